@@ -0,0 +1,246 @@
+import json
+import math
+import re
+from typing import Annotated, Literal
+
+from pydantic import AfterValidator, BaseModel, BeforeValidator, StringConstraints, TypeAdapter, ValidationError
+
+DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def _split_tags(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [tag for tag in (part.strip() for part in value.split(",")) if tag]
+    if isinstance(value, list):
+        return [tag for tag in value if not (isinstance(tag, str) and not tag.strip())]
+    return value
+
+
+def _date_or_empty(value):
+    # a malformed date is dropped instead of failing the answer, Paperless then keeps its own
+    return value if DATE.match(value) else ""
+
+
+def _text_or_empty(value):
+    return "" if value is None else value
+
+
+Required = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
+Text = Annotated[str, BeforeValidator(_text_or_empty), StringConstraints(strip_whitespace=True)]
+Date = Annotated[Text, AfterValidator(_date_or_empty)]
+Tags = Annotated[list[Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]], BeforeValidator(_split_tags)]
+
+FIELD_TYPES = {
+    "title": Required,
+    "created_date": Date,
+    "tags": Tags,
+    "correspondent": Text,
+    "document_type": Text,
+    "summary": Required,
+    "explanation": Text,
+}
+FIELD_ADAPTERS = {name: TypeAdapter(field_type) for name, field_type in FIELD_TYPES.items()}
+
+# characters of each field the prompt asks for, with room for quoting and slightly long answers; they size
+# max_tokens, and a field growing past twice its budget is a runaway answer
+FIELD_BUDGETS = {
+    "title": 64,
+    "created_date": 12,
+    "tags": 160,
+    "correspondent": 64,
+    "document_type": 64,
+    "summary": 192,
+    "explanation": 400,
+}
+UNKNOWN_FIELD_BUDGET = 1000
+# free text that may be as long as the model likes: it is never a runaway, a long one is cut off by max_tokens
+UNBOUNDED_FIELDS = ("explanation",)
+# German text averages about three characters per token
+CHARS_PER_TOKEN = 3
+
+
+class Answer(BaseModel):
+    """The answer expected for one document, see the response format of the prompt."""
+    title: Required
+    created_date: Date = ""
+    tags: Tags = []
+    correspondent: Text = ""
+    document_type: Text = ""
+    summary: Required
+    explanation: Text = ""
+
+
+class MetadataAnswer(Answer):
+    """An answer only assigning tags, correspondent and document type, such as one reused from similar documents.
+
+    Title, date and summary are empty, the document keeps its own.
+    """
+    title: Text = ""
+    summary: Text = ""
+    metadata_only: Literal[True]
+
+
+class MalformedAnswer(ValueError):
+    pass
+
+
+def max_answer_tokens():
+    """Completion tokens an answer following the response format needs, keys and punctuation included."""
+    chars = sum(FIELD_BUDGETS.values()) + sum(len(name) + 6 for name in FIELD_BUDGETS)
+    return math.ceil(chars / CHARS_PER_TOKEN)
+
+
+def validate_field(name, value):
+    """Returns the validated value of a top-level field. Raises MalformedAnswer if it does not fit the schema."""
+    adapter = FIELD_ADAPTERS.get(name)
+    if adapter is None:
+        return value
+    try:
+        return adapter.validate_python(value)
+    except ValidationError as e:
+        raise MalformedAnswer(f"invalid {name}: {e.errors()[0]['msg']}") from None
+
+
+def parse_answer(text):
+    """Returns the Answer in text, or None if there is none.
+
+    Text around the JSON object, such as a Markdown code fence, is ignored.
+    """
+    if not text:
+        return None
+    try:
+        data = json.loads(text)
+    except ValueError:
+        start, end = text.find("{"), text.rfind("}")
+        if start < 0 or end < start:
+            return None
+        try:
+            data = json.loads(text[start:end + 1])
+        except ValueError:
+            return None
+    if not isinstance(data, dict):
+        return None
+    try:
+        return (MetadataAnswer if data.get("metadata_only") else Answer).model_validate(data)
+    except ValidationError:
+        return None
+
+
+class AnswerStream:
+    """Parses a JSON answer while it is streamed.
+
+    Each top-level field is validated as soon as its value is complete and then passed to on_field(name, value),
+    so work depending on it can start while the rest is generated. feed() raises MalformedAnswer as soon as the
+    text cannot become a valid answer: it does not start with an object, a field fails validation or outgrows
+    its budget (the explanation has none). finish() also accepts an answer cut off by max_tokens once all required fields are complete.
+    """
+
+    def __init__(self, on_field=None):
+        self.on_field = on_field
+        self.fields = {}
+        self._text = []
+        self._size = 0
+        self._started = False
+        self._closed = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._field = ""
+        self._key = None
+        self._value_size = 0
+
+    def __len__(self):
+        return self._size
+
+    def feed(self, chunk):
+        self._text.append(chunk)
+        self._size += len(chunk)
+        for char in chunk:
+            if self._closed:
+                if not char.isspace():
+                    raise MalformedAnswer("text after the answer object")
+                continue
+            if not self._started:
+                if char.isspace():
+                    continue
+                if char != "{":
+                    raise MalformedAnswer("answer does not start with a JSON object")
+                self._started = True
+                self._depth = 1
+                continue
+            if self._step(char):
+                self._field += char
+                if self._key is not None:
+                    self._value_size += 1
+        if self._key is None or self._key in UNBOUNDED_FIELDS:
+            return
+        limit = 2 * FIELD_BUDGETS.get(self._key, UNKNOWN_FIELD_BUDGET)
+        if self._value_size > limit:
+            raise MalformedAnswer(f"{self._key} is longer than {limit} characters")
+
+    def _step(self, char):
+        """Advances the scanner by one character. Returns False if the character ends the current field."""
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif char == '"':
+                self._in_string = False
+            return True
+        if char == '"':
+            self._in_string = True
+        elif char in "{[":
+            self._depth += 1
+        elif char in "}]":
+            self._depth -= 1
+            if self._depth == 0:
+                self._complete()
+                self._closed = True
+                return False
+        elif self._depth == 1 and char == ",":
+            self._complete()
+            return False
+        elif self._depth == 1 and char == ":" and self._key is None:
+            try:
+                self._key = json.loads(self._field)
+            except ValueError:
+                raise MalformedAnswer(f"invalid key {self._field.strip()!r}") from None
+        return True
+
+    def _complete(self):
+        fragment, self._field, self._key, self._value_size = self._field.strip(), "", None, 0
+        if not fragment:
+            return
+        try:
+            data = json.loads("{" + fragment + "}")
+        except ValueError:
+            raise MalformedAnswer(f"invalid field {fragment[:40]!r}") from None
+        for name, value in data.items():
+            value = validate_field(name, value)
+            self.fields[name] = value
+            if self.on_field:
+                self.on_field(name, value)
+
+    def finish(self):
+        """Returns the complete answer as JSON text. Raises MalformedAnswer if required fields are missing."""
+        if not self._started:
+            raise MalformedAnswer("empty answer")
+        if not self._closed:
+            # cut off by max_tokens: the last field is kept if it happens to be complete, usually it is the
+            # explanation and lost
+            try:
+                self._complete()
+            except MalformedAnswer:
+                pass
+        try:
+            answer = Answer.model_validate(self.fields)
+        except ValidationError as e:
+            raise MalformedAnswer(f"incomplete answer: {e.errors()[0]['loc']} {e.errors()[0]['msg']}") from None
+        return json.dumps(answer.model_dump(), ensure_ascii=False)
+
+    @property
+    def text(self):
+        return "".join(self._text)
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import logging
+import time
+
+import httpx
+
+from cfg import TIMEOUT, PAPERLESS_MAX_CONNECTIONS
+from metrics import record_request
+from ratelimit import PAPERLESS_LIMITER
+from resilience import (DEFAULT_POLICY, IDEMPOTENT_METHODS, PAPERLESS_BREAKER, RETRY_COUNTS, RETRY_STATUSES,
+                        RejectedRequest, is_rejected, parse_retry_after)
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class AsyncPaperlessClient:
+    """asyncio counterpart of a requests session plus make_request, backed by one pooled httpx client.
+
+    Uses HTTP/2 with keep-alive when the optional h2 package is installed, HTTP/1.1 keep-alive otherwise.
+    """
+
+    def __init__(self, api_key, max_connections=PAPERLESS_MAX_CONNECTIONS, http2=True):
+        if http2 and not HTTP2_AVAILABLE:
+            logging.info("h2 is not installed, using HTTP/1.1 for Paperless")
+        self._client = httpx.AsyncClient(
+            headers={
+                "Authorization": f"Token {api_key}",
+                "Content-Type": "application/json",
+                "Accept": "application/json; version=4",
+            },
+            http2=http2 and HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=TIMEOUT,
+        )
+
+    async def request(self, url, method, body=None, params=None, idempotent=None, raise_rejected=False):
+        """Same contract and retry behaviour as helpers.make_request: the decoded JSON, the text if it is not JSON, or None on errors."""
+        if body is not None:
+            body = json.dumps(body)
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+
+        attempt = 0
+        while True:
+            attempt += 1
+            can_retry = idempotent and attempt < DEFAULT_POLICY.max_attempts
+            await PAPERLESS_BREAKER.before_call_async()
+            try:
+                async with PAPERLESS_LIMITER.limit_async():
+                    start = time.perf_counter()
+                    r = await self._client.request(method, url, params=params, content=body)
+            except (httpx.ConnectError, httpx.TimeoutException) as e:
+                record_request("paperless", method, url, "error", time.perf_counter() - start)
+                PAPERLESS_BREAKER.record_failure()
+                if can_retry:
+                    await self._wait_before_retry(url, attempt, e)
+                    continue
+                if isinstance(e, httpx.TimeoutException):
+                    logging.error(f"Timeout calling {url}: {e}")
+                else:
+                    logging.error(f"Error connecting to {url}: {e}")
+                return None
+            except httpx.HTTPError as e:
+                record_request("paperless", method, url, "error", time.perf_counter() - start)
+                logging.error(f"Error calling {url}: {e}")
+                return None
+
+            record_request("paperless", method, url, r.status_code, time.perf_counter() - start)
+            if r.status_code not in RETRY_STATUSES:
+                PAPERLESS_BREAKER.record_success()
+                break
+            PAPERLESS_BREAKER.record_failure()
+            if not can_retry:
+                break
+            await self._wait_before_retry(url, attempt, f"status {r.status_code}", parse_retry_after(r.headers))
+
+        try:
+            r.raise_for_status()
+        except httpx.HTTPStatusError as e:
+            logging.error(f"Http error calling {url}: {e}")
+            logging.error(f"Response: {r.text}")
+            if raise_rejected and is_rejected(r.status_code, r.text):
+                raise RejectedRequest(f"{method} {url} was rejected with status {r.status_code}") from None
+            return None
+
+        try:
+            return r.json()
+        except ValueError as e:
+            logging.error(f"Error occurred converting response to json {e}")
+            return r.text
+
+    @staticmethod
+    async def _wait_before_retry(url, attempt, reason, retry_after=None):
+        delay = DEFAULT_POLICY.delay(attempt, retry_after)
+        logging.warning(f"attempt {attempt} calling {url} failed ({reason}), retrying in {delay:.1f}s")
+        RETRY_COUNTS.add("paperless")
+        await asyncio.sleep(delay)
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
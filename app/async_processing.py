@@ -0,0 +1,324 @@
+import asyncio
+import logging
+from collections import deque
+
+from openai import AsyncOpenAI
+
+from answer_schema import AnswerStream, MalformedAnswer, max_answer_tokens
+from async_client import AsyncPaperlessClient
+from cascade import classify_from_neighbours, record_processed
+from correspondents import get_or_create_correspondent_async
+from custom_fields import get_or_create_custom_field_async
+from document_type import get_or_create_document_type_async
+from duplicates import record_document, recorded_answer, reuse_duplicate
+from helpers import ListingError
+from metrics import METRICS, timed_request
+from cfg import ANSWER_MAX_ATTEMPTS, ANSWER_MAX_TOKENS, STREAM_ANSWERS
+from main import (METADATA_FIELDS, ProcessingContext, build_document_update, build_messages, interpret_response,
+                  lookup_cached_answer, read_answer, store_valid_answer, with_current_date)
+from metadata_cache import load_all_async
+from ratelimit import OPENAI_LIMITER, estimate_tokens
+from result_cache import cache_key
+from tags import get_or_create_tags_async
+from usage import USAGE
+from resilience import OPENAI_BREAKER, call_with_retries_async, classify_openai_error
+
+
+async def create_async_context(paperless_url, paperless_key, openai_model, openai_key, openai_base_url,
+                               username=None, dry_run=False):
+    """Builds a ProcessingContext whose session is an AsyncPaperlessClient and whose client is AsyncOpenAI.
+
+    The caller must close it with close_async_context().
+    """
+    client = AsyncPaperlessClient(paperless_key)
+    owner_id = await get_owner_id_async(client, username, paperless_url) if username else None
+    # retries are handled by query_openai_async
+    openai_client = AsyncOpenAI(api_key=openai_key, base_url=openai_base_url, max_retries=0)
+    return ProcessingContext(client, paperless_url, openai_model, openai_key, openai_base_url,
+                             dry_run=dry_run, owner_id=owner_id, openai_client=openai_client)
+
+
+async def close_async_context(ctx):
+    await ctx.sess.aclose()
+    await ctx.openai_client.close()
+    # waits for batches still running
+    await asyncio.to_thread(ctx.close)
+
+
+async def get_owner_id_async(client, username, paperless_url):
+    """Async version of main.get_owner_id."""
+    response = await client.request(paperless_url + "/api/users/", "GET", params={"username__iexact": username})
+    if not response or 'results' not in response or len(response['results']) == 0:
+        logging.error(f"Could not retrieve owner ID for username {username}")
+        return None
+    user = response['results'][0]
+    logging.info(f"Owner ID for username {username} is {user['id']}")
+    return user['id']
+
+
+async def get_single_document_async(client, doc_pk, paperless_url):
+    """Async version of main.get_single_document."""
+    return await client.request(paperless_url + f"/api/documents/{doc_pk}/", "GET")
+
+
+async def query_openai_async(client, model, messages, **kwargs):
+    """Async version of main.query_openai using an AsyncOpenAI client."""
+    kwargs = {k: v for k, v in kwargs.items() if k not in ("mock", "completion_tokens")}
+    messages = with_current_date(messages)
+
+    async def create():
+        async with OPENAI_LIMITER.limit_async(tokens=estimate_tokens(messages)):
+            with timed_request("openai", "POST", "/chat/completions"):
+                return await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    response_format={"type": "json_object"},
+                    **kwargs
+                )
+
+    response = await call_with_retries_async(create, "openai", OPENAI_BREAKER, classify_openai_error)
+    USAGE.record(model, getattr(response, "usage", None))
+    return response
+
+
+async def stream_answer_async(client, model, messages, on_field=None):
+    """Async version of main.stream_answer using an AsyncOpenAI client."""
+    messages = with_current_date(messages)
+    max_tokens = ANSWER_MAX_TOKENS or max_answer_tokens()
+    for attempt in range(1, ANSWER_MAX_ATTEMPTS + 1):
+        parser = None
+
+        async def consume():
+            nonlocal parser
+            parser = AnswerStream(on_field)
+            async with OPENAI_LIMITER.limit_async(tokens=estimate_tokens(messages)):
+                with timed_request("openai", "POST", "/chat/completions"):
+                    stream = await client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        response_format={"type": "json_object"},
+                        max_tokens=max_tokens,
+                        stream=True,
+                        extra_body={"stream_options": {"include_usage": True}},
+                    )
+                    try:
+                        async for chunk in stream:
+                            USAGE.record(model, getattr(chunk, "usage", None))
+                            if chunk.choices and chunk.choices[0].delta.content:
+                                parser.feed(chunk.choices[0].delta.content)
+                    finally:
+                        await stream.response.aclose()
+
+        try:
+            await call_with_retries_async(consume, "openai", OPENAI_BREAKER, classify_openai_error)
+            return parser.finish()
+        except MalformedAnswer as e:
+            METRICS.inc("malformed_answers_total", model=model)
+            logging.warning(f"attempt {attempt} of {ANSWER_MAX_ATTEMPTS}: aborted malformed answer after "
+                            f"{len(parser)} characters ({e}): {parser.text[:200]!r}")
+    return None
+
+
+# keeps the tasks of early_resolution_async referenced until they are done
+_early_tasks = set()
+
+
+def early_resolution_async(ctx):
+    """Async version of main.early_resolution, loading the listings in a task on the running event loop."""
+    if ctx.dry_run:
+        return None
+
+    def on_field(name, value):
+        if name not in METADATA_FIELDS or not value:
+            return
+        task = asyncio.get_running_loop().create_task(load_all_async(ctx.sess, ctx.paperless_url))
+        _early_tasks.add(task)
+        task.add_done_callback(_early_loaded)
+    return on_field
+
+
+def _early_loaded(task):
+    _early_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        # only a head start, resolve_metadata_ids_async loads the listings again
+        logging.warning(f"could not load metadata listings while the answer is generated: {task.exception()}")
+
+
+async def generate_title_tags_correspondent_and_type_async(ctx, content, on_field=None):
+    """Async version of main.generate_title_tags_correspondent_and_type."""
+    messages = build_messages(ctx.openai_model, content)
+    key = cache_key(ctx.openai_model, messages)
+    answer, skip = lookup_cached_answer(key)
+    if skip:
+        return answer
+    if ctx.backend:
+        # the batcher blocks until the batch is answered, so wait for it off the event loop
+        return store_valid_answer(key, await asyncio.to_thread(ctx.backend.generate, messages))
+    if STREAM_ANSWERS:
+        return store_valid_answer(key, await stream_answer_async(ctx.openai_client, ctx.openai_model, messages, on_field))
+    response = await query_openai_async(ctx.openai_client, model=ctx.openai_model, messages=messages)
+    return read_answer(key, response)
+
+
+async def resolve_metadata_ids_async(ctx, doc_pk, tags, correspondent, document_type):
+    """Async version of main.resolve_metadata_ids, resolving correspondent, tags and document type concurrently."""
+    client, paperless_url = ctx.sess, ctx.paperless_url
+    correspondent_id, tag_ids, document_type_id = await asyncio.gather(
+        get_or_create_correspondent_async(client, correspondent, paperless_url, ctx.owner_id),
+        get_or_create_tags_async(client, tags, paperless_url, ctx.owner_id),
+        get_or_create_document_type_async(client, document_type, paperless_url),
+    )
+    if not correspondent_id:
+        logging.error(f"could not retrieve or create correspondent for document {doc_pk}")
+        return None
+    if not tag_ids:
+        logging.error(f"could not retrieve or create tags for document {doc_pk}")
+        return None
+    if not document_type_id:
+        logging.error(f"could not retrieve or create document_type for document {doc_pk}")
+        return None
+    return {"tags": tag_ids, "correspondent": correspondent_id, "document_type": document_type_id}
+
+
+async def update_document_async(client, doc_pk, update, paperless_url):
+    """Async version of main.update_document."""
+    if not update:
+        logging.info(f"document {doc_pk} is already up to date")
+        return True
+    resp = await client.request(paperless_url + f"/api/documents/{doc_pk}/", "PATCH", body=update)
+    if not resp:
+        logging.error(f"could not update document {doc_pk} with {update}")
+        return False
+    logging.info(f"updated document {doc_pk} with {update}")
+    return True
+
+
+async def process_single_document_async(ctx, doc_info):
+    """Async version of main.process_single_document for a context built by create_async_context()."""
+    with METRICS.stage("document"):
+        processed = await write_document_async(ctx, doc_info)
+    METRICS.inc("documents_total", result="processed" if processed else "failed")
+    return processed
+
+
+async def write_document_async(ctx, doc_info):
+    doc_pk = doc_info["id"]
+    with METRICS.stage("generate"):
+        # the lookups are local, only a small model call may block
+        response = (reuse_duplicate(doc_info)
+                    or await asyncio.to_thread(classify_from_neighbours, ctx, doc_info)
+                    or await generate_title_tags_correspondent_and_type_async(ctx, doc_info["content"],
+                                                                              early_resolution_async(ctx)))
+    result = interpret_response(doc_info, response)
+    if not result:
+        return False
+    title, tags, correspondent, document_type, created_date, summary = result
+
+    if ctx.dry_run:
+        logging.info(f"dry run, not updating document {doc_pk}")
+        return True
+
+    async def get_summary_field():
+        # an answer only assigning metadata leaves the summary as it is
+        return await get_or_create_custom_field_async(ctx.sess, "summary", ctx.paperless_url) if summary else None
+
+    # resolved concurrently, so both are timed as one stage
+    with METRICS.stage("resolve_metadata"):
+        metadata_ids, summary_field_id = await asyncio.gather(
+            resolve_metadata_ids_async(ctx, doc_pk, tags, correspondent, document_type),
+            get_summary_field(),
+        )
+    if not metadata_ids:
+        title = None
+    if summary and not summary_field_id:
+        logging.error(f"could not create or retrieve custom field 'summary' for document {doc_pk}")
+
+    update = build_document_update(doc_info, title, metadata_ids, created_date, summary_field_id, summary)
+    with METRICS.stage("update"):
+        updated = await update_document_async(ctx.sess, doc_pk, update, ctx.paperless_url)
+    if updated:
+        recorded = recorded_answer(response)
+        record_document(doc_info, recorded)
+        record_processed(doc_info, recorded)
+    return updated
+
+
+async def iter_documents_async(client, paperless_url, advanced_filter=None, page_size=None, fields=None):
+    """Async version of cli.iter_documents, yielding documents page by page. Raises ListingError on a failed page."""
+    url = paperless_url + "/api/documents/"
+    if advanced_filter:
+        url += f"?{advanced_filter}"
+    params = {"page_size": page_size} if page_size else {}
+    if fields:
+        params["fields"] = fields
+    while url:
+        response = await client.request(url, "GET", params=params)
+        if not response or not isinstance(response, dict):
+            raise ListingError(f"could not retrieve documents from {url}")
+        for doc in response.get("results", []):
+            yield doc
+        url = response.get("next")
+        params = None
+
+
+async def fetch_documents_async(client, paperless_url, ids):
+    """Async version of cli.fetch_documents."""
+    params = {"id__in": ",".join(str(doc_pk) for doc_pk in ids), "page_size": len(ids)}
+    response = await client.request(paperless_url + "/api/documents/", "GET", params=params)
+    if not response or not isinstance(response, dict):
+        raise ListingError(f"could not retrieve documents {ids}")
+    return response.get("results", [])
+
+
+async def iter_with_content_async(client, paperless_url, listed, batch_size, concurrency):
+    """Async version of cli.iter_with_content for an async iterable of listed documents."""
+    pending = deque()
+    batch = []
+    try:
+        async for doc in listed:
+            batch.append(doc["id"])
+            if len(batch) < batch_size:
+                continue
+            pending.append(asyncio.create_task(fetch_documents_async(client, paperless_url, batch)))
+            batch = []
+            if len(pending) >= concurrency:
+                for full_doc in await pending.popleft():
+                    yield full_doc
+        if batch:
+            pending.append(asyncio.create_task(fetch_documents_async(client, paperless_url, batch)))
+        while pending:
+            for full_doc in await pending.popleft():
+                yield full_doc
+    finally:
+        # after a failed fetch the listing is incomplete anyway, the fetches still running are not needed
+        for task in pending:
+            task.cancel()
+
+
+async def run_documents_async(ctx, documents, concurrency, on_done=None):
+    """Processes documents from an async iterable with at most concurrency documents in flight.
+
+    on_done(doc, processed) is called after each document that did not raise.
+    """
+    in_flight = set()
+
+    async def run(doc):
+        logging.info(f"running for document {doc['id']}")
+        try:
+            processed = await process_single_document_async(ctx, doc)
+        except Exception:
+            logging.exception(f"unhandled error while processing document {doc['id']}")
+            return
+        if on_done:
+            on_done(doc, processed)
+        logging.info(f"finished running for document {doc['id']}")
+
+    try:
+        async for doc in documents:
+            if len(in_flight) >= concurrency:
+                _, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            in_flight.add(asyncio.create_task(run(doc)))
+    finally:
+        # documents already started are finished even if the listing fails
+        if in_flight:
+            await asyncio.wait(in_flight)
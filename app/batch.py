@@ -0,0 +1,235 @@
+import io
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+
+from cfg import TIMEOUT, BATCH_MAX_REQUESTS
+from main import apply_response, build_messages, get_single_document, parse_response, reuse_answer, with_current_date
+from result_cache import cache_key, get_cached_answer, store_answer
+from usage import USAGE
+
+DEFAULT_OPENAI_BASEURL = "https://api.openai.com/v1"
+CHAT_COMPLETIONS = "/v1/chat/completions"
+FINISHED_STATES = ("completed", "failed", "expired", "cancelled")
+# the Batch API accepts input files up to 200 MB
+MAX_BATCH_BYTES = 190 * 1024 * 1024
+
+
+class BatchState:
+    """Local checkpoint of submitted batches and of which documents have been applied, kept in SQLite."""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS batches ("
+                "batch_id TEXT PRIMARY KEY, status TEXT NOT NULL, output_file_id TEXT, error_file_id TEXT, "
+                "created_at REAL NOT NULL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS requests ("
+                "custom_id TEXT PRIMARY KEY, doc_pk INTEGER NOT NULL, batch_id TEXT, cache_key TEXT NOT NULL, "
+                "status TEXT NOT NULL)")
+
+    def is_requested(self, doc_pk):
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM requests WHERE doc_pk = ? AND status != 'failed'",
+                                     (doc_pk,)).fetchone()
+            return row is not None
+
+    def add_batch(self, batch_id, status, requests_in_batch):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT INTO batches (batch_id, status, created_at) VALUES (?, ?, ?)",
+                               (batch_id, status, time.time()))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO requests (custom_id, doc_pk, batch_id, cache_key, status) "
+                "VALUES (?, ?, ?, ?, 'submitted')",
+                [(custom_id, doc_pk, batch_id, key) for custom_id, doc_pk, key in requests_in_batch])
+
+    def update_batch(self, batch_id, status, output_file_id=None, error_file_id=None):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE batches SET status = ?, output_file_id = ?, error_file_id = ? WHERE batch_id = ?",
+                               (status, output_file_id, error_file_id, batch_id))
+
+    def batches(self, statuses=None):
+        with self._lock:
+            rows = self._conn.execute("SELECT batch_id, status, output_file_id, error_file_id FROM batches").fetchall()
+        return [row for row in rows if statuses is None or row[1] in statuses]
+
+    def request(self, custom_id):
+        """Returns (doc_pk, cache_key, status) for a submitted request, or None."""
+        with self._lock:
+            return self._conn.execute("SELECT doc_pk, cache_key, status FROM requests WHERE custom_id = ?",
+                                      (custom_id,)).fetchone()
+
+    def set_request_status(self, custom_id, status):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE requests SET status = ? WHERE custom_id = ?", (status, custom_id))
+
+    def counts(self):
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM requests GROUP BY status").fetchall())
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def openai_request(sess, base_url, method, path, **kwargs):
+    """Calls the OpenAI REST API directly. Returns the response, or None on errors."""
+    url = (base_url or DEFAULT_OPENAI_BASEURL).rstrip("/") + path
+    try:
+        r = sess.request(method, url, timeout=TIMEOUT * 6, **kwargs)
+        r.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Error calling {url}: {e}")
+        return None
+    return r
+
+
+def build_batch_request(custom_id, model, messages):
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": CHAT_COMPLETIONS,
+        "body": {"model": model, "messages": with_current_date(messages), "response_format": {"type": "json_object"}},
+    }
+
+
+def submit_batches(ctx, state, documents, openai_sess, max_requests=BATCH_MAX_REQUESTS):
+    """Writes chat requests for documents not yet submitted to JSONL files and submits each as a batch.
+
+    A batch is cut after max_requests requests or MAX_BATCH_BYTES of input, staying below the API's limits.
+    Near duplicates, documents classified from similar ones and documents with a cached answer are applied right
+    away instead of being submitted.
+    """
+    lines, pending = [], []
+    size = 0
+
+    def submit():
+        batch_id = submit_batch_file(openai_sess, ctx.openai_base_url, "\n".join(lines) + "\n")
+        if batch_id:
+            state.add_batch(batch_id, "validating", pending)
+            logging.info(f"submitted batch {batch_id} with {len(pending)} documents")
+        lines.clear()
+        pending.clear()
+        return 0
+
+    for doc in documents:
+        doc_pk = doc["id"]
+        if state.is_requested(doc_pk):
+            continue
+        reused = reuse_answer(ctx, doc)
+        if reused:
+            apply_response(ctx, doc, reused)
+            continue
+        messages = build_messages(ctx.openai_model, doc["content"])
+        key = cache_key(ctx.openai_model, messages)
+        answer = get_cached_answer(key)
+        if answer:
+            logging.info(f"using cached answer for document {doc_pk}")
+            apply_response(ctx, doc, answer)
+            continue
+        custom_id = f"doc-{doc_pk}"
+        line = json.dumps(build_batch_request(custom_id, ctx.openai_model, messages))
+        if lines and size + len(line) + 1 > MAX_BATCH_BYTES:
+            size = submit()
+        lines.append(line)
+        pending.append((custom_id, doc_pk, key))
+        size += len(line) + 1
+        if len(lines) >= max_requests:
+            size = submit()
+    if lines:
+        submit()
+
+
+def submit_batch_file(openai_sess, base_url, jsonl):
+    """Uploads a JSONL input file and creates a batch for it. Returns the batch ID or None."""
+    upload = openai_request(openai_sess, base_url, "POST", "/files", data={"purpose": "batch"},
+                            files={"file": ("batch.jsonl", io.BytesIO(jsonl.encode("utf-8")), "application/jsonl")})
+    if upload is None:
+        return None
+    batch = openai_request(openai_sess, base_url, "POST", "/batches", json={
+        "input_file_id": upload.json()["id"],
+        "endpoint": CHAT_COMPLETIONS,
+        "completion_window": "24h",
+    })
+    if batch is None:
+        return None
+    return batch.json()["id"]
+
+
+def refresh_batches(state, openai_sess, base_url):
+    """Updates the status of all unfinished batches. Returns the number still running."""
+    running = 0
+    for batch_id, status, _, _ in state.batches():
+        if status in FINISHED_STATES:
+            continue
+        response = openai_request(openai_sess, base_url, "GET", f"/batches/{batch_id}")
+        if response is None:
+            running += 1
+            continue
+        batch = response.json()
+        state.update_batch(batch_id, batch["status"], batch.get("output_file_id"), batch.get("error_file_id"))
+        logging.info(f"batch {batch_id} is {batch['status']} ({batch.get('request_counts')})")
+        if batch["status"] not in FINISHED_STATES:
+            running += 1
+    return running
+
+
+def iter_batch_results(state, openai_sess, base_url):
+    """Yields (custom_id, answer) for every result line of finished batches. answer is None for failed requests."""
+    for batch_id, _, output_file_id, error_file_id in state.batches(FINISHED_STATES):
+        for file_id in (output_file_id, error_file_id):
+            if not file_id:
+                continue
+            response = openai_request(openai_sess, base_url, "GET", f"/files/{file_id}/content")
+            if response is None:
+                logging.error(f"could not download results {file_id} of batch {batch_id}")
+                continue
+            for line in response.text.splitlines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                answer = None
+                body = (result.get("response") or {}).get("body") or {}
+                if body.get("usage"):
+                    USAGE.record(body.get("model", "batch"), body["usage"])
+                if not result.get("error") and body.get("choices"):
+                    answer = body["choices"][0]["message"]["content"]
+                yield result["custom_id"], answer
+
+
+def apply_batch_result(ctx, state, custom_id, answer):
+    """Applies one batch result through the regular update path, checkpointing the outcome.
+
+    A dry run writes nothing, so it does not checkpoint either and a later apply still updates the document.
+    """
+    request = state.request(custom_id)
+    if request is None:
+        logging.warning(f"unknown batch request {custom_id}")
+        return
+    doc_pk, key, status = request
+    if status in ("applied", "failed"):
+        return
+    if not answer or not parse_response(answer)[0]:
+        logging.error(f"batch request for document {doc_pk} returned no usable answer")
+        if not ctx.dry_run:
+            state.set_request_status(custom_id, "failed")
+        return
+    store_answer(key, answer)
+    doc_info = get_single_document(ctx.sess, doc_pk, ctx.paperless_url)
+    if not isinstance(doc_info, dict):
+        logging.error(f"could not retrieve document info for document {doc_pk}")
+        return
+    processed = apply_response(ctx, doc_info, answer)
+    if not ctx.dry_run:
+        state.set_request_status(custom_id, "applied" if processed else "failed")
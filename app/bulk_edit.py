@@ -0,0 +1,122 @@
+import logging
+import threading
+from collections import Counter
+
+from cfg import BULK_EDIT_BATCH_SIZE
+from helpers import make_request
+
+
+def bulk_edit(sess, paperless_url, document_ids, method, parameters):
+    """Applies one bulk_edit method to a list of documents."""
+    url = paperless_url + "/api/documents/bulk_edit/"
+    body = {
+        "documents": document_ids,
+        "method": method,
+        "parameters": parameters
+    }
+    # setting the same correspondent, type or tags again changes nothing, so the POST is safe to retry
+    resp = make_request(sess, url, "POST", body=body, idempotent=True)
+    if not resp:
+        logging.error(f"could not run {method} with {parameters} on documents {document_ids}")
+        return False
+    logging.info(f"ran {method} with {parameters} on {len(document_ids)} documents")
+    return True
+
+
+class BulkCommitter:
+    """Collects tag, correspondent and document type assignments and writes them with bulk_edit.
+
+    Documents that need the same correspondent, the same document type or the same tags added are grouped, so
+    each group costs one request instead of one PATCH per document. A group is written once it holds
+    batch_size documents, everything else on flush(). when_written() tells when all groups of a document were
+    written and whether they succeeded.
+    """
+
+    def __init__(self, paperless_url, batch_size=BULK_EDIT_BATCH_SIZE):
+        self.paperless_url = paperless_url
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        # (method, value) -> IDs of the documents it is written to
+        self._correspondents = {}
+        self._document_types = {}
+        self._tags = {}
+        # document id -> queued groups holding it
+        self._outstanding = Counter()
+        # documents with a failed bulk_edit whose result was not handed to when_written() yet
+        self._failed = set()
+        self._callbacks = {}
+
+    def add(self, sess, doc_info, metadata_ids):
+        """Queues the changes of one document, writing any group that became full."""
+        doc_pk = doc_info["id"]
+        full = []
+        with self._lock:
+            if metadata_ids["correspondent"] != doc_info.get("correspondent"):
+                full += self._queue(self._correspondents, ("set_correspondent", metadata_ids["correspondent"]), doc_pk)
+            if metadata_ids["document_type"] != doc_info.get("document_type"):
+                full += self._queue(self._document_types, ("set_document_type", metadata_ids["document_type"]), doc_pk)
+            # like the PATCH, added to the current tags, see main.build_document_update
+            added_tags = frozenset(metadata_ids["tags"]) - set(doc_info.get("tags") or [])
+            if added_tags:
+                full += self._queue(self._tags, ("modify_tags", added_tags), doc_pk)
+        for key, documents in full:
+            self._commit(sess, key, documents)
+
+    def _queue(self, groups, key, doc_pk):
+        documents = groups.setdefault(key, set())
+        if doc_pk not in documents:
+            self._outstanding[doc_pk] += 1
+            documents.add(doc_pk)
+        if len(documents) < self.batch_size:
+            return []
+        return [(key, groups.pop(key))]
+
+    def when_written(self, doc_pk, callback):
+        """Calls callback(ok) once every queued change of the document is written, right away if none is queued.
+
+        ok is False if a bulk_edit with the document failed. The callback may run on the thread writing the last
+        group, during add() or flush().
+        """
+        with self._lock:
+            if self._outstanding.get(doc_pk):
+                self._callbacks[doc_pk] = callback
+                return
+            ok = doc_pk not in self._failed
+            self._failed.discard(doc_pk)
+        callback(ok)
+
+    def flush(self, sess):
+        """Writes all queued groups."""
+        with self._lock:
+            pending = []
+            for groups in (self._correspondents, self._document_types, self._tags):
+                pending += groups.items()
+                groups.clear()
+        for key, documents in pending:
+            self._commit(sess, key, documents)
+
+    def _commit(self, sess, key, documents):
+        method, value = key
+        document_ids = sorted(documents)
+        if method == "set_correspondent":
+            parameters = {"correspondent": value}
+        elif method == "set_document_type":
+            parameters = {"document_type": value}
+        else:
+            parameters = {"add_tags": sorted(value), "remove_tags": []}
+        ok = bulk_edit(sess, self.paperless_url, document_ids, method, parameters)
+        written = []
+        with self._lock:
+            for doc_pk in document_ids:
+                if not ok:
+                    self._failed.add(doc_pk)
+                self._outstanding[doc_pk] -= 1
+                if self._outstanding[doc_pk] > 0:
+                    continue
+                del self._outstanding[doc_pk]
+                callback = self._callbacks.pop(doc_pk, None)
+                if callback:
+                    written.append((callback, doc_pk not in self._failed))
+                    self._failed.discard(doc_pk)
+        for callback, doc_ok in written:
+            callback(doc_ok)
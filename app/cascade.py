@@ -0,0 +1,241 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from cfg import CASCADE_INDEX_PATH, CASCADE_MAX_DISTANCE, CASCADE_MIN_NEIGHBOURS, CASCADE_MODEL
+from fingerprint import hamming, shingles, simhash, to_signed, to_unsigned
+from metrics import METRICS
+from result_cache import cache_key, store_answer
+from token_budget import content_budget, count_tokens, select_content
+
+# 64-bit fingerprints split into 8 bands of 8 bits: two fingerprints at most 7 bits apart share at least one band
+BANDS = 8
+BAND_BITS = 8
+# documents with fewer distinct word pairs give fingerprints too noisy to trust
+MIN_SHINGLES = 20
+# neighbours whose answers are compared
+MAX_NEIGHBOURS = 5
+
+TITLE_PROMPT = """You are an AI model that is responsible for analyzing OCR text from scanned documents whose tags, correspondent and document type are already known. Generate only a title, the most relevant date, and a summary.
+
+===Response Guidelines
+1. The title should not contain any dates, should begin with an uppercase letter with all nouns capitalized, must not contain special characters, slashes, or leading/trailing spaces, and is at most 32 characters long.
+2. Return the most relevant date (e.g., creation date or the date the letter was written) in the format "YYYY-MM-DD" as `created_date`. If no relevant date can be found, use today's date.
+3. The `summary` summarizes the document in no more than 128 characters and must always be in German.
+4. Respond in a valid JSON format.
+
+===Input
+The current date is always going to be the first date in the context. The rest of the context is the truncated OCR text from the scanned document.
+
+===Response Format
+{
+  "title": "A valid title with capitalized nouns.",
+  "created_date": "YYYY-MM-DD",
+  "summary": ""
+}
+"""
+
+
+def fingerprint_content(content):
+    """SimHash of the content's word pairs, or None if the content is too short to compare."""
+    features = shingles(content)
+    if len(features) < MIN_SHINGLES:
+        return None
+    return simhash(features)
+
+
+class NeighbourIndex:
+    """SQLite backed index of processed documents by the SimHash of their content, kept in memory for lookups.
+
+    Every document is stored with the answer it was processed with. Candidates are the documents sharing at
+    least one band of their fingerprint, which finds every document up to 7 bits away without comparing
+    against all of them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "doc_pk INTEGER PRIMARY KEY, simhash INTEGER NOT NULL, answer TEXT NOT NULL, recorded_at REAL NOT NULL)")
+        self._fingerprints = {}
+        self._bands = {}
+        for doc_pk, value in self._conn.execute("SELECT doc_pk, simhash FROM documents"):
+            self._index(doc_pk, to_unsigned(value))
+        logging.info(f"loaded {len(self._fingerprints)} document fingerprints from {path}")
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    @staticmethod
+    def _band_keys(fingerprint):
+        mask = (1 << BAND_BITS) - 1
+        return [(band, fingerprint >> (band * BAND_BITS) & mask) for band in range(BANDS)]
+
+    def _index(self, doc_pk, fingerprint):
+        old = self._fingerprints.get(doc_pk)
+        if old is not None:
+            for key in self._band_keys(old):
+                self._bands[key].discard(doc_pk)
+        self._fingerprints[doc_pk] = fingerprint
+        for key in self._band_keys(fingerprint):
+            self._bands.setdefault(key, set()).add(doc_pk)
+
+    def add(self, doc_pk, fingerprint, answer):
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO documents (doc_pk, simhash, answer, recorded_at) VALUES (?, ?, ?, ?)",
+                    (doc_pk, to_signed(fingerprint), answer, time.time()))
+            self._index(doc_pk, fingerprint)
+
+    def neighbours(self, fingerprint, max_distance, limit=MAX_NEIGHBOURS, exclude=None):
+        """Returns up to limit (distance, doc_pk, answer) of the closest documents at most max_distance bits away."""
+        with self._lock:
+            candidates = set()
+            for key in self._band_keys(fingerprint):
+                candidates.update(self._bands.get(key, ()))
+            candidates.discard(exclude)
+            closest = sorted((hamming(fingerprint, self._fingerprints[doc_pk]), doc_pk) for doc_pk in candidates)
+            closest = [(distance, doc_pk) for distance, doc_pk in closest[:limit] if distance <= max_distance]
+            return [(distance, doc_pk, self._answer(doc_pk)) for distance, doc_pk in closest]
+
+    def _answer(self, doc_pk):
+        row = self._conn.execute("SELECT answer FROM documents WHERE doc_pk = ?", (doc_pk,)).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_index = None
+_model = CASCADE_MODEL
+_max_distance = CASCADE_MAX_DISTANCE
+_min_neighbours = CASCADE_MIN_NEIGHBOURS
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def configure_cascade(path=CASCADE_INDEX_PATH, model=CASCADE_MODEL, max_distance=CASCADE_MAX_DISTANCE,
+                      min_neighbours=CASCADE_MIN_NEIGHBOURS):
+    """Opens the neighbour index at path (disabled when path is empty).
+
+    A document whose min_neighbours closest processed documents, all at most max_distance bits away, agree on
+    correspondent and document type gets their metadata, and only its title, date and summary are generated by
+    model. Without a model only the metadata is assigned, and title, date and summary are left as they are.
+    """
+    global _index, _model, _max_distance, _min_neighbours
+    if _index is not None:
+        _index.close()
+    _index = NeighbourIndex(path) if path else None
+    _model = model
+    _max_distance = min(max_distance, BANDS - 1)
+    _min_neighbours = max(min_neighbours, 1)
+
+
+def classify_from_neighbours(ctx, doc_info):
+    """Returns an answer built from similar processed documents, or None if the document needs the full model."""
+    if _index is None:
+        return None
+    doc_pk = doc_info["id"]
+    fingerprint = fingerprint_content(doc_info.get("content"))
+    if fingerprint is None:
+        return None
+    neighbours = _index.neighbours(fingerprint, _max_distance, exclude=doc_pk)
+    answers = [_parse(answer) for _, _, answer in neighbours]
+    answers = [answer for answer in answers if answer]
+    if len(answers) < _min_neighbours or len({_metadata_key(answer) for answer in answers}) > 1:
+        METRICS.inc("cascade_total", result="escalated")
+        return None
+
+    closest = answers[0]
+    logging.info(f"document {doc_pk} is similar to documents {[pk for _, pk, _ in neighbours]} "
+                 f"(distance {neighbours[0][0]}), reusing correspondent {closest['correspondent']}, "
+                 f"document type {closest['document_type']} and tags {closest['tags']}")
+    answer = {
+        "explanation": f"tags, correspondent and document type of similar documents {[pk for _, pk, _ in neighbours]}",
+        "tags": closest["tags"],
+        "correspondent": closest["correspondent"],
+        "document_type": closest["document_type"],
+    }
+    if not _model:
+        # title, date and summary describe the neighbour, so the document keeps its own
+        METRICS.inc("cascade_total", result="reused")
+        return json.dumps(dict(answer, metadata_only=True))
+
+    generated = generate_title(ctx, doc_info["content"], closest)
+    if not generated:
+        METRICS.inc("cascade_total", result="escalated")
+        return None
+    METRICS.inc("cascade_total", result="small_model")
+    return json.dumps(dict(answer, title=generated["title"], created_date=generated.get("created_date", ""),
+                           summary=generated["summary"]))
+
+
+def generate_title(ctx, content, known):
+    """Asks the small model for title, created_date and summary. Returns them as a dict, or None."""
+    # imported here, main imports this module
+    from main import lookup_cached_answer, query_openai
+    budget = content_budget(_model, count_tokens(TITLE_PROMPT, _model))
+    messages = [
+        {"role": "system", "content": TITLE_PROMPT},
+        {"role": "user", "content": f"Correspondent: {known['correspondent']}, document type: {known['document_type']}"},
+        {"role": "user", "content": select_content(content, _model, budget)},
+    ]
+    key = cache_key(_model, messages)
+    answer, skip = lookup_cached_answer(key)
+    if not skip:
+        try:
+            response = query_openai(_client(ctx), model=_model, messages=messages)
+            answer = response.choices[0].message.content
+        except Exception as e:
+            logging.error(f"{_model} could not generate a title, using {ctx.openai_model}: {e}")
+            return None
+    generated = _parse(answer, fields=("title", "summary"))
+    if generated and not skip:
+        store_answer(key, answer)
+    return generated
+
+
+def _client(ctx):
+    """A synchronous OpenAI client for the context's account, also when the context itself is async."""
+    with _clients_lock:
+        client = _clients.get((ctx.openai_key, ctx.openai_base_url))
+        if client is None:
+            from openai import OpenAI
+            client = _clients[(ctx.openai_key, ctx.openai_base_url)] = OpenAI(
+                api_key=ctx.openai_key, base_url=ctx.openai_base_url, max_retries=0)
+        return client
+
+
+def _parse(answer, fields=("title", "summary", "correspondent", "document_type", "tags")):
+    try:
+        data = json.loads(answer)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(data, dict) or not all(data.get(field) for field in fields):
+        return None
+    return data
+
+
+def _metadata_key(answer):
+    return str(answer["correspondent"]).casefold(), str(answer["document_type"]).casefold()
+
+
+def record_processed(doc_info, answer):
+    """Adds a processed document and its answer to the neighbour index."""
+    if _index is None:
+        return
+    fingerprint = fingerprint_content(doc_info.get("content"))
+    if fingerprint is not None and _parse(answer):
+        _index.add(doc_info["id"], fingerprint, answer)
@@ -36,11 +36,11 @@ The current date is always going to be the first date in the context. The rest o
 {
   "title": "A valid title with capitalized nouns.",
   "created_date": "YYYY-MM-DD",
-  "explanation": "Why the title, date, tags, document_type, summary, and correspondent were chosen.",
   "tags": [],
   "correspondent": "",
   "document_type": "",
-  "summary": ""
+  "summary": "",
+  "explanation": "Why the title, date, tags, document_type, summary, and correspondent were chosen."
 }
 """
 
@@ -53,3 +53,82 @@ PAPERLESS_API_KEY = os.getenv("PAPERLESS_API_KEY")
 OPENAI_BASEURL = os.getenv("OPENAI_BASEURL")
 TIMEOUT = 10
 OWNER_NAME = os.getenv("OWNER_NAME", None)
+DEFAULT_PAGE_SIZE = int(os.getenv("PAGE_SIZE", "100"))
+# seconds before cached tags, correspondents, document types and custom fields are reloaded, 0 never reloads
+METADATA_CACHE_TTL = int(os.getenv("METADATA_CACHE_TTL", "600"))
+# similarity (0-1) above which a new tag, correspondent or document type name is mapped onto an existing one,
+# 0 (the default) disables it: distinct names such as "Deutsche Bank" and "Deutsche Bahn" score close to 0.8
+FUZZY_MATCH_THRESHOLD = float(os.getenv("FUZZY_MATCH_THRESHOLD", "0"))
+# sqlite file caching OpenAI answers by content, model and prompt, unset disables the cache
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH")
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", "256"))
+# sqlite file of processed documents' content fingerprints and answers. When set, a document whose closest
+# similar documents agree on correspondent and document type reuses their metadata, unset disables the cascade
+CASCADE_INDEX_PATH = os.getenv("CASCADE_INDEX_PATH")
+# model asked only for title, date and summary of such a document, empty keeps the document's own
+CASCADE_MODEL = os.getenv("CASCADE_MODEL", "gpt-4o-mini")
+# differing bits (0-7 of 64) up to which a processed document counts as similar, and how many must agree
+CASCADE_MAX_DISTANCE = int(os.getenv("CASCADE_MAX_DISTANCE", "6"))
+CASCADE_MIN_NEIGHBOURS = int(os.getenv("CASCADE_MIN_NEIGHBOURS", "2"))
+# sqlite file of processed documents' MinHash signatures and answers. A new document at least DUPLICATE_THRESHOLD
+# similar (0-1) to one of them reuses its answer, unset disables duplicate detection
+DUPLICATE_INDEX_PATH = os.getenv("DUPLICATE_INDEX_PATH")
+DUPLICATE_THRESHOLD = float(os.getenv("DUPLICATE_THRESHOLD", "0.8"))
+# tag added to detected duplicates, empty adds none
+DUPLICATE_TAG = os.getenv("DUPLICATE_TAG", "")
+# documents per bulk_edit request when tags, correspondents and document types are written in bulk
+BULK_EDIT_BATCH_SIZE = int(os.getenv("BULK_EDIT_BATCH_SIZE", "500"))
+# size of the connection pool used for Paperless in async mode
+PAPERLESS_MAX_CONNECTIONS = int(os.getenv("PAPERLESS_MAX_CONNECTIONS", "20"))
+
+# when set, the post-consume script only queues the document here and worker.py processes it
+WORKER_QUEUE_PATH = os.getenv("WORKER_QUEUE_PATH")
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "4"))
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "1"))
+WORKER_MAX_ATTEMPTS = int(os.getenv("WORKER_MAX_ATTEMPTS", "3"))
+# "openai" sends one request per document. "local" batches concurrently processed documents into simultaneous
+# requests to a local OpenAI compatible server (llama.cpp, vLLM) at OPENAI_BASEURL, "fake" answers without a model
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+# documents per batch and batches running at once, 0 uses the backend's default
+LLM_BATCH_SIZE = int(os.getenv("LLM_BATCH_SIZE", "0"))
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "0"))
+# milliseconds a batch waits for more documents before it is sent
+LLM_BATCH_WAIT_MS = float(os.getenv("LLM_BATCH_WAIT_MS", "20"))
+# port of the Prometheus /metrics endpoint served by worker.py, 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# local checkpoint of OpenAI Batch API jobs submitted by cli batch
+BATCH_STATE_PATH = os.getenv("BATCH_STATE_PATH", "batch_state.sqlite")
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "10000"))
+
+# local record of documents processed by cli all, used by --resume and --since-last-run
+RUN_STATE_PATH = os.getenv("RUN_STATE_PATH", "run_state.sqlite")
+
+# maximum tokens of document content sent to OpenAI, capped by the model's context window
+CONTENT_TOKEN_BUDGET = int(os.getenv("CONTENT_TOKEN_BUDGET", "4000"))
+
+# stream answers and validate each field as it arrives, aborting and retrying malformed answers early
+STREAM_ANSWERS = os.getenv("STREAM_ANSWERS", "false").lower() in ("y", "yes", "on", "1", "true", "t")
+# completion tokens of a streamed answer, 0 derives the limit from the response format
+ANSWER_MAX_TOKENS = int(os.getenv("ANSWER_MAX_TOKENS", "0"))
+# requests per document before a malformed answer is given up
+ANSWER_MAX_ATTEMPTS = int(os.getenv("ANSWER_MAX_ATTEMPTS", "2"))
+
+# cli all --pack combines up to PACK_MAX_DOCUMENTS documents of at most PACK_MAX_DOCUMENT_TOKENS tokens into one request
+PACK_MAX_DOCUMENTS = int(os.getenv("PACK_MAX_DOCUMENTS", "8"))
+PACK_MAX_DOCUMENT_TOKENS = int(os.getenv("PACK_MAX_DOCUMENT_TOKENS", "500"))
+
+# retries with exponential backoff for transient Paperless and OpenAI errors
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "4"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "1"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "60"))
+# consecutive failures after which calls to an endpoint pause for BREAKER_COOLDOWN seconds, 0 disables
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+
+# concurrency and rate limits, 0 disables the limit
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "0"))
+OPENAI_RPS = float(os.getenv("OPENAI_RPS", "0"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "0"))
+PAPERLESS_MAX_CONCURRENCY = int(os.getenv("PAPERLESS_MAX_CONCURRENCY", "0"))
+PAPERLESS_RPS = float(os.getenv("PAPERLESS_RPS", "0"))
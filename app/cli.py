@@ -1,33 +1,127 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
 import logging
 import requests
 import sys
+import time
+from collections import deque
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
 
-from main import set_auth_tokens, make_request, process_single_document, get_single_document
-from cfg import PAPERLESS_URL, PAPERLESS_API_KEY, OPENAI_API_KEY, OPENAPI_MODEL, OPENAI_BASEURL
+from main import set_auth_tokens, make_request, process_single_document, get_single_document, ProcessingContext
+from helpers import ListingError
+from cfg import (PAPERLESS_URL, PAPERLESS_API_KEY, OPENAI_API_KEY, OPENAPI_MODEL, OPENAI_BASEURL, OWNER_NAME,
+                 OPENAI_MAX_CONCURRENCY, OPENAI_RPS, OPENAI_TPM, PAPERLESS_MAX_CONCURRENCY, PAPERLESS_RPS,
+                 DEFAULT_PAGE_SIZE, RESULT_CACHE_PATH, RESULT_CACHE_MAX_MB, BULK_EDIT_BATCH_SIZE,
+                 BATCH_STATE_PATH, RUN_STATE_PATH, PACK_MAX_DOCUMENTS, CASCADE_INDEX_PATH, CASCADE_MODEL,
+                 DUPLICATE_INDEX_PATH, DUPLICATE_TAG)
+from pool import run_bounded, thread_session, ThreadContexts
+from ratelimit import configure_limits
+from result_cache import configure_result_cache
+from cascade import configure_cascade
+from duplicates import configure_duplicates
+from bulk_edit import BulkCommitter
+from run_state import RunState, content_hash
+from packing import pack_documents, process_documents
+from usage import USAGE
+from resilience import log_retry_summary
+from metrics import log_json_summary
 
 
-def get_all_documents(sess, paperless_url, advanced_filter=None):
+def fetch_document_page(sess, url, params=None):
+    """Returns one page of a document listing. Raises ListingError if it could not be retrieved."""
+    response = make_request(sess, url, "GET", params=params)
+    if not response or not isinstance(response, dict):
+        raise ListingError(f"could not retrieve documents from {url}")
+    return response
+
+
+# fields requested when listing documents before deciding which ones to fetch with their content
+LIST_FIELDS = "id,modified"
+
+
+def iter_documents(sess, paperless_url, advanced_filter=None, page_size=DEFAULT_PAGE_SIZE, prefetch=False, fields=None):
+    """Yields documents page by page, so only about one page (two when prefetching) is held in memory.
+
+    With prefetch enabled the next page is requested in the background, on a copy of sess, while the current one
+    is consumed. fields limits the returned fields to a comma separated list. Raises ListingError when a page could not be
+    retrieved, instead of ending early as if the listing was complete.
+    """
     url = paperless_url + "/api/documents/"
     if advanced_filter:
         url += f"?{advanced_filter}"
-    response = make_request(sess, url, "GET")
-    if not response or not isinstance(response, dict):
-        logging.error("could not retrieve documents")
-        return []
+    params = {"page_size": page_size}
+    if fields:
+        params["fields"] = fields
+    response = fetch_document_page(sess, url, params=params)
+    logging.info(f"found {response.get('count', 'unknown number of')} documents")
+
+    def prefetch_page(next_url):
+        return fetch_document_page(thread_session(sess), next_url)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        while True:
+            next_url = response.get("next")
+            next_page = None
+            if next_url and prefetch:
+                next_page = executor.submit(prefetch_page, next_url)
+            yield from response.pop("results", [])
+            if not next_url:
+                return
+            response = next_page.result() if next_page else fetch_document_page(sess, next_url)
+
+
+def get_all_documents(sess, paperless_url, advanced_filter=None):
+    return list(iter_documents(sess, paperless_url, advanced_filter))
+
+
+def fetch_documents(sess, paperless_url, ids):
+    """Fetches the complete documents with the given IDs with a single request. Raises ListingError on errors."""
+    params = {"id__in": ",".join(str(doc_pk) for doc_pk in ids), "page_size": len(ids)}
+    response = fetch_document_page(sess, paperless_url + "/api/documents/", params=params)
+    return response.get("results", [])
 
-    documents = response.get("results", [])
 
-    while response["next"]:
-        response = make_request(sess, response["next"], "GET")
-        if not response or not isinstance(response, dict):
-            logging.error("could not retrieve documents")
-            return []
+def iter_id_batches(documents, batch_size):
+    batch = []
+    for doc in documents:
+        batch.append(doc["id"])
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-        documents.extend(response.get("results", []))
 
-    return documents
+def iter_with_content(sess, paperless_url, listed, batch_size, concurrency):
+    """Fetches the complete documents, content included, for documents listed without it.
+
+    Documents are requested batch_size at a time with up to concurrency requests in flight, and yielded in
+    listing order. Every fetching thread uses its own copy of sess, which the listing keeps using meanwhile.
+    """
+    def fetch(ids):
+        return fetch_documents(thread_session(sess), paperless_url, ids)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        for ids in iter_id_batches(listed, batch_size):
+            pending.append(executor.submit(fetch, ids))
+            if len(pending) >= concurrency:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def new_session(args):
+    sess = requests.Session()
+    set_auth_tokens(sess, args.paperlesskey)
+    return sess
+
+
+def build_context(sess, args, bulk_committer=None):
+    return ProcessingContext(sess, args.paperlessurl, args.openaimodel, args.openaikey, args.openaibaseurl,
+                             username=OWNER_NAME, dry_run=args.dry, bulk_committer=bulk_committer)
 
 
 def run_single_document(args):
@@ -41,41 +135,248 @@ def run_single_document(args):
             logging.error(f"could not retrieve document info for document {args.document_id}")
             return
 
-        doc_contents = doc_info["content"]
-        doc_title = doc_info["title"]
+        ctx = build_context(sess, args)
+        try:
+            process_single_document(ctx, doc_info)
+        finally:
+            ctx.close()
+
+
+def document_filter(args, state):
+    """Returns the document query string, limited to documents modified since the last finished run if requested."""
+    filters = [args.filterstr] if args.filterstr else []
+    if args.sincelastrun:
+        since = state.last_finished_run_start()
+        if since:
+            logging.info(f"only including documents modified since the last run started at {since}")
+            filters.append(urlencode({"modified__gt": since}))
+        else:
+            logging.info("no finished run recorded, including all documents")
+    return "&".join(filters) or None
+
+
+def failed_document_filters(args, failed_ids):
+    """Query strings listing the given documents that failed in an earlier run, a page at a time.
+
+    --since-last-run only lists documents modified since the last finished run, which would never retry a
+    failed document that was not modified since. The user's filter still applies.
+    """
+    filters = [args.filterstr] if args.filterstr else []
+    failed_ids = sorted(failed_ids)
+    for start in range(0, len(failed_ids), args.pagesize):
+        ids = ",".join(str(doc_pk) for doc_pk in failed_ids[start:start + args.pagesize])
+        yield "&".join(filters + [urlencode({"id__in": ids})])
+
+
+def iter_listed_documents(sess, args, state, advanced_filter):
+    """Lists the documents matching advanced_filter with LIST_FIELDS, plus failed ones with --since-last-run."""
+    failed = set(state.failed_ids()) if args.sincelastrun else set()
+    for doc in iter_documents(sess, args.paperlessurl, advanced_filter, args.pagesize, args.prefetch, LIST_FIELDS):
+        failed.discard(doc["id"])
+        yield doc
+    for failed_filter in failed_document_filters(args, failed):
+        yield from iter_documents(sess, args.paperlessurl, failed_filter, args.pagesize, fields=LIST_FIELDS)
+
+
+def lists_without_content(args):
+    """Whether documents are first listed without their content, because exclusions or resume will drop some."""
+    return bool(args.exclude or args.resume or args.sincelastrun)
 
-        process_single_document(sess, args.document_id, doc_title, doc_contents, args.paperlessurl,
-                                args.openaimodel, args.openaikey, args.openaibaseurl, args.dry)
+
+def skip_listed_document(args, state, doc):
+    """Decides on a document listed with LIST_FIELDS only, before its content is fetched."""
+    if args.exclude and doc["id"] in args.exclude:
+        logging.info(f"skipping document {doc['id']}")
+        return True
+    if (args.resume or args.sincelastrun) and state.is_done_since(doc["id"], doc.get("modified")):
+        logging.debug(f"skipping document {doc['id']}, already processed and not modified since")
+        return True
+    return False
+
+
+def iter_included_documents(sess, args, state):
+    """Yields the documents to process, content included.
+
+    When exclusions or resume apply, documents are listed with LIST_FIELDS only and the content is fetched
+    just for those not skipped, instead of downloading the content of every document.
+    """
+    advanced_filter = document_filter(args, state)
+    if lists_without_content(args):
+        listed = iter_listed_documents(sess, args, state, advanced_filter)
+        selected = (doc for doc in listed if not skip_listed_document(args, state, doc))
+        documents = iter_with_content(sess, args.paperlessurl, selected, args.pagesize, args.fetchconcurrency)
+    else:
+        documents = iter_documents(sess, args.paperlessurl, advanced_filter, args.pagesize, args.prefetch)
+    return (doc for doc in documents if not skip_document(args, state, doc))
+
+
+def skip_document(args, state, doc):
+    if args.exclude and doc["id"] in args.exclude:
+        logging.info(f"skipping document {doc['id']}")
+        return True
+    if (args.resume or args.sincelastrun) and state.is_done(doc["id"], content_hash(doc["content"])):
+        logging.debug(f"skipping document {doc['id']}, already processed with unchanged content")
+        return True
+    return False
+
+
+def record_document(args, state, doc, processed):
+    # a dry run changes nothing, so it must not mark documents as done
+    if not args.dry:
+        state.record(doc["id"], content_hash(doc["content"]), processed)
 
 
 def run_all_documents(args):
     if args.dry:
         logging.info("Running in dryrun mode")
 
-    logging.info("Running on all documents")
+    state = RunState(args.runstatepath)
+    # a dry run changes nothing, so --since-last-run must not start after it
+    run_id = None if args.dry else state.start_run()
+    try:
+        if args.useasync:
+            asyncio.run(run_all_documents_async(args, state))
+        else:
+            run_all_documents_threaded(args, state)
+        if run_id:
+            state.finish_run(run_id)
+    except ListingError as e:
+        logging.error(f"{e}, stopping the run")
+    finally:
+        state.close()
+
+
+def run_all_documents_threaded(args, state):
+    logging.info(f"Running on all documents with {args.workers} worker(s)")
+
+    def record(doc, processed):
+        if args.dry or not bulk_committer:
+            record_document(args, state, doc, processed)
+            return
+        # only done once the bulk_edit requests with its tags, correspondent and document type succeeded
+        doc_pk, doc_hash = doc["id"], content_hash(doc["content"])
+        bulk_committer.when_written(doc_pk, lambda written: state.record(doc_pk, doc_hash, processed and written))
+
+    def run_document(doc):
+        doc_id = doc["id"]
+        logging.info(f"running for document {doc_id}")
+        record(doc, process_single_document(contexts.get(), doc))
+        logging.info(f"finished running for document {doc_id}")
+
+    def run_pack(docs):
+        results = process_documents(contexts.get(), docs)
+        for doc in docs:
+            record(doc, results[doc["id"]])
+
     with requests.Session() as sess:
         set_auth_tokens(sess, args.paperlesskey)
+        bulk_committer = BulkCommitter(args.paperlessurl, args.bulkbatchsize) if args.bulkedit else None
+        ctx = build_context(sess, args, bulk_committer)
+        contexts = ThreadContexts(ctx, lambda: new_session(args))
+        included = iter_included_documents(sess, args, state)
+        try:
+            if args.pack:
+                run_bounded(pack_documents(included, args.openaimodel, args.packmaxdocs), run_pack, args.workers)
+            else:
+                run_bounded(included, run_document, args.workers)
+        finally:
+            try:
+                # also when the run stops early, the documents already processed are waiting for these
+                if bulk_committer:
+                    bulk_committer.flush(sess)
+            finally:
+                contexts.close()
+                ctx.close()
 
-        all_docs = get_all_documents(sess, args.paperlessurl, args.filterstr)
-        if not all_docs or not isinstance(all_docs, list):
-            logging.error("could not retrieve documents")
-            return
 
-        logging.info(f"found {len(all_docs)} documents")
+async def run_all_documents_async(args, state):
+    # imported here so the threaded mode does not need httpx's async stack
+    from async_processing import (create_async_context, close_async_context, iter_documents_async,
+                                  iter_with_content_async, run_documents_async)
+
+    if args.pack:
+        logging.warning("--pack is not supported in async mode, sending one request per document")
+    if args.bulkedit:
+        logging.warning("--bulkedit is not supported in async mode, writing each document with its own PATCH")
+    logging.info(f"Running on all documents asynchronously with up to {args.workers} documents in flight")
+    ctx = await create_async_context(args.paperlessurl, args.paperlesskey, args.openaimodel, args.openaikey,
+                                     args.openaibaseurl, username=OWNER_NAME, dry_run=args.dry)
+    try:
+        async def selected(docs):
+            async for doc in docs:
+                if not skip_listed_document(args, state, doc):
+                    yield doc
+
+        async def listed_documents(advanced_filter):
+            failed = set(state.failed_ids()) if args.sincelastrun else set()
+            async for doc in iter_documents_async(ctx.sess, args.paperlessurl, advanced_filter, args.pagesize,
+                                                  LIST_FIELDS):
+                failed.discard(doc["id"])
+                yield doc
+            for failed_filter in failed_document_filters(args, failed):
+                async for doc in iter_documents_async(ctx.sess, args.paperlessurl, failed_filter, args.pagesize,
+                                                      LIST_FIELDS):
+                    yield doc
+
+        advanced_filter = document_filter(args, state)
+        if lists_without_content(args):
+            listed = listed_documents(advanced_filter)
+            all_docs = iter_with_content_async(ctx.sess, args.paperlessurl, selected(listed), args.pagesize,
+                                               args.fetchconcurrency)
+        else:
+            all_docs = iter_documents_async(ctx.sess, args.paperlessurl, advanced_filter, args.pagesize)
+
+        async def included(docs):
+            async for doc in docs:
+                if not skip_document(args, state, doc):
+                    yield doc
 
-        for doc in all_docs:
-            doc_id = doc["id"]
-            doc_title = doc["title"]
-            doc_content = doc["content"]
+        await run_documents_async(ctx, included(all_docs), args.workers,
+                                  on_done=lambda doc, processed: record_document(args, state, doc, processed))
+    finally:
+        await close_async_context(ctx)
 
-            if args.exclude and doc_id in args.exclude:
-                logging.info(f"skipping document {doc_id}")
-                continue
 
-            logging.info(f"running for document {doc_id}")
-            process_single_document(sess, doc_id, doc_title, doc_content, args.paperlessurl,
-                                    args.openaimodel, args.openaikey, args.openaibaseurl, args.dry)
-            logging.info(f"finished running for document {doc_id}")
+def run_batch(args):
+    # imported here so the other commands do not depend on the batch state
+    from batch import BatchState, apply_batch_result, iter_batch_results, refresh_batches, submit_batches
+
+    state = BatchState(args.statepath)
+    openai_sess = requests.Session()
+    openai_sess.headers.update({"Authorization": f"Bearer {args.openaikey}"})
+    ctx = None
+    try:
+        with requests.Session() as sess:
+            set_auth_tokens(sess, args.paperlesskey)
+            ctx = build_context(sess, args)
+            if args.action == "submit":
+                docs = iter_documents(sess, args.paperlessurl, args.filterstr, args.pagesize)
+                included = (doc for doc in docs if not args.exclude or doc["id"] not in args.exclude)
+                try:
+                    submit_batches(ctx, state, included, openai_sess)
+                except ListingError as e:
+                    logging.error(f"{e}, stopping the submission")
+                return
+
+            running = refresh_batches(state, openai_sess, args.openaibaseurl)
+            while args.wait and running:
+                logging.info(f"{running} batches still running, checking again in {args.pollinterval}s")
+                time.sleep(args.pollinterval)
+                running = refresh_batches(state, openai_sess, args.openaibaseurl)
+
+            if args.action == "apply":
+                contexts = ThreadContexts(ctx, lambda: new_session(args))
+                try:
+                    run_bounded(iter_batch_results(state, openai_sess, args.openaibaseurl),
+                                lambda result: apply_batch_result(contexts.get(), state, *result), args.workers)
+                finally:
+                    contexts.close()
+            logging.info(f"batch requests by status: {state.counts()}")
+    finally:
+        if ctx:
+            ctx.close()
+        openai_sess.close()
+        state.close()
 
 
 def parse_args(args):
@@ -91,13 +392,81 @@ def parse_args(args):
     parser.add_argument('--openaikey', type=str, default=OPENAI_API_KEY, help="OpenAI key to use")
     parser.add_argument('--openaibaseurl', type=str, default=OPENAI_BASEURL,
                         help="Endpoint for OpenAI compatible API to use when generating titles")
+    parser.add_argument('--openaiconcurrency', type=int, default=OPENAI_MAX_CONCURRENCY,
+                        help="Maximum number of concurrent OpenAI requests (0 for no limit)")
+    parser.add_argument('--openairps', type=float, default=OPENAI_RPS,
+                        help="Maximum OpenAI requests per second (0 for no limit)")
+    parser.add_argument('--openaitpm', type=int, default=OPENAI_TPM,
+                        help="Maximum OpenAI tokens per minute (0 for no limit)")
+    parser.add_argument('--paperlessconcurrency', type=int, default=PAPERLESS_MAX_CONCURRENCY,
+                        help="Maximum number of concurrent Paperless requests (0 for no limit)")
+    parser.add_argument('--paperlessrps', type=float, default=PAPERLESS_RPS,
+                        help="Maximum Paperless requests per second (0 for no limit)")
+    parser.add_argument('--cachepath', type=str, default=RESULT_CACHE_PATH,
+                        help="SQLite file used to cache OpenAI answers between runs")
+    parser.add_argument('--cachemaxmb', type=int, default=RESULT_CACHE_MAX_MB,
+                        help="Maximum size of cached answers in MB before the least recently used are evicted")
+    parser.add_argument('--cascadepath', type=str, default=CASCADE_INDEX_PATH,
+                        help="SQLite file of processed documents whose metadata similar new documents reuse")
+    parser.add_argument('--cascademodel', type=str, default=CASCADE_MODEL,
+                        help="Small model generating only title, date and summary of such documents "
+                             "(empty keeps their own title, date and summary)")
+    parser.add_argument('--duplicatepath', type=str, default=DUPLICATE_INDEX_PATH,
+                        help="SQLite file of processed documents whose answer near duplicates reuse")
+    parser.add_argument('--duplicatetag', type=str, default=DUPLICATE_TAG,
+                        help="Tag added to detected near duplicates")
+    parser.add_argument('--metricsfile', type=str,
+                        help="Write request latencies, counts and token usage of the run as JSON to this file")
+    cache_mode = parser.add_mutually_exclusive_group()
+    cache_mode.add_argument('--cache-only', dest='cacheonly', action='store_true',
+                            help="Only use cached answers and never call OpenAI")
+    cache_mode.add_argument('--refresh', action='store_true',
+                            help="Ignore cached answers and replace them with fresh ones")
     subparsers = parser.add_subparsers()
 
     parser_all = subparsers.add_parser("all", description="Run on all documents")
     parser_all.add_argument('--exclude', action='append', type=int, help="Document ID to skip")
     parser_all.add_argument('--filterstr', type=str, help='Pass in url query parameters to filter document filter request by')
+    parser_all.add_argument('--workers', type=int, default=1, help="Number of documents to process concurrently")
+    parser_all.add_argument('--pagesize', type=int, default=DEFAULT_PAGE_SIZE,
+                            help="Number of documents requested per page")
+    parser_all.add_argument('--prefetch', action='store_true',
+                            help="Fetch the next page of documents while the current one is processed")
+    parser_all.add_argument('--fetchconcurrency', type=int, default=4,
+                            help="Pages of document content fetched concurrently when documents are first listed "
+                                 "without content (with --exclude, --resume or --since-last-run)")
+    parser_all.add_argument('--runstatepath', type=str, default=RUN_STATE_PATH,
+                            help="SQLite file recording processed documents and finished runs")
+    parser_all.add_argument('--resume', action='store_true',
+                            help="Skip documents already processed in an earlier run whose content has not changed")
+    parser_all.add_argument('--since-last-run', dest='sincelastrun', action='store_true',
+                            help="Only request documents modified since the last finished run, implies --resume")
+    parser_all.add_argument('--pack', action='store_true',
+                            help="Send several short documents in one OpenAI request")
+    parser_all.add_argument('--packmaxdocs', type=int, default=PACK_MAX_DOCUMENTS,
+                            help="Maximum number of short documents per packed request")
+    parser_all.add_argument('--async', dest='useasync', action='store_true',
+                            help="Process documents with asyncio instead of threads, --workers sets the documents in flight")
+    parser_all.add_argument('--bulkedit', action='store_true',
+                            help="Assign tags, correspondents and document types with grouped bulk_edit requests")
+    parser_all.add_argument('--bulkbatchsize', type=int, default=BULK_EDIT_BATCH_SIZE,
+                            help="Maximum number of documents per bulk_edit request")
     parser_all.set_defaults(func=run_all_documents)
 
+    parser_batch = subparsers.add_parser("batch", description="Process documents offline with the OpenAI Batch API")
+    parser_batch.add_argument('action', choices=['submit', 'status', 'apply'],
+                              help="submit new batches, show their status, or apply the results of finished batches")
+    parser_batch.add_argument('--statepath', type=str, default=BATCH_STATE_PATH,
+                              help="SQLite file checkpointing submitted batches and applied documents")
+    parser_batch.add_argument('--wait', action='store_true', help="Wait until all submitted batches have finished")
+    parser_batch.add_argument('--pollinterval', type=int, default=60, help="Seconds between batch status checks")
+    parser_batch.add_argument('--exclude', action='append', type=int, help="Document ID to skip")
+    parser_batch.add_argument('--filterstr', type=str, help='Pass in url query parameters to filter document filter request by')
+    parser_batch.add_argument('--pagesize', type=int, default=DEFAULT_PAGE_SIZE,
+                              help="Number of documents requested per page")
+    parser_batch.add_argument('--workers', type=int, default=1, help="Number of results to apply concurrently")
+    parser_batch.set_defaults(func=run_batch)
+
     parser_single = subparsers.add_parser("single", description="Run on a single document")
     parser_single.add_argument('document_id', type=int)
     parser_single.set_defaults(func=run_single_document)
@@ -108,10 +477,19 @@ def parse_args(args):
                         datefmt='%m/%d/%Y %I:%M:%S %p',
                         level=parsed_args.loglevel)
 
-    try:
-        parsed_args.func(parsed_args)
-    except AttributeError:
+    configure_limits(parsed_args.paperlessconcurrency, parsed_args.paperlessrps,
+                     parsed_args.openaiconcurrency, parsed_args.openairps, parsed_args.openaitpm)
+    configure_result_cache(parsed_args.cachepath, parsed_args.cachemaxmb, parsed_args.cacheonly, parsed_args.refresh)
+    configure_cascade(parsed_args.cascadepath, parsed_args.cascademodel)
+    configure_duplicates(parsed_args.duplicatepath, tag=parsed_args.duplicatetag)
+
+    if not hasattr(parsed_args, "func"):
         parser.print_help()
+        return
+    parsed_args.func(parsed_args)
+    USAGE.log_summary()
+    log_retry_summary()
+    log_json_summary(parsed_args.metricsfile)
 
 
 if __name__ == '__main__':
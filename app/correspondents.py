@@ -1,9 +1,17 @@
 import logging
 from urllib.parse import quote
 from helpers import make_request
+from metadata_cache import CORRESPONDENT_CACHE
+from resilience import create_after_recheck, create_after_recheck_async
 
 def get_existing_correspondent(sess, correspondent_name, paperless_url):
     """Checks if a correspondent with the exact name already exists."""
+    if CORRESPONDENT_CACHE.load(sess, paperless_url):
+        correspondent_id = CORRESPONDENT_CACHE.match(correspondent_name)
+        if correspondent_id:
+            logging.info(f"correspondent {correspondent_name} already exists with id {correspondent_id}")
+        return correspondent_id
+
     encoded_name = quote(correspondent_name)
     url = paperless_url + f"/api/correspondents/?name__iexact={encoded_name}"
     response = make_request(sess, url, "GET")
@@ -25,15 +33,24 @@ def create_new_correspondent(sess, correspondent_name, paperless_url, owner_id):
         "owner": owner_id_or_empty
     }
 
-    response = make_request(sess, url, "POST", body=body)
+    response = make_request(sess, url, "POST", body=body, raise_rejected=True)
     if not response:
         logging.error(f"could not create correspondent {correspondent_name}")
+        CORRESPONDENT_CACHE.invalidate()
         return None
     logging.info(f"created new correspondent: {correspondent_name}")
+    CORRESPONDENT_CACHE.add(correspondent_name, response['id'])
     return response['id']
 
 def get_or_create_correspondent(sess, correspondent_name, paperless_url, owner_id=None):
-    """Checks if a correspondent exists; if not, creates it and returns the correspondent ID."""
+    """Checks if a correspondent exists; if not, creates it and returns the correspondent ID.
+
+    Concurrent calls for the same name share a single lookup and create.
+    """
+    return CORRESPONDENT_CACHE.single_flight(
+        correspondent_name, lambda: resolve_correspondent(sess, correspondent_name, paperless_url, owner_id))
+
+def resolve_correspondent(sess, correspondent_name, paperless_url, owner_id):
     # Check if correspondent exists by name
     correspondent_id = get_existing_correspondent(sess, correspondent_name, paperless_url)
     
@@ -41,9 +58,62 @@ def get_or_create_correspondent(sess, correspondent_name, paperless_url, owner_i
         return correspondent_id
     else:
         # Create a new correspondent if it does not exist
-        new_correspondent_id = create_new_correspondent(sess, correspondent_name, paperless_url, owner_id)
+        new_correspondent_id = create_after_recheck(
+            lambda: create_new_correspondent(sess, correspondent_name, paperless_url, owner_id),
+            lambda: get_existing_correspondent(sess, correspondent_name, paperless_url))
         if new_correspondent_id:
             return new_correspondent_id
         else:
             logging.error(f"could not create or find correspondent {correspondent_name}")
-            return None
\ No newline at end of file
+            return None
+
+async def get_existing_correspondent_async(client, correspondent_name, paperless_url):
+    """Async version of get_existing_correspondent using an AsyncPaperlessClient."""
+    if await CORRESPONDENT_CACHE.load_async(client, paperless_url):
+        correspondent_id = CORRESPONDENT_CACHE.match(correspondent_name)
+        if correspondent_id:
+            logging.info(f"correspondent {correspondent_name} already exists with id {correspondent_id}")
+        return correspondent_id
+
+    url = paperless_url + "/api/correspondents/"
+    response = await client.request(url, "GET", params={"name__iexact": correspondent_name})
+    if not response:
+        logging.error(f"could not retrieve correspondent {correspondent_name}")
+        return None
+    if len(response['results']) > 0:
+        correspondent = response['results'][0]
+        logging.info(f"correspondent {correspondent_name} already exists with id {correspondent['id']}")
+        return correspondent['id']
+    return None
+
+async def create_new_correspondent_async(client, correspondent_name, paperless_url, owner_id):
+    """Async version of create_new_correspondent using an AsyncPaperlessClient."""
+    url = paperless_url + "/api/correspondents/"
+    body = {
+        "name": correspondent_name,
+        "owner": owner_id or ''
+    }
+    response = await client.request(url, "POST", body=body, raise_rejected=True)
+    if not response:
+        logging.error(f"could not create correspondent {correspondent_name}")
+        CORRESPONDENT_CACHE.invalidate()
+        return None
+    logging.info(f"created new correspondent: {correspondent_name}")
+    CORRESPONDENT_CACHE.add(correspondent_name, response['id'])
+    return response['id']
+
+async def get_or_create_correspondent_async(client, correspondent_name, paperless_url, owner_id=None):
+    """Async version of get_or_create_correspondent."""
+    return await CORRESPONDENT_CACHE.single_flight_async(
+        correspondent_name, lambda: resolve_correspondent_async(client, correspondent_name, paperless_url, owner_id))
+
+async def resolve_correspondent_async(client, correspondent_name, paperless_url, owner_id):
+    correspondent_id = await get_existing_correspondent_async(client, correspondent_name, paperless_url)
+    if correspondent_id:
+        return correspondent_id
+    new_correspondent_id = await create_after_recheck_async(
+        lambda: create_new_correspondent_async(client, correspondent_name, paperless_url, owner_id),
+        lambda: get_existing_correspondent_async(client, correspondent_name, paperless_url))
+    if not new_correspondent_id:
+        logging.error(f"could not create or find correspondent {correspondent_name}")
+    return new_correspondent_id
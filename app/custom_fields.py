@@ -1,5 +1,7 @@
 import logging
 from helpers import make_request
+from metadata_cache import CUSTOM_FIELD_CACHE
+from resilience import create_after_recheck, create_after_recheck_async
 
 def get_custom_fields(sess, paperless_url):
     """Retrieves all existing custom fields from Paperless."""
@@ -18,24 +20,88 @@ def create_custom_field(sess, field_name, paperless_url):
         "data_type": "string",
         "extra_data": 'null'
     }
-    response = make_request(sess, url, "POST", body=body)
+    response = make_request(sess, url, "POST", body=body, raise_rejected=True)
     if not response:
         logging.error(f"could not create custom field {field_name}")
+        CUSTOM_FIELD_CACHE.invalidate()
         return None
     logging.info(f"created new custom field: {field_name}")
+    CUSTOM_FIELD_CACHE.add(field_name, response['id'])
     return response['id']
 
+def get_existing_custom_field(sess, field_name, paperless_url):
+    """Returns the ID of the custom field with this name, or None."""
+    if CUSTOM_FIELD_CACHE.load(sess, paperless_url):
+        return CUSTOM_FIELD_CACHE.get(field_name)
+    return get_custom_fields(sess, paperless_url).get(field_name)
+
 def get_or_create_custom_field(sess, field_name, paperless_url):
-    """Checks if a custom field exists; if not, creates it and returns its ID."""
-    custom_fields = get_custom_fields(sess, paperless_url)
-    
-    if field_name in custom_fields:
-        logging.info(f"custom field {field_name} already exists with id {custom_fields[field_name]}")
-        return custom_fields[field_name]
+    """Checks if a custom field exists; if not, creates it and returns its ID.
+
+    Concurrent calls for the same name share a single lookup and create.
+    """
+    return CUSTOM_FIELD_CACHE.single_flight(field_name, lambda: resolve_custom_field(sess, field_name, paperless_url))
+
+def resolve_custom_field(sess, field_name, paperless_url):
+    field_id = get_existing_custom_field(sess, field_name, paperless_url)
+
+    if field_id:
+        logging.info(f"custom field {field_name} already exists with id {field_id}")
+        return field_id
     else:
-        new_field_id = create_custom_field(sess, field_name, paperless_url)
+        new_field_id = create_after_recheck(lambda: create_custom_field(sess, field_name, paperless_url),
+                                            lambda: get_existing_custom_field(sess, field_name, paperless_url))
         if new_field_id:
             return new_field_id
         else:
             logging.error(f"could not create or find custom field {field_name}")
-            return None
\ No newline at end of file
+            return None
+
+async def get_custom_fields_async(client, paperless_url):
+    """Async version of get_custom_fields using an AsyncPaperlessClient."""
+    response = await client.request(paperless_url + "/api/custom_fields/", "GET")
+    if not response:
+        logging.error("could not retrieve custom fields")
+        return {}
+    return {field['name']: field['id'] for field in response['results']}
+
+async def create_custom_field_async(client, field_name, paperless_url):
+    """Async version of create_custom_field using an AsyncPaperlessClient."""
+    url = paperless_url + "/api/custom_fields/"
+    body = {
+        "name": field_name,
+        "data_type": "string",
+        "extra_data": 'null'
+    }
+    response = await client.request(url, "POST", body=body, raise_rejected=True)
+    if not response:
+        logging.error(f"could not create custom field {field_name}")
+        CUSTOM_FIELD_CACHE.invalidate()
+        return None
+    logging.info(f"created new custom field: {field_name}")
+    CUSTOM_FIELD_CACHE.add(field_name, response['id'])
+    return response['id']
+
+async def get_existing_custom_field_async(client, field_name, paperless_url):
+    """Async version of get_existing_custom_field."""
+    if await CUSTOM_FIELD_CACHE.load_async(client, paperless_url):
+        return CUSTOM_FIELD_CACHE.get(field_name)
+    return (await get_custom_fields_async(client, paperless_url)).get(field_name)
+
+async def get_or_create_custom_field_async(client, field_name, paperless_url):
+    """Async version of get_or_create_custom_field."""
+    return await CUSTOM_FIELD_CACHE.single_flight_async(
+        field_name, lambda: resolve_custom_field_async(client, field_name, paperless_url))
+
+async def resolve_custom_field_async(client, field_name, paperless_url):
+    field_id = await get_existing_custom_field_async(client, field_name, paperless_url)
+
+    if field_id:
+        logging.info(f"custom field {field_name} already exists with id {field_id}")
+        return field_id
+    new_field_id = await create_after_recheck_async(
+        lambda: create_custom_field_async(client, field_name, paperless_url),
+        lambda: get_existing_custom_field_async(client, field_name, paperless_url))
+    if not new_field_id:
+        logging.error(f"could not create or find custom field {field_name}")
+    return new_field_id
@@ -1,8 +1,16 @@
 import logging
 from helpers import make_request
+from metadata_cache import DOCUMENT_TYPE_CACHE
+from resilience import create_after_recheck, create_after_recheck_async
 
 def get_existing_document_type(sess, document_type_name, paperless_url):
     """Checks if a document_type with the exact name already exists."""
+    if DOCUMENT_TYPE_CACHE.load(sess, paperless_url):
+        document_type_id = DOCUMENT_TYPE_CACHE.match(document_type_name)
+        if document_type_id:
+            logging.info(f"document_type {document_type_name} already exists with id {document_type_id}")
+        return document_type_id
+
     url = paperless_url + f"/api/document_types/?name__iexact={document_type_name}"
     response = make_request(sess, url, "GET")
     if not response:
@@ -20,15 +28,24 @@ def create_new_document_type(sess, document_type_name, paperless_url):
     body = {
         "name": document_type_name
     }
-    response = make_request(sess, url, "POST", body=body)
+    response = make_request(sess, url, "POST", body=body, raise_rejected=True)
     if not response:
         logging.error(f"could not create document_type {document_type_name}")
+        DOCUMENT_TYPE_CACHE.invalidate()
         return None
     logging.info(f"created new document_type: {document_type_name}")
+    DOCUMENT_TYPE_CACHE.add(document_type_name, response['id'])
     return response['id']
 
 def get_or_create_document_type(sess, document_type, paperless_url):
-    """Checks if a document_type exists; if not, creates it and returns the document_type ID."""
+    """Checks if a document_type exists; if not, creates it and returns the document_type ID.
+
+    Concurrent calls for the same name share a single lookup and create.
+    """
+    return DOCUMENT_TYPE_CACHE.single_flight(
+        document_type, lambda: resolve_document_type(sess, document_type, paperless_url))
+
+def resolve_document_type(sess, document_type, paperless_url):
     # Check if document_type exists by name
     document_type_id = get_existing_document_type(sess, document_type, paperless_url)
     
@@ -36,9 +53,61 @@ def get_or_create_document_type(sess, document_type, paperless_url):
         return document_type_id
     else:
         # Create a new document_type if it does not exist
-        new_document_type_id = create_new_document_type(sess, document_type, paperless_url)
+        new_document_type_id = create_after_recheck(
+            lambda: create_new_document_type(sess, document_type, paperless_url),
+            lambda: get_existing_document_type(sess, document_type, paperless_url))
         if new_document_type_id:
             return new_document_type_id
         else:
             logging.error(f"could not create or find document_type {document_type}")
-            return None
\ No newline at end of file
+            return None
+
+async def get_existing_document_type_async(client, document_type_name, paperless_url):
+    """Async version of get_existing_document_type using an AsyncPaperlessClient."""
+    if await DOCUMENT_TYPE_CACHE.load_async(client, paperless_url):
+        document_type_id = DOCUMENT_TYPE_CACHE.match(document_type_name)
+        if document_type_id:
+            logging.info(f"document_type {document_type_name} already exists with id {document_type_id}")
+        return document_type_id
+
+    url = paperless_url + "/api/document_types/"
+    response = await client.request(url, "GET", params={"name__iexact": document_type_name})
+    if not response:
+        logging.error(f"could not retrieve document_type {document_type_name}")
+        return None
+    if len(response['results']) > 0:
+        document_type = response['results'][0]
+        logging.info(f"document_type {document_type_name} already exists with id {document_type['id']}")
+        return document_type['id']
+    return None
+
+async def create_new_document_type_async(client, document_type_name, paperless_url):
+    """Async version of create_new_document_type using an AsyncPaperlessClient."""
+    url = paperless_url + "/api/document_types/"
+    body = {
+        "name": document_type_name
+    }
+    response = await client.request(url, "POST", body=body, raise_rejected=True)
+    if not response:
+        logging.error(f"could not create document_type {document_type_name}")
+        DOCUMENT_TYPE_CACHE.invalidate()
+        return None
+    logging.info(f"created new document_type: {document_type_name}")
+    DOCUMENT_TYPE_CACHE.add(document_type_name, response['id'])
+    return response['id']
+
+async def get_or_create_document_type_async(client, document_type, paperless_url):
+    """Async version of get_or_create_document_type."""
+    return await DOCUMENT_TYPE_CACHE.single_flight_async(
+        document_type, lambda: resolve_document_type_async(client, document_type, paperless_url))
+
+async def resolve_document_type_async(client, document_type, paperless_url):
+    document_type_id = await get_existing_document_type_async(client, document_type, paperless_url)
+    if document_type_id:
+        return document_type_id
+    new_document_type_id = await create_after_recheck_async(
+        lambda: create_new_document_type_async(client, document_type, paperless_url),
+        lambda: get_existing_document_type_async(client, document_type, paperless_url))
+    if not new_document_type_id:
+        logging.error(f"could not create or find document_type {document_type}")
+    return new_document_type_id
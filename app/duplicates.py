@@ -0,0 +1,175 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+from cfg import DUPLICATE_INDEX_PATH, DUPLICATE_TAG, DUPLICATE_THRESHOLD
+from fingerprint import MINHASH_PERMUTATIONS, jaccard_estimate, minhash, shingles
+from metrics import METRICS
+
+# 16 bands of 4 signature values: documents with a Jaccard similarity of 0.8 become candidates with a
+# probability above 99.9%, unrelated ones (below 0.3) in less than 13% of lookups
+BANDS = 16
+ROWS = MINHASH_PERMUTATIONS // BANDS
+SHINGLE_SIZE = 3
+SIGNATURE = struct.Struct(f"<{MINHASH_PERMUTATIONS}I")
+
+
+def signature_of(content):
+    """MinHash signature of the content's runs of three words, digits included, or None for empty content."""
+    return minhash(shingles(content, SHINGLE_SIZE, digits=True))
+
+
+def band_buckets(signature):
+    """One bucket per band, the band number in the top bits above a hash of its values."""
+    packed = SIGNATURE.pack(*signature)
+    buckets = []
+    for band in range(BANDS):
+        rows = packed[band * ROWS * 4:(band + 1) * ROWS * 4]
+        digest = int.from_bytes(hashlib.blake2b(rows, digest_size=7).digest(), "little")
+        buckets.append(band << 56 | digest)
+    return buckets
+
+
+class DuplicateIndex:
+    """SQLite backed locality-sensitive hashing index of processed documents by the MinHash of their content.
+
+    Every document is stored with its signature and the answer it was processed with. Buckets live in an
+    indexed table instead of memory, so a short-lived post-consume process looks documents up without loading
+    the archive: one query finds the documents sharing a band, and only those signatures are compared.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "doc_pk INTEGER PRIMARY KEY, signature BLOB NOT NULL, answer TEXT NOT NULL, recorded_at REAL NOT NULL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "bucket INTEGER NOT NULL, doc_pk INTEGER NOT NULL, PRIMARY KEY (bucket, doc_pk)) WITHOUT ROWID")
+
+    def add(self, doc_pk, signature, answer):
+        with self._lock, self._conn:
+            old = self._conn.execute("SELECT signature FROM documents WHERE doc_pk = ?", (doc_pk,)).fetchone()
+            if old:
+                self._conn.executemany("DELETE FROM buckets WHERE bucket = ? AND doc_pk = ?",
+                                       [(bucket, doc_pk) for bucket in band_buckets(SIGNATURE.unpack(old[0]))])
+            self._conn.execute(
+                "INSERT OR REPLACE INTO documents (doc_pk, signature, answer, recorded_at) VALUES (?, ?, ?, ?)",
+                (doc_pk, SIGNATURE.pack(*signature), answer, time.time()))
+            self._conn.executemany("INSERT OR IGNORE INTO buckets (bucket, doc_pk) VALUES (?, ?)",
+                                   [(bucket, doc_pk) for bucket in band_buckets(signature)])
+
+    def find(self, signature, threshold, exclude=None):
+        """Returns (similarity, doc_pk, answer) of the most similar document scoring at least threshold, or None."""
+        buckets = band_buckets(signature)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT doc_pk, signature FROM documents WHERE doc_pk IN "
+                f"(SELECT doc_pk FROM buckets WHERE bucket IN ({','.join('?' * len(buckets))}))",
+                buckets).fetchall()
+            best = None
+            for doc_pk, packed in rows:
+                if doc_pk == exclude:
+                    continue
+                similarity = jaccard_estimate(signature, SIGNATURE.unpack(packed))
+                if similarity >= threshold and (best is None or similarity > best[0]):
+                    best = (similarity, doc_pk)
+            if best is None:
+                return None
+            answer = self._conn.execute("SELECT answer FROM documents WHERE doc_pk = ?", (best[1],)).fetchone()[0]
+            return best[0], best[1], answer
+
+    def answer(self, doc_pk):
+        """Returns the answer stored for a document, or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT answer FROM documents WHERE doc_pk = ?", (doc_pk,)).fetchone()
+        return row[0] if row else None
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_index = None
+_threshold = DUPLICATE_THRESHOLD
+_tag = DUPLICATE_TAG
+
+
+def configure_duplicates(path=DUPLICATE_INDEX_PATH, threshold=DUPLICATE_THRESHOLD, tag=DUPLICATE_TAG):
+    """Opens the duplicate index at path (disabled when path is empty).
+
+    A document whose content is at least threshold similar to a processed one gets that document's answer,
+    plus tag when it is set.
+    """
+    global _index, _threshold, _tag
+    if _index is not None:
+        _index.close()
+    _index = DuplicateIndex(path) if path else None
+    _threshold = threshold
+    _tag = tag
+
+
+def reuse_duplicate(doc_info):
+    """Returns the answer of a processed near-duplicate of the document, or None if there is none."""
+    if _index is None:
+        return None
+    signature = signature_of(doc_info.get("content"))
+    if signature is None:
+        return None
+    with METRICS.timer("duplicate_lookup_seconds"):
+        found = _index.find(signature, _threshold, exclude=doc_info["id"])
+    if not found:
+        return None
+    similarity, original_pk, answer = found
+    try:
+        data = json.loads(answer)
+    except ValueError:
+        return None
+    logging.info(f"document {doc_info['id']} is a near duplicate of document {original_pk} "
+                 f"(similarity {similarity:.2f}), reusing its answer")
+    METRICS.inc("duplicates_total")
+    data["explanation"] = f"near duplicate of document {original_pk}"
+    data["duplicate_of"] = original_pk
+    if _tag and _tag.casefold() not in (str(tag).casefold() for tag in data.get("tags", [])):
+        data["tags"] = list(data.get("tags", [])) + [_tag]
+    return json.dumps(data)
+
+
+def recorded_answer(answer):
+    """Returns the answer to record for a processed document.
+
+    For a reused duplicate that is the original's stored answer, so the duplicate tag and explanation do not
+    spread to later duplicates or to the neighbours of the cascade.
+    """
+    try:
+        data = json.loads(answer)
+    except (TypeError, ValueError):
+        return answer
+    if not isinstance(data, dict) or "duplicate_of" not in data:
+        return answer
+    return _index.answer(data["duplicate_of"]) if _index is not None else None
+
+
+def record_document(doc_info, answer):
+    """Adds a processed document and its answer to the duplicate index."""
+    if _index is None or not answer:
+        return
+    signature = signature_of(doc_info.get("content"))
+    if signature is not None:
+        _index.add(doc_info["id"], signature, answer)
@@ -0,0 +1,93 @@
+import hashlib
+import random
+import re
+from collections import Counter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# runs of letters only, so amounts, dates and reference numbers do not change a document's fingerprint
+WORD = re.compile(r"[^\W\d_]{2,}")
+# letters and digits, for telling apart documents that only differ in their numbers
+TOKEN = re.compile(r"\w+")
+# only the start of long documents is fingerprinted, which keeps it at a few milliseconds
+MAX_CHARS = 20000
+
+
+def words(content, digits=False):
+    return (TOKEN if digits else WORD).findall((content or "")[:MAX_CHARS].casefold())
+
+
+def shingles(content, size=2, digits=False):
+    """The set of runs of size consecutive words of the content."""
+    tokens = words(content, digits)
+    if len(tokens) < size:
+        return {" ".join(tokens)} if tokens else set()
+    return {" ".join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+
+
+def feature_hash(feature):
+    return int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def simhash(features):
+    """64-bit SimHash of a set of features: similar sets give fingerprints differing in few bits."""
+    hashes = [feature_hash(feature) for feature in features]
+    if not hashes:
+        return 0
+    fingerprint = 0
+    # count set bits byte by byte instead of bit by bit for every hash
+    for byte in range(8):
+        values = Counter((h >> (8 * byte)) & 0xFF for h in hashes)
+        for bit in range(8):
+            ones = sum(count for value, count in values.items() if value >> bit & 1)
+            if ones * 2 > len(hashes):
+                fingerprint |= 1 << (8 * byte + bit)
+    return fingerprint
+
+
+MINHASH_PERMUTATIONS = 64
+MERSENNE_PRIME = (1 << 61) - 1
+MASK_32 = (1 << 32) - 1
+# fixed seed, signatures stored in an index must stay comparable between runs
+_rng = random.Random(20240101)
+MINHASH_A = [_rng.randrange(1, 1 << 32) for _ in range(MINHASH_PERMUTATIONS)]
+MINHASH_B = [_rng.randrange(0, 1 << 32) for _ in range(MINHASH_PERMUTATIONS)]
+
+
+def minhash(features):
+    """MinHash signature of a set of features as MINHASH_PERMUTATIONS 32-bit values, or None for an empty set.
+
+    The share of equal values of two signatures estimates the Jaccard similarity of both sets. Every
+    permutation is (a * h + b) mod 2^61-1 of a 32-bit feature hash, which stays below 2^64, so NumPy (when
+    installed) and plain Python compute the same signature.
+    """
+    hashes = [feature_hash(feature) & MASK_32 for feature in features]
+    if not hashes:
+        return None
+    if np is not None:
+        values = np.asarray(hashes, dtype=np.uint64)
+        a = np.asarray(MINHASH_A, dtype=np.uint64)[:, None]
+        b = np.asarray(MINHASH_B, dtype=np.uint64)[:, None]
+        permuted = ((a * values + b) % np.uint64(MERSENNE_PRIME)) & np.uint64(MASK_32)
+        return [int(value) for value in permuted.min(axis=1)]
+    return [min(((a * h + b) % MERSENNE_PRIME) & MASK_32 for h in hashes) for a, b in zip(MINHASH_A, MINHASH_B)]
+
+
+def jaccard_estimate(a, b):
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+def to_signed(value):
+    """Maps an unsigned 64-bit value onto SQLite's signed INTEGER range."""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
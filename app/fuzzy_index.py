@@ -0,0 +1,106 @@
+import re
+import threading
+import unicodedata
+from collections import Counter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+NON_ALNUM = re.compile(r"[^0-9a-z]+")
+
+
+def normalize(name):
+    """Lowercases name, folds umlauts and accents, and reduces everything but letters and digits to single spaces."""
+    name = name.casefold().replace("ß", "ss")
+    name = "".join(c for c in unicodedata.normalize("NFKD", name) if not unicodedata.combining(c))
+    return NON_ALNUM.sub(" ", name).strip()
+
+
+def trigrams(name):
+    """Character trigrams of the normalized name, padded so word starts and ends count as well."""
+    padded = f"  {normalize(name)} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)} if padded.strip() else set()
+
+
+class TrigramIndex:
+    """Finds the existing name most similar to a new one, to map spelling variants onto existing objects.
+
+    A name scores the mean of the Dice coefficient and the overlap coefficient of both trigram sets, so
+    plurals ("Rechnungen" and "Rechnung") and added qualifiers ("Finanzamt München" and "Finanzamt") score
+    above 0.8 while names merely sharing a word stay below. Names are added incrementally. Scoring uses
+    NumPy when installed and plain dictionaries otherwise.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._names = []
+        self._values = []
+        self._sizes = []
+        self._postings = {}
+        # NumPy copies of _sizes and the postings, rebuilt lazily after additions
+        self._size_array = None
+        self._posting_arrays = {}
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, name, value):
+        grams = trigrams(name)
+        if not grams:
+            return
+        with self._lock:
+            row = len(self._names)
+            self._names.append(name)
+            self._values.append(value)
+            self._sizes.append(len(grams))
+            for gram in grams:
+                self._postings.setdefault(gram, []).append(row)
+                self._posting_arrays.pop(gram, None)
+            self._size_array = None
+
+    def best(self, name):
+        """Returns (value, matched name, score) of the most similar name scoring at least threshold, or None."""
+        grams = trigrams(name)
+        if not grams:
+            return None
+        with self._lock:
+            if not self._names:
+                return None
+            if np is not None:
+                row, score = self._best_numpy(grams)
+            else:
+                row, score = self._best_python(grams)
+            if row is None or score < self.threshold:
+                return None
+            return self._values[row], self._names[row], score
+
+    def _best_numpy(self, grams):
+        rows = [self._posting_array(gram) for gram in grams if gram in self._postings]
+        if not rows:
+            return None, 0.0
+        if self._size_array is None:
+            self._size_array = np.asarray(self._sizes, dtype=np.float32)
+        shared = np.bincount(np.concatenate(rows), minlength=len(self._names)).astype(np.float32)
+        sizes = self._size_array
+        scores = (2 * shared / (len(grams) + sizes) + shared / np.minimum(len(grams), sizes)) / 2
+        row = int(np.argmax(scores))
+        return row, float(scores[row])
+
+    def _posting_array(self, gram):
+        array = self._posting_arrays.get(gram)
+        if array is None:
+            array = self._posting_arrays[gram] = np.asarray(self._postings[gram], dtype=np.int64)
+        return array
+
+    def _best_python(self, grams):
+        shared = Counter(row for gram in grams for row in self._postings.get(gram, ()))
+        best_row, best_score = None, 0.0
+        for row, count in shared.items():
+            size = self._sizes[row]
+            score = (2 * count / (len(grams) + size) + count / min(len(grams), size)) / 2
+            if score > best_score:
+                best_row, best_score = row, score
+        return best_row, best_score
@@ -1,14 +1,17 @@
 import logging
 import requests
 import json
+import time
 import traceback
 from cfg import TIMEOUT
+from metrics import record_request
+from ratelimit import PAPERLESS_LIMITER
+from resilience import (DEFAULT_POLICY, IDEMPOTENT_METHODS, PAPERLESS_BREAKER, RETRY_COUNTS, RETRY_STATUSES,
+                        RejectedRequest, is_rejected, parse_retry_after)
 
 
-def get_character_limit(openai_model):
-    if 'gpt-4' in openai_model:
-        return 200000
-    return 45000
+class ListingError(Exception):
+    """Raised when a page of a Paperless listing could not be retrieved, so the listing is incomplete."""
 
 
 def strtobool(value: str) -> bool:
@@ -18,32 +21,64 @@ def strtobool(value: str) -> bool:
     return False
 
 
-def make_request(sess, url, method, body=None, params=None, headers=None):
+def make_request(sess, url, method, body=None, params=None, headers=None, idempotent=None, raise_rejected=False):
+    """Calls the Paperless API and returns the decoded JSON, the text if it is not JSON, or None on errors.
+
+    Timeouts, connection errors and 408/429/5xx responses are retried with backoff for idempotent calls
+    (by default every method but POST). Repeated failures pause all callers through the circuit breaker.
+    With raise_rejected, a request rejected as invalid (see resilience.is_rejected) raises RejectedRequest.
+    """
     if body is not None:
         body = json.dumps(body)
     if headers is None:
         headers = {}
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
 
     headers["Content-Type"] = "application/json"
     headers['Accept'] = 'application/json; version=4'
 
-    try:
-        r = sess.request(method, headers=headers, url=url, params=params, data=body, timeout=TIMEOUT, verify=True)
-    except requests.exceptions.ConnectionError as e:
-        logging.error(f"Error connecting to {url}: {e}")
-        return None
-    except requests.exceptions.Timeout as e:
-        logging.error(f"Timeout calling {url}: {e}")
-        return None
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error calling {url}: {e}")
-        return None
+    attempt = 0
+    while True:
+        attempt += 1
+        can_retry = idempotent and attempt < DEFAULT_POLICY.max_attempts
+        PAPERLESS_BREAKER.before_call()
+        try:
+            with PAPERLESS_LIMITER.limit():
+                start = time.perf_counter()
+                r = sess.request(method, headers=headers, url=url, params=params, data=body, timeout=TIMEOUT, verify=True)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            record_request("paperless", method, url, "error", time.perf_counter() - start)
+            PAPERLESS_BREAKER.record_failure()
+            if can_retry:
+                wait_before_retry(url, attempt, e)
+                continue
+            if isinstance(e, requests.exceptions.Timeout):
+                logging.error(f"Timeout calling {url}: {e}")
+            else:
+                logging.error(f"Error connecting to {url}: {e}")
+            return None
+        except requests.exceptions.RequestException as e:
+            record_request("paperless", method, url, "error", time.perf_counter() - start)
+            logging.error(f"Error calling {url}: {e}")
+            return None
+
+        record_request("paperless", method, url, r.status_code, time.perf_counter() - start)
+        if r.status_code not in RETRY_STATUSES:
+            PAPERLESS_BREAKER.record_success()
+            break
+        PAPERLESS_BREAKER.record_failure()
+        if not can_retry:
+            break
+        wait_before_retry(url, attempt, f"status {r.status_code}", parse_retry_after(r.headers))
 
     try:
         r.raise_for_status()
     except requests.exceptions.HTTPError as e:
         logging.error(f"Http error calling {url}: {e}")
         logging.error(f"Response: {r.text}")
+        if raise_rejected and is_rejected(r.status_code, r.text):
+            raise RejectedRequest(f"{method} {url} was rejected with status {r.status_code}") from None
         return None
 
     try:
@@ -53,3 +88,10 @@ def make_request(sess, url, method, body=None, params=None, headers=None):
         traceback.print_exc()
         return r.text
     return json_response
+
+
+def wait_before_retry(url, attempt, reason, retry_after=None):
+    delay = DEFAULT_POLICY.delay(attempt, retry_after)
+    logging.warning(f"attempt {attempt} calling {url} failed ({reason}), retrying in {delay:.1f}s")
+    RETRY_COUNTS.add("paperless")
+    time.sleep(delay)
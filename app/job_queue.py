@@ -0,0 +1,97 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobQueue:
+    """Durable queue of document IDs in a SQLite file, shared by the post-consume script and the worker.
+
+    Only the standard library is used so enqueueing stays cheap for the short-lived post-consume process.
+    """
+
+    def __init__(self, path, max_attempts=3):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # several post-consume processes may enqueue at the same time, so wait for locks instead of failing
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, doc_pk INTEGER NOT NULL, status TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, error TEXT, enqueued_at REAL NOT NULL, updated_at REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+
+    def enqueue(self, doc_pk):
+        """Adds a document unless it is already waiting to be processed."""
+        with self._lock:
+            now = time.time()
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                pending = self._conn.execute("SELECT 1 FROM jobs WHERE doc_pk = ? AND status = ?",
+                                             (doc_pk, PENDING)).fetchone()
+                if not pending:
+                    self._conn.execute("INSERT INTO jobs (doc_pk, status, enqueued_at, updated_at) VALUES (?, ?, ?, ?)",
+                                       (doc_pk, PENDING, now, now))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def claim(self, limit=1):
+        """Marks up to limit pending jobs as running and returns them as (job_id, doc_pk) tuples, oldest first."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                jobs = self._conn.execute("SELECT id, doc_pk FROM jobs WHERE status = ? ORDER BY id LIMIT ?",
+                                          (PENDING, limit)).fetchall()
+                self._conn.executemany("UPDATE jobs SET status = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                                       [(RUNNING, time.time(), job_id) for job_id, _ in jobs])
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            return jobs
+
+    def complete(self, job_id):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = ?, error = NULL, updated_at = ? WHERE id = ?",
+                               (DONE, time.time(), job_id))
+
+    def fail(self, job_id, error=None):
+        """Puts a job back in the queue, or marks it failed once it used up its attempts."""
+        with self._lock:
+            attempts = self._conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+            status = FAILED if attempts >= self.max_attempts else PENDING
+            self._conn.execute("UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                               (status, error, time.time(), job_id))
+            if status == FAILED:
+                logging.error(f"giving up on job {job_id} after {attempts} attempts: {error}")
+
+    def requeue_running(self):
+        """Returns jobs left running by a worker that stopped unexpectedly to the queue."""
+        with self._lock:
+            count = self._conn.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE status = ?",
+                                       (PENDING, time.time(), RUNNING)).rowcount
+            if count:
+                logging.info(f"requeued {count} interrupted jobs")
+
+    def purge_done(self, older_than):
+        """Deletes finished jobs last updated more than older_than seconds ago."""
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE status = ? AND updated_at < ?", (DONE, time.time() - older_than))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from cfg import LLM_BACKEND, LLM_BATCH_SIZE, LLM_BATCH_WAIT_MS, LLM_CONCURRENCY
+from metrics import METRICS
+from pool import run_concurrently
+
+
+class Backend:
+    """Generates the answers for a batch of conversations.
+
+    batch_size and concurrency are the defaults for the DynamicBatcher in front of it: how many documents one
+    batch may hold and how many batches may run at once.
+    """
+    name = "backend"
+    batch_size = 1
+    concurrency = 1
+
+    def complete_batch(self, conversations):
+        """Returns one answer (the JSON text) or None per conversation, in the same order."""
+        raise NotImplementedError
+
+
+class OpenAICompatibleBackend(Backend):
+    """A local OpenAI compatible server such as llama.cpp or vLLM.
+
+    The conversations of a batch are sent as simultaneous chat completions, so a server with continuous batching
+    (llama.cpp started with --parallel, vLLM) evaluates them together. A CPU-only server usually does best with
+    one batch at a time of about as many documents as it has slots.
+    """
+    name = "local"
+    batch_size = 4
+    concurrency = 1
+
+    def __init__(self, client, model):
+        self.client = client
+        self.model = model
+
+    def complete_batch(self, conversations):
+        return run_concurrently([lambda messages=messages: self._complete(messages) for messages in conversations])
+
+    def _complete(self, messages):
+        # imported here, main imports this module
+        from main import query_openai
+        try:
+            response = query_openai(self.client, model=self.model, messages=messages)
+            return response.choices[0].message.content
+        except Exception as e:
+            logging.error(f"{self.name} backend failed: {e}")
+            return None
+
+
+class FakeBackend(Backend):
+    """Answers without a model after a simulated delay of latency plus per_document for each document of a batch.
+
+    The answer only depends on the conversation, and the sizes of all batches are kept in batches, so
+    batching and throughput can be checked without a model.
+    """
+    name = "fake"
+    batch_size = 8
+    concurrency = 1
+
+    def __init__(self, latency=0.05, per_document=0.01):
+        self.latency = latency
+        self.per_document = per_document
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def complete_batch(self, conversations):
+        with self._lock:
+            self.batches.append(len(conversations))
+        time.sleep(self.latency + self.per_document * len(conversations))
+        return [self._answer(messages) for messages in conversations]
+
+    @staticmethod
+    def _answer(messages):
+        digest = hashlib.sha256(json.dumps(messages, sort_keys=True).encode("utf-8")).hexdigest()[:8]
+        return json.dumps({
+            "title": f"Dokument {digest}",
+            "explanation": "answer of the fake backend",
+            "tags": ["test"],
+            "correspondent": "Test",
+            "created_date": "",
+            "document_type": "Test",
+            "summary": f"Testdokument {digest}",
+        })
+
+
+class DynamicBatcher:
+    """Collects the conversations of concurrently processed documents into batches for a backend.
+
+    generate() blocks the calling thread until its answer is ready. A batch is dispatched once it holds
+    max_batch_size conversations or max_wait_ms passed since its first one arrived, and at most max_concurrency
+    batches run at once. While all are busy, waiting conversations keep filling the next batch.
+    """
+
+    def __init__(self, backend, max_batch_size=None, max_wait_ms=LLM_BATCH_WAIT_MS, max_concurrency=None):
+        self.backend = backend
+        self.max_batch_size = max_batch_size or backend.batch_size
+        self.max_wait = max_wait_ms / 1000
+        max_concurrency = max_concurrency or backend.concurrency
+        self._queue = queue.Queue()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=f"{backend.name}-batch")
+        self._thread = threading.Thread(target=self._collect, name=f"{backend.name}-batcher", daemon=True)
+        self._thread.start()
+        logging.info(f"batching requests to the {backend.name} backend, up to {self.max_batch_size} documents "
+                     f"or {max_wait_ms:g} ms per batch, {max_concurrency} batch(es) at a time")
+
+    def generate(self, messages):
+        """Returns the answer for one conversation, or None if the backend could not answer it."""
+        future = Future()
+        self._queue.put((messages, future))
+        return future.result()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._executor.shutdown()
+
+    def _collect(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.max_wait
+            stop = self._fill(batch, deadline)
+            self._slots.acquire()
+            if not stop:
+                stop = self._fill(batch, None)
+            self._executor.submit(self._run, batch)
+            if stop:
+                return
+
+    def _fill(self, batch, deadline):
+        """Adds waiting conversations to batch until it is full or the deadline passed (None: only those already
+        waiting). Returns True if close() was called."""
+        while len(batch) < self.max_batch_size:
+            try:
+                if deadline is None:
+                    item = self._queue.get_nowait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                return False
+            if item is None:
+                return True
+            batch.append(item)
+        return False
+
+    def _run(self, batch):
+        METRICS.inc("llm_batches_total", backend=self.backend.name)
+        METRICS.inc("llm_batched_documents_total", len(batch), backend=self.backend.name)
+        try:
+            with METRICS.timer("llm_batch_seconds", backend=self.backend.name):
+                answers = self.backend.complete_batch([messages for messages, _ in batch])
+        except Exception as e:
+            logging.exception(f"{self.backend.name} backend failed on a batch of {len(batch)}")
+            for _, future in batch:
+                future.set_exception(e)
+        else:
+            for (_, future), answer in zip(batch, answers):
+                future.set_result(answer)
+        finally:
+            self._slots.release()
+
+
+def create_backend(openai_model, openai_key, openai_base_url, kind=LLM_BACKEND):
+    """Returns a DynamicBatcher for the configured backend, or None for the default of one OpenAI request per document."""
+    if kind == "openai":
+        return None
+    if kind == "local":
+        from openai import OpenAI
+        backend = OpenAICompatibleBackend(OpenAI(api_key=openai_key or "local", base_url=openai_base_url,
+                                                 max_retries=0), openai_model)
+    elif kind == "fake":
+        backend = FakeBackend()
+    else:
+        raise ValueError(f"unknown LLM_BACKEND {kind!r}, expected openai, local or fake")
+    return DynamicBatcher(backend, LLM_BATCH_SIZE, LLM_BATCH_WAIT_MS, LLM_CONCURRENCY)
@@ -1,18 +1,57 @@
 #!/usr/bin/env python3
-import json
+import copy
 import logging
 import os
 import sys
 from datetime import datetime
 
-import requests
-from openai import OpenAI
-from cfg import (OPENAI_API_KEY, OPENAPI_MODEL, PAPERLESS_API_KEY, PAPERLESS_URL, PROMPT, OPENAI_BASEURL, TIMEOUT, OWNER_NAME)
-from helpers import make_request, strtobool, get_character_limit
-from tags import get_or_create_tags
-from correspondents import get_or_create_correspondent
-from custom_fields import get_or_create_custom_field
-from document_type import get_or_create_document_type
+from cfg import WORKER_QUEUE_PATH
+from job_queue import JobQueue
+
+def configure_logging():
+    LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO').upper()
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                        datefmt='%m/%d/%Y %I:%M:%S %p',
+                        level=LOGLEVEL)
+
+def enqueue_document(doc_pk):
+    """Hands the document to the resident worker instead of processing it in this process."""
+    if not doc_pk:
+        logging.error("Missing DOCUMENT_ID")
+        sys.exit(1)
+    queue = JobQueue(WORKER_QUEUE_PATH)
+    try:
+        queue.enqueue(int(doc_pk))
+    finally:
+        queue.close()
+    logging.info(f"queued document {doc_pk} in {WORKER_QUEUE_PATH}")
+
+# As post-consume script with the worker, only queue the document. This runs before the processing stack below
+# is imported, which would take several times as long as queueing.
+if __name__ == '__main__' and WORKER_QUEUE_PATH:
+    configure_logging()
+    enqueue_document(os.getenv("DOCUMENT_ID"))
+    sys.exit(0)
+
+import requests  # noqa: E402
+from cfg import (OPENAI_API_KEY, OPENAPI_MODEL, PAPERLESS_API_KEY, PAPERLESS_URL, PROMPT, OPENAI_BASEURL,  # noqa: E402
+                 TIMEOUT, OWNER_NAME, STREAM_ANSWERS, ANSWER_MAX_TOKENS, ANSWER_MAX_ATTEMPTS)
+from helpers import make_request, strtobool  # noqa: E402
+from metrics import METRICS, timed_request  # noqa: E402
+from cascade import classify_from_neighbours, configure_cascade, record_processed  # noqa: E402
+from duplicates import configure_duplicates, record_document, recorded_answer, reuse_duplicate  # noqa: E402
+from llm_backends import create_backend  # noqa: E402
+from metadata_cache import CORRESPONDENT_CACHE, DOCUMENT_TYPE_CACHE, TAG_CACHE, load_all  # noqa: E402
+from pool import run_concurrently  # noqa: E402
+from ratelimit import OPENAI_LIMITER, estimate_tokens  # noqa: E402
+from token_budget import content_budget, count_tokens, select_content  # noqa: E402
+from usage import USAGE  # noqa: E402
+from resilience import OPENAI_BREAKER, call_with_retries, classify_openai_error  # noqa: E402
+from result_cache import cache_key, get_cached_answer, store_answer, is_cache_only, configure_result_cache  # noqa: E402
+from tags import get_or_create_tags  # noqa: E402
+from correspondents import get_or_create_correspondent  # noqa: E402
+from custom_fields import get_or_create_custom_field  # noqa: E402
+from document_type import get_or_create_document_type  # noqa: E402
 
 def check_args(doc_pk):
     """Verifies that all required arguments and environment variables are present."""
@@ -42,183 +81,404 @@ def get_document_created_date(doc_info):
     """Returns the created date of the document or None if not available."""
     return doc_info.get("created_date")
 
-def update_document_created_date_if_earlier(sess, doc_pk, openai_created_date, paperless_created_date, paperless_url):
-    """Updates the document's created date if the OpenAI date is earlier."""
-    if paperless_created_date:
-        # Compare dates
-        openai_date = datetime.strptime(openai_created_date, '%Y-%m-%d')
-        paperless_date = datetime.strptime(paperless_created_date, '%Y-%m-%d')
-        if openai_date < paperless_date:
-            logging.info(f"OpenAI created_date {openai_created_date} is earlier than Paperless date {paperless_created_date}. Updating Paperless.")
-            update_document_created_date(sess, doc_pk, openai_created_date, paperless_url)
-        else:
-            logging.info(f"Paperless created_date {paperless_created_date} is earlier. No update needed.")
-    else:
+def select_created_date(openai_created_date, paperless_created_date):
+    """Returns the OpenAI created date if it should replace the Paperless one, otherwise None."""
+    if not paperless_created_date:
         # If no created_date in Paperless, use the OpenAI date
         logging.info(f"No created_date in Paperless. Setting OpenAI created_date {openai_created_date}.")
-        update_document_created_date(sess, doc_pk, openai_created_date, paperless_url)
+        return openai_created_date
 
-def update_document_created_date(sess, doc_pk, created_date, paperless_url):
-    """Updates the document's created_date in Paperless."""
-    url = paperless_url + f"/api/documents/{doc_pk}/"
-    body = {"created_date": created_date}
-    resp = make_request(sess, url, "PATCH", body=body)
-    if not resp:
-        logging.error(f"could not update document {doc_pk} with created_date {created_date}")
-    else:
-        logging.info(f"updated document {doc_pk} with created_date {created_date}")
+    # Compare dates
+    try:
+        openai_date = datetime.strptime(openai_created_date, '%Y-%m-%d')
+        paperless_date = datetime.strptime(paperless_created_date, '%Y-%m-%d')
+    except ValueError as e:
+        logging.error(f"could not compare created dates {openai_created_date} and {paperless_created_date}: {e}")
+        return None
+    if openai_date < paperless_date:
+        logging.info(f"OpenAI created_date {openai_created_date} is earlier than Paperless date {paperless_created_date}. Updating Paperless.")
+        return openai_created_date
+    logging.info(f"Paperless created_date {paperless_created_date} is earlier. No update needed.")
+    return None
+
+class ProcessingContext:
+    """Long-lived state shared by every document processed in one run.
 
-def query_openai(model, messages, openai_key, openai_base_url, **kwargs):
+    Holds the Paperless session, a single OpenAI client (and with it one pooled HTTP connection) and the owner
+    ID, which is looked up once instead of per document. The async pipeline in async_processing uses the same
+    class with an AsyncPaperlessClient and an AsyncOpenAI client. With a bulk_committer, tags, correspondent and
+    document type are handed to it instead of being written with each document's PATCH. With a backend (see
+    llm_backends, configured by LLM_BACKEND), answers are generated through it instead of one OpenAI request each;
+    the backend is created once per context unless one is passed, and stopped by close().
+    """
+
+    def __init__(self, sess, paperless_url, openai_model, openai_key, openai_base_url,
+                 username=None, dry_run=False, openai_client=None, bulk_committer=None, owner_id=None, backend=None):
+        self.sess = sess
+        self.paperless_url = paperless_url
+        self.openai_model = openai_model
+        self.openai_key = openai_key
+        self.openai_base_url = openai_base_url
+        self.dry_run = dry_run
+        self.bulk_committer = bulk_committer
+        if openai_client is None:
+            # imported here, openai and pydantic are slow to import and not needed when only queueing
+            from openai import OpenAI
+            # retries are handled by query_openai, which shares its backoff and circuit breaker with Paperless calls
+            openai_client = OpenAI(api_key=openai_key, base_url=openai_base_url, max_retries=0)
+        self.openai_client = openai_client
+        if backend is None:
+            backend = create_backend(openai_model, openai_key, openai_base_url)
+        self.backend = backend
+        if username and owner_id is None:
+            owner_id = get_owner_id(sess, username, paperless_url)
+        self.owner_id = owner_id
+
+    def for_session(self, sess):
+        """Returns a copy of this context using another Paperless session but the same OpenAI client and backend."""
+        ctx = copy.copy(self)
+        ctx.sess = sess
+        return ctx
+
+    def close(self):
+        """Stops the backend's batcher at the end of the run. Copies made by for_session share it and are not closed."""
+        if self.backend:
+            self.backend.close()
+            self.backend = None
+
+def with_current_date(messages):
+    """Inserts today's date right after the system prompt.
+
+    The prompt expects the current date to be the first date in the context. It is added only when sending,
+    after the static system prompt, so the prompt stays a byte-stable prefix for the provider's prompt cache
+    and the result cache key does not change every day.
+    """
+    date_message = {"role": "user", "content": f"Current date: {datetime.now().strftime('%Y-%m-%d')}"}
+    return messages[:1] + [date_message] + messages[1:]
+
+def query_openai(client, model, messages, **kwargs):
     """Queries OpenAI to generate title, tags, correspondent, and created_date."""
-    client = OpenAI(api_key=openai_key, base_url=openai_base_url)
     args_to_remove = ['mock', 'completion_tokens']
     for arg in args_to_remove:
         if arg in kwargs:
             del kwargs[arg]
-    return client.chat.completions.create(
-        model=model,
-        messages=messages,
-        response_format={"type": "json_object"},
-        **kwargs
-    )
+    messages = with_current_date(messages)
+
+    def create():
+        with OPENAI_LIMITER.limit(tokens=estimate_tokens(messages)), timed_request("openai", "POST", "/chat/completions"):
+            return client.chat.completions.create(
+                model=model,
+                messages=messages,
+                response_format={"type": "json_object"},
+                **kwargs
+            )
+
+    response = call_with_retries(create, "openai", OPENAI_BREAKER, classify_openai_error)
+    USAGE.record(model, getattr(response, "usage", None))
+    return response
+
+def stream_answer(client, model, messages, on_field=None):
+    """Streams the answer to messages, validating every field as soon as it is complete.
+
+    A malformed answer is aborted at the first invalid field and requested again, up to ANSWER_MAX_ATTEMPTS
+    times. on_field(name, value) is called for every valid field while the rest is generated. Returns the
+    answer as JSON text, or None if no valid one was received.
+    """
+    # imported here, pydantic is slow to import and not needed when only queueing
+    from answer_schema import AnswerStream, MalformedAnswer, max_answer_tokens
+    messages = with_current_date(messages)
+    max_tokens = ANSWER_MAX_TOKENS or max_answer_tokens()
+    for attempt in range(1, ANSWER_MAX_ATTEMPTS + 1):
+        parser = None
 
-def generate_title_tags_correspondent_and_type(content, openai_model, openai_key, openai_base_url):
-    """Generates title, tags, correspondent, document_type, and extracts the most relevant date from the content."""
-    character_limit = get_character_limit(openai_model)
-    messages = [
+        def consume():
+            nonlocal parser
+            # a retried request starts over with a new parser
+            parser = AnswerStream(on_field)
+            with OPENAI_LIMITER.limit(tokens=estimate_tokens(messages)), timed_request("openai", "POST", "/chat/completions"):
+                stream = client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    response_format={"type": "json_object"},
+                    max_tokens=max_tokens,
+                    stream=True,
+                    extra_body={"stream_options": {"include_usage": True}},
+                )
+                try:
+                    for chunk in stream:
+                        # the last chunk carries the usage and no choices
+                        USAGE.record(model, getattr(chunk, "usage", None))
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            parser.feed(chunk.choices[0].delta.content)
+                finally:
+                    stream.response.close()
+
+        try:
+            call_with_retries(consume, "openai", OPENAI_BREAKER, classify_openai_error)
+            return parser.finish()
+        except MalformedAnswer as e:
+            METRICS.inc("malformed_answers_total", model=model)
+            logging.warning(f"attempt {attempt} of {ANSWER_MAX_ATTEMPTS}: aborted malformed answer after "
+                            f"{len(parser)} characters ({e}): {parser.text[:200]!r}")
+    return None
+
+def build_messages(openai_model, content):
+    """Builds the chat messages sent to OpenAI for a document's content, fitted to the token budget."""
+    budget = content_budget(openai_model, count_tokens(PROMPT, openai_model))
+    return [
         {"role": "system", "content": PROMPT},
-        {"role": "user", "content": " ".join(content[:character_limit].split())}
+        {"role": "user", "content": select_content(content, openai_model, budget)}
     ]
-    response = query_openai(model=openai_model,
-                            messages=messages,
-                            openai_key=openai_key,
-                            openai_base_url=openai_base_url,
-                            mock=False)
+
+def lookup_cached_answer(key):
+    """Returns (answer, skip): the cached answer if any, and whether the LLM must not be called."""
+    answer = get_cached_answer(key)
+    if answer:
+        logging.info("using cached answer")
+        return answer, True
+    if is_cache_only():
+        logging.info("no cached answer and running in cache only mode, skipping")
+        return None, True
+    return None, False
+
+def read_answer(key, response):
+    """Extracts the answer from an OpenAI response and caches it if it parses."""
     try:
         answer = response.choices[0].message.content
     except:
         return None
+    return store_valid_answer(key, answer)
+
+def store_valid_answer(key, answer):
+    if answer and parse_response(answer)[0]:
+        store_answer(key, answer)
     return answer
 
+def generate_title_tags_correspondent_and_type(ctx, content, on_field=None):
+    """Generates title, tags, correspondent, document_type, and extracts the most relevant date from the content.
+
+    When answers are streamed, on_field(name, value) is called with each field as soon as it is generated.
+    """
+    messages = build_messages(ctx.openai_model, content)
+    key = cache_key(ctx.openai_model, messages)
+    answer, skip = lookup_cached_answer(key)
+    if skip:
+        return answer
+    if ctx.backend:
+        return store_valid_answer(key, ctx.backend.generate(messages))
+    if STREAM_ANSWERS:
+        return store_valid_answer(key, stream_answer(ctx.openai_client, ctx.openai_model, messages, on_field))
+
+    response = query_openai(ctx.openai_client,
+                            model=ctx.openai_model,
+                            messages=messages,
+                            mock=False)
+    return read_answer(key, response)
+
 def parse_response(response):
-    """Parses the response from OpenAI to extract title, explanation, tags, correspondent, created_date, document_type, and summary."""
-    try:
-        data = json.loads(response)
-    except:
+    """Parses the response from OpenAI to extract title, explanation, tags, correspondent, created_date, document_type, and summary.
+
+    The answer is validated against answer_schema.Answer. All seven are None if it does not fit.
+    """
+    from answer_schema import parse_answer
+    answer = parse_answer(response)
+    if answer is None:
         return None, None, None, None, None, None, None
-    return data['title'], data.get('explanation', ""), data.get('tags', []), data.get('correspondent', ""), data.get('created_date', ""), data.get('document_type', ""), data.get('summary', "")
+    return answer.title, answer.explanation, answer.tags, answer.correspondent, answer.created_date, answer.document_type, answer.summary
+
+METADATA_FIELDS = ("correspondent", "tags", "document_type")
+
+def early_resolution(ctx):
+    """Returns an on_field callback loading the metadata listings as soon as the answer names any metadata.
+
+    It runs on the calling thread with its session, while the model keeps generating summary and explanation
+    into the open response, so resolve_metadata_ids later finds the names in fresh caches. Nothing is created
+    here: a streamed answer may still be aborted, so creates wait until it is validated as a whole. Returns None
+    in dry runs, which never resolve metadata.
+    """
+    if ctx.dry_run:
+        return None
+
+    def on_field(name, value):
+        if name not in METADATA_FIELDS or not value:
+            return
+        try:
+            load_all(ctx.sess, ctx.paperless_url)
+        except Exception as e:
+            # only a head start, resolve_metadata_ids loads the listings again
+            logging.warning(f"could not load metadata listings while the answer is generated: {e}")
+    return on_field
+
+def resolve_metadata_ids(ctx, doc_pk, tags, correspondent, document_type):
+    """Gets or creates the correspondent, tags and document_type. Returns their IDs, or None if any could not be resolved.
+
+    Stale listings are reloaded in parallel. Names missing from them are created concurrently, so a document
+    waits for about one round trip however many new names it has.
+    """
+    sess, paperless_url = ctx.sess, ctx.paperless_url
+    load_all(sess, paperless_url)
+    resolve = [
+        lambda resolve_sess: get_or_create_correspondent(resolve_sess, correspondent, paperless_url, ctx.owner_id),
+        lambda resolve_sess: get_or_create_tags(resolve_sess, tags, paperless_url, ctx.owner_id),
+        lambda resolve_sess: get_or_create_document_type(resolve_sess, document_type, paperless_url),
+    ]
+    cached = (CORRESPONDENT_CACHE.get(correspondent) and DOCUMENT_TYPE_CACHE.get(document_type)
+              and all(TAG_CACHE.get(tag) for tag in tags))
+    # everything known is answered from the caches, so threads would only add overhead
+    if cached:
+        correspondent_id, tag_ids, document_type_id = [fn(sess) for fn in resolve]
+    else:
+        correspondent_id, tag_ids, document_type_id = run_concurrently(resolve, sess)
 
-def update_document_title_tags_correspondent_and_type(sess, doc_pk, title, tags, correspondent, document_type, owner_id, paperless_url):
-    """Updates the document with title, tags, correspondent, and document_type."""
-    
-    # Get or create the correspondent and its ID
-    correspondent_id = get_or_create_correspondent(sess, correspondent, paperless_url, owner_id)
     if not correspondent_id:
         logging.error(f"could not retrieve or create correspondent for document {doc_pk}")
-        return
-
-    # Get or create tags and their IDs
-    tag_ids = get_or_create_tags(sess, tags, paperless_url, owner_id)
+        return None
     if not tag_ids:
         logging.error(f"could not retrieve or create tags for document {doc_pk}")
-        return
-
-    # Get or create document_type and its ID
-    document_type_id = get_or_create_document_type(sess, document_type, paperless_url)
+        return None
     if not document_type_id:
         logging.error(f"could not retrieve or create document_type for document {doc_pk}")
-        return
+        return None
 
-    # Update the document with the title, tags, correspondent, and document type
-    url = paperless_url + f"/api/documents/{doc_pk}/"
-    body = {
-        "title": title,
-        "tags": tag_ids,
-        "correspondent": correspondent_id,
-        "document_type": document_type_id
-    }
-    resp = make_request(sess, url, "PATCH", body=body)
-    if not resp:
-        logging.error(f"could not update document {doc_pk} with title, tags, correspondent, and document_type")
-    else:
-        logging.info(f"updated document {doc_pk} with title {title}, tags {tags}, correspondent {correspondent}, and document_type {document_type}")
+    return {"tags": tag_ids, "correspondent": correspondent_id, "document_type": document_type_id}
 
-def update_document_with_custom_fields(sess, doc_pk, custom_field_id, summary_value, paperless_url):
-    """Updates the document with the generated summary in the custom field."""
+def build_document_update(doc_info, title=None, metadata_ids=None, created_date=None, custom_field_id=None, custom_field_value=None):
+    """Builds the PATCH body for a document, leaving out every field that already has the wanted value.
+
+    The new tags are added to the document's current ones, so tags assigned by Paperless or by hand are kept.
+    """
+    update = {}
+    if title and title != doc_info.get("title"):
+        update["title"] = title
+    if metadata_ids:
+        current_tags = doc_info.get("tags") or []
+        added_tags = [tag_id for tag_id in metadata_ids["tags"] if tag_id not in current_tags]
+        if added_tags:
+            update["tags"] = current_tags + added_tags
+        for field in ("correspondent", "document_type"):
+            if metadata_ids[field] != doc_info.get(field):
+                update[field] = metadata_ids[field]
+    if created_date and created_date != get_document_created_date(doc_info):
+        update["created_date"] = created_date
+    if custom_field_id:
+        # custom_fields is replaced as a whole, so keep the values of all other fields
+        current = doc_info.get("custom_fields") or []
+        if {"field": custom_field_id, "value": custom_field_value} not in current:
+            update["custom_fields"] = [f for f in current if f.get("field") != custom_field_id]
+            update["custom_fields"].append({"field": custom_field_id, "value": custom_field_value})
+    return update
+
+def update_document(sess, doc_pk, update, paperless_url):
+    """Writes all changes of a document with a single PATCH, or does nothing if there are none. Returns False on errors."""
+    if not update:
+        logging.info(f"document {doc_pk} is already up to date")
+        return True
     url = paperless_url + f"/api/documents/{doc_pk}/"
-    body = {
-        "custom_fields": [{"field": custom_field_id, "value": summary_value}]
-    }
-    resp = make_request(sess, url, "PATCH", body=body)
+    resp = make_request(sess, url, "PATCH", body=update)
     if not resp:
-        logging.error(f"could not update document {doc_pk} with custom field {custom_field_id} and value {summary_value}")
-    else:
-        logging.info(f"updated document {doc_pk} with summary: {summary_value}")
-
-def process_single_document(
-        sess,
-        doc_pk,
-        doc_title,
-        doc_contents,
-        paperless_url,
-        openai_model,
-        openai_key,
-        openai_base_url,
-        username=None,
-        dry_run=False):
-    """Processes a single document: generates a title, tags, correspondent, document_type, summary, and handles created_date logic."""
-    
-    # Get document information, including created date
-    doc_info = get_single_document(sess, doc_pk, paperless_url)
-    if not doc_info:
-        logging.error(f"could not retrieve document info for document {doc_pk}")
-        return
-
-    # Get the owner_id based on the username, if provided
-    owner_id = None
-    if username:
-        owner_id = get_owner_id(sess, username, paperless_url)
-
-    # Call OpenAI to generate title, tags, correspondent, created_date, document_type, and summary
-    response = generate_title_tags_correspondent_and_type(doc_contents, openai_model, openai_key, openai_base_url)
+        logging.error(f"could not update document {doc_pk} with {update}")
+        return False
+    logging.info(f"updated document {doc_pk} with {update}")
+    return True
+
+def interpret_response(doc_info, response):
+    """Parses and logs the OpenAI answer for a document.
+
+    Returns (title, tags, correspondent, document_type, created_date, summary), with created_date only set if
+    it should replace the one in Paperless, or None if the answer is unusable. Title and summary are empty for
+    an answer only assigning metadata.
+    """
+    doc_pk = doc_info["id"]
     if not response:
         logging.error(f"could not generate title, tags, correspondent, document_type, or summary for document {doc_pk}")
-        return
+        return None
     
     # Parse response from OpenAI
     title, explain, tags, correspondent, openai_created_date, document_type, summary = parse_response(response)
-    if not title or not summary:
+    if title is None:
         logging.error(f"could not parse response for document {doc_pk}: {response}")
-        return
+        return None
     
     # Use the title from OpenAI directly, without adding the date
-    logging.info(f"will update document {doc_pk} title from {doc_title} to: {title} because {explain}, with tags {tags}, correspondent {correspondent}, document type {document_type}, and summary {summary}")
+    if title:
+        logging.info(f"will update document {doc_pk} title from {doc_info['title']} to: {title} because {explain}, with tags {tags}, correspondent {correspondent}, document type {document_type}, and summary {summary}")
+    else:
+        # only metadata reused from similar documents, title and summary stay as they are
+        logging.info(f"will update document {doc_pk} because {explain}, with tags {tags}, correspondent {correspondent}, and document type {document_type}")
 
-    # Update the document title, tags, correspondent, and document type
-    if not dry_run:
-        update_document_title_tags_correspondent_and_type(sess, doc_pk, title, tags, correspondent, document_type, owner_id, paperless_url)
-    
     # Handle the created_date logic
-    paperless_created_date = get_document_created_date(doc_info)
+    created_date = None
     if openai_created_date:
-        update_document_created_date_if_earlier(sess, doc_pk, openai_created_date, paperless_created_date, paperless_url)
+        created_date = select_created_date(openai_created_date, get_document_created_date(doc_info))
+    return title, tags, correspondent, document_type, created_date, summary
+
+def reuse_answer(ctx, doc_info):
+    """Returns the answer of a near duplicate or the metadata of similar documents, or None if there is none."""
+    return reuse_duplicate(doc_info) or classify_from_neighbours(ctx, doc_info)
+
+def process_single_document(ctx, doc_info, reuse=True):
+    """Processes a single already fetched document: generates a title, tags, correspondent, document_type, summary, and handles created_date logic.
+
+    Without reuse, the answers of duplicates and similar documents are not looked up, as a caller already did.
+    Returns True if the document was processed and False if it failed.
+    """
+    with METRICS.stage("document"):
+        # Call OpenAI to generate title, tags, correspondent, created_date, document_type, and summary
+        with METRICS.stage("generate"):
+            response = ((reuse and reuse_answer(ctx, doc_info))
+                        or generate_title_tags_correspondent_and_type(ctx, doc_info["content"], early_resolution(ctx)))
+        return apply_response(ctx, doc_info, response)
+
+def apply_response(ctx, doc_info, response):
+    """Writes the title, tags, correspondent, document_type, created_date and summary from an OpenAI answer to the document."""
+    processed = write_response(ctx, doc_info, response)
+    METRICS.inc("documents_total", result="processed" if processed else "failed")
+    return processed
+
+def write_response(ctx, doc_info, response):
+    doc_pk = doc_info["id"]
+    result = interpret_response(doc_info, response)
+    if not result:
+        return False
+    title, tags, correspondent, document_type, created_date, summary = result
+
+    if ctx.dry_run:
+        logging.info(f"dry run, not updating document {doc_pk}")
+        return True
+
+    # Title, tags, correspondent and document type are only written together
+    with METRICS.stage("resolve_metadata"):
+        metadata_ids = resolve_metadata_ids(ctx, doc_pk, tags, correspondent, document_type)
+    if not metadata_ids:
+        title = None
 
     # Check if the custom field 'summary' exists, create if it doesn't
-    summary_field_id = get_or_create_custom_field(sess, "summary", paperless_url)
-    if not summary_field_id:
-        logging.error(f"could not create or retrieve custom field 'summary' for document {doc_pk}")
-        return
+    summary_field_id = None
+    if summary:
+        with METRICS.stage("custom_field"):
+            summary_field_id = get_or_create_custom_field(ctx.sess, "summary", ctx.paperless_url)
+        if not summary_field_id:
+            logging.error(f"could not create or retrieve custom field 'summary' for document {doc_pk}")
 
-    # Update the document with the generated summary
-    if not dry_run:
-        update_document_with_custom_fields(sess, doc_pk, summary_field_id, summary, paperless_url)
+    if metadata_ids and ctx.bulk_committer:
+        ctx.bulk_committer.add(ctx.sess, doc_info, metadata_ids)
+        metadata_ids = None
+
+    update = build_document_update(doc_info, title, metadata_ids, created_date, summary_field_id, summary)
+    with METRICS.stage("update"):
+        updated = update_document(ctx.sess, doc_pk, update, ctx.paperless_url)
+    if updated:
+        recorded = recorded_answer(response)
+        record_document(doc_info, recorded)
+        record_processed(doc_info, recorded)
+    return updated
 
 def get_single_document(sess, doc_pk, paperless_url):
     """Retrieves the content of a single document."""
     url = paperless_url + f"/api/documents/{doc_pk}/"
     return make_request(sess, url, "GET")
 
-def run_for_document(doc_pk):
+def run_for_document(doc_pk, dry_run=False):
     """Runs the process for a single document."""
     check_args(doc_pk)
 
@@ -230,21 +490,12 @@ def run_for_document(doc_pk):
             logging.error(f"could not retrieve document info for document {doc_pk}")
             return
 
-        doc_contents = doc_info["content"]
-        doc_title = doc_info["title"]
-
-        process_single_document(
-            sess,
-            doc_pk,
-            doc_title,
-            doc_contents,
-            PAPERLESS_URL,
-            OPENAPI_MODEL,
-            OPENAI_API_KEY,
-            OPENAI_BASEURL,
-            OWNER_NAME,
-            DRY_RUN
-        )
+        ctx = ProcessingContext(sess, PAPERLESS_URL, OPENAPI_MODEL, OPENAI_API_KEY, OPENAI_BASEURL,
+                                username=OWNER_NAME, dry_run=dry_run)
+        try:
+            process_single_document(ctx, doc_info)
+        finally:
+            ctx.close()
 
 def get_owner_id(sess, username, paperless_url):
     """Retrieves the owner ID based on the username from the Paperless API."""
@@ -266,11 +517,12 @@ def set_auth_tokens(session: requests.Session, api_key):
     )
 
 if __name__ == '__main__':
-    LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO').upper()
-    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
-                        datefmt='%m/%d/%Y %I:%M:%S %p',
-                        level=LOGLEVEL)
+    configure_logging()
     DRY_RUN = strtobool(os.getenv("DRY_RUN", "false"))
     if DRY_RUN:
         logging.info("DRY_RUN ENABLED")
-    run_for_document(os.getenv("DOCUMENT_ID"))
+    configure_result_cache()
+    configure_cascade()
+    configure_duplicates()
+    run_for_document(os.getenv("DOCUMENT_ID"), DRY_RUN)
+    USAGE.log_summary()
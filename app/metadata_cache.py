@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import threading
+import time
+
+from cfg import METADATA_CACHE_TTL, FUZZY_MATCH_THRESHOLD
+from fuzzy_index import TrigramIndex
+from helpers import make_request
+from pool import run_concurrently
+
+LIST_PAGE_SIZE = 1000
+
+
+class MetadataCache:
+    """Case-insensitive name to id lookups for one Paperless collection such as tags or correspondents.
+
+    The whole collection is preloaded once with a paginated listing and then answered locally.
+    Objects created by this process are added with add(); the cache reloads after ttl seconds (0 keeps it
+    for the lifetime of the process) or after invalidate(). single_flight() lets concurrent get-or-create calls
+    for the same name share one lookup and create. With a fuzzy_threshold, match() also maps spelling variants
+    onto the most similar cached name.
+    """
+
+    def __init__(self, endpoint, ttl=METADATA_CACHE_TTL, fuzzy_threshold=0):
+        self.endpoint = endpoint
+        self.ttl = ttl
+        self.fuzzy_threshold = fuzzy_threshold
+        self._index = None
+        self._lock = threading.Lock()
+        self._async_lock = None
+        self._ids = None
+        self._paperless_url = None
+        self._loaded_at = 0.0
+        self._flight_lock = threading.Lock()
+        self._flights = {}
+        self._async_flights = {}
+
+    @staticmethod
+    def _key(name):
+        return name.strip().lower()
+
+    def is_fresh(self, paperless_url):
+        if self._ids is None or self._paperless_url != paperless_url:
+            return False
+        return not self.ttl or time.monotonic() - self._loaded_at < self.ttl
+
+    def load(self, sess, paperless_url):
+        """Loads the collection unless a fresh copy is cached. Returns False if it could not be listed."""
+        if self.is_fresh(paperless_url):
+            return True
+        with self._lock:
+            if self.is_fresh(paperless_url):
+                return True
+            ids = {}
+            url = paperless_url + f"/api/{self.endpoint}/"
+            params = {"page_size": LIST_PAGE_SIZE}
+            while url:
+                response = make_request(sess, url, "GET", params=params)
+                url = self._read_page(response, ids)
+                if url is False:
+                    return False
+                params = None
+            return self._store(ids, paperless_url)
+
+    async def load_async(self, client, paperless_url):
+        """Same as load() using an AsyncPaperlessClient. Concurrent callers wait for a single listing."""
+        if self.is_fresh(paperless_url):
+            return True
+        if self._async_lock is None:
+            self._async_lock = asyncio.Lock()
+        async with self._async_lock:
+            if self.is_fresh(paperless_url):
+                return True
+            ids = {}
+            url = paperless_url + f"/api/{self.endpoint}/"
+            params = {"page_size": LIST_PAGE_SIZE}
+            while url:
+                response = await client.request(url, "GET", params=params)
+                url = self._read_page(response, ids)
+                if url is False:
+                    return False
+                params = None
+            with self._lock:
+                return self._store(ids, paperless_url)
+
+    def _read_page(self, response, ids):
+        """Adds one listed page to ids. Returns the next page URL, or False if the listing failed."""
+        if not response or not isinstance(response, dict):
+            logging.error(f"could not list {self.endpoint}")
+            return False
+        for item in response.get("results", []):
+            ids.setdefault(self._key(item["name"]), item["id"])
+        return response.get("next")
+
+    def _store(self, ids, paperless_url):
+        self._ids = ids
+        self._index = None
+        if self.fuzzy_threshold:
+            self._index = TrigramIndex(self.fuzzy_threshold)
+            for name, obj_id in ids.items():
+                self._index.add(name, obj_id)
+        self._paperless_url = paperless_url
+        self._loaded_at = time.monotonic()
+        logging.info(f"cached {len(ids)} {self.endpoint}")
+        return True
+
+    def get(self, name):
+        """Returns the cached id for name, or None if it is unknown."""
+        ids = self._ids
+        if ids is None:
+            return None
+        return ids.get(self._key(name))
+
+    def match(self, name):
+        """Returns the cached id for name, or for the most similar cached name if it scores above fuzzy_threshold."""
+        obj_id = self.get(name)
+        index = self._index
+        if obj_id or index is None or self._ids is None:
+            return obj_id
+        best = index.best(name)
+        if best is None:
+            return None
+        obj_id, matched, score = best
+        logging.info(f"using existing {self.endpoint} entry {matched} for {name} (similarity {score:.2f})")
+        return obj_id
+
+    def add(self, name, obj_id):
+        with self._lock:
+            if self._ids is not None:
+                self._ids[self._key(name)] = obj_id
+                if self._index is not None:
+                    self._index.add(self._key(name), obj_id)
+
+    def invalidate(self):
+        """Drops the cached listing, so the next lookup lists the collection again.
+
+        Called when a create conflicts with an existing name or gets no answer: the name may have been created
+        outside of this process, so the cached listing cannot be trusted anymore.
+        """
+        with self._lock:
+            self._ids = None
+            self._index = None
+
+    def single_flight(self, name, resolve):
+        """Returns resolve(), unless a call for the same normalized name is already running in another thread.
+
+        Then it waits for that call and returns its result instead, so two documents producing the same new
+        name create it once instead of racing to create duplicates.
+        """
+        key = self._key(name)
+        with self._flight_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            return flight.result
+        try:
+            flight.result = resolve()
+        finally:
+            with self._flight_lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    async def single_flight_async(self, name, resolve):
+        """Same as single_flight() for coroutine functions running on one event loop."""
+        key = self._key(name)
+        task = self._async_flights.get(key)
+        if task is None:
+            task = self._async_flights[key] = asyncio.ensure_future(resolve())
+            task.add_done_callback(lambda _: self._async_flights.pop(key, None))
+        # shielded so a cancelled waiter does not cancel the lookup the others are waiting for
+        return await asyncio.shield(task)
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+TAG_CACHE = MetadataCache("tags", fuzzy_threshold=FUZZY_MATCH_THRESHOLD)
+CORRESPONDENT_CACHE = MetadataCache("correspondents", fuzzy_threshold=FUZZY_MATCH_THRESHOLD)
+DOCUMENT_TYPE_CACHE = MetadataCache("document_types", fuzzy_threshold=FUZZY_MATCH_THRESHOLD)
+CUSTOM_FIELD_CACHE = MetadataCache("custom_fields")
+
+
+def invalidate_all():
+    for cache in (TAG_CACHE, CORRESPONDENT_CACHE, DOCUMENT_TYPE_CACHE, CUSTOM_FIELD_CACHE):
+        cache.invalidate()
+
+
+def load_all(sess, paperless_url, caches=(TAG_CACHE, CORRESPONDENT_CACHE, DOCUMENT_TYPE_CACHE)):
+    """Loads the listings of all caches that are not fresh in parallel, so they cost one round trip instead of one each."""
+    stale = [cache for cache in caches if not cache.is_fresh(paperless_url)]
+    run_concurrently([lambda cache_sess, cache=cache: cache.load(cache_sess, paperless_url) for cache in stale], sess)
+
+
+async def load_all_async(client, paperless_url, caches=(TAG_CACHE, CORRESPONDENT_CACHE, DOCUMENT_TYPE_CACHE)):
+    """Same as load_all() using an AsyncPaperlessClient."""
+    await asyncio.gather(*(cache.load_async(client, paperless_url) for cache in caches
+                           if not cache.is_fresh(paperless_url)))
+
+
+def unique_names(names):
+    """Returns the non-empty names without duplicates under the cache's normalization, in their original order."""
+    unique = {}
+    for name in names:
+        if name and name.strip():
+            unique.setdefault(MetadataCache._key(name), name)
+    return list(unique.values())
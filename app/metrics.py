@@ -0,0 +1,210 @@
+import json
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from resilience import RETRY_COUNTS
+
+PREFIX = "paperless_ai_"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float("inf"))
+NUMERIC_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observed values, as in Prometheus."""
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimates a quantile by interpolating within the bucket it falls into."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(BUCKETS, self.counts):
+            if seen + count >= rank and count:
+                if bound == float("inf"):
+                    return lower
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return lower
+
+
+class Metrics:
+    """Thread safe registry of labelled counters and latency histograms."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def stage(self, stage):
+        """Times one stage of processing a document."""
+        return self.timer("stage_seconds", stage=stage)
+
+    def summary(self):
+        """Returns all metrics as plain data, histograms reduced to count, mean and estimated p50/p95/p99."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (h.count, h.sum, h.quantile(0.5), h.quantile(0.95), h.quantile(0.99))
+                          for key, h in self._histograms.items()}
+        result = {"counters": {}, "latency_seconds": {}}
+        for (name, labels), value in sorted(counters.items()):
+            result["counters"].setdefault(name, []).append({**dict(labels), "value": value})
+        for (name, labels), (count, total, p50, p95, p99) in sorted(histograms.items()):
+            result["latency_seconds"].setdefault(name, []).append({
+                **dict(labels), "count": count, "mean": round(total / count, 4) if count else 0.0,
+                "p50": round(p50, 4), "p95": round(p95, 4), "p99": round(p99, 4),
+            })
+        return result
+
+    def render_prometheus(self, extra_counters=None):
+        """Renders all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(h.counts), h.sum, h.count) for key, h in self._histograms.items()}
+        for name, values in (extra_counters or {}).items():
+            for labels, value in values.items():
+                counters[(name, labels)] = value
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {PREFIX}{name} counter")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{PREFIX}{name}{_labels(labels)} {value}")
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+            for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(BUCKETS, counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{PREFIX}{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{PREFIX}{name}_sum{_labels(labels)} {total}")
+                lines.append(f"{PREFIX}{name}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = (f'{key}="{_escape(value)}"' for key, value in labels)
+    return "{" + ",".join(pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def endpoint_label(url):
+    """Reduces a URL to its path with IDs replaced, e.g. /api/documents/{id}/, to keep label cardinality low."""
+    return NUMERIC_SEGMENT.sub("/{id}", urlsplit(url).path) or "/"
+
+
+METRICS = Metrics()
+
+
+def record_request(service, method, url, status, seconds):
+    """Records the latency and outcome of one HTTP attempt; status is the response code or "error"."""
+    endpoint = endpoint_label(url)
+    METRICS.observe("request_seconds", seconds, service=service, method=method.upper(), endpoint=endpoint)
+    METRICS.inc("requests_total", service=service, method=method.upper(), endpoint=endpoint, status=status)
+
+
+@contextmanager
+def timed_request(service, method, url):
+    """Records a call made through an SDK, taking the status from the raised error if there is one."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        record_request(service, method, url, getattr(e, "status_code", None) or "error", time.perf_counter() - start)
+        raise
+    record_request(service, method, url, 200, time.perf_counter() - start)
+
+
+def log_json_summary(path=None):
+    """Logs the metrics summary as JSON, and writes it to path if given."""
+    summary = METRICS.summary()
+    summary["counters"]["retries_total"] = [{"endpoint": name, "value": count}
+                                            for name, count in sorted(RETRY_COUNTS.snapshot().items())]
+    text = json.dumps(summary, indent=2, sort_keys=True)
+    logging.info(f"metrics summary: {json.dumps(summary, sort_keys=True)}")
+    if path:
+        with open(path, "w") as f:
+            f.write(text)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        retries = {(("endpoint", name),): count for name, count in RETRY_COUNTS.snapshot().items()}
+        body = METRICS.render_prometheus({"retries_total": retries}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_metrics_server(port, host="0.0.0.0"):
+    """Serves /metrics in the Prometheus text format from a background thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,124 @@
+import json
+import logging
+
+from cfg import PROMPT, PACK_MAX_DOCUMENTS, PACK_MAX_DOCUMENT_TOKENS
+from metrics import METRICS
+from main import (apply_response, build_messages, lookup_cached_answer, parse_response, query_openai, process_single_document,
+                  reuse_answer)
+from result_cache import cache_key, store_answer
+from token_budget import count_tokens, normalize_whitespace
+
+PACK_INSTRUCTIONS = """
+
+===Multiple Documents
+The context contains several independent documents. Each one starts with a line `=== Document <id> ===`.
+Analyze every document on its own, following the guidelines above. Respond with a JSON object of the form
+{"documents": [{"document_id": <id>, ...the response format above...}, ...]} with exactly one entry per document.
+"""
+
+
+def is_short(doc, model, max_tokens=PACK_MAX_DOCUMENT_TOKENS):
+    content = doc.get("content") or ""
+    # cheap upper bound first, tokens are never shorter than one character
+    return len(content) <= max_tokens or count_tokens(content, model) <= max_tokens
+
+
+def pack_documents(documents, model, max_documents=PACK_MAX_DOCUMENTS, max_tokens=PACK_MAX_DOCUMENT_TOKENS):
+    """Groups short documents into lists of up to max_documents. Every other document is yielded as a list of one."""
+    pack = []
+    for doc in documents:
+        if not is_short(doc, model, max_tokens):
+            yield [doc]
+            continue
+        pack.append(doc)
+        if len(pack) >= max_documents:
+            yield pack
+            pack = []
+    if pack:
+        yield pack
+
+
+def build_packed_messages(documents):
+    parts = [f"=== Document {doc['id']} ===\n{normalize_whitespace(doc['content'] or '')}" for doc in documents]
+    return [
+        {"role": "system", "content": PROMPT + PACK_INSTRUCTIONS},
+        {"role": "user", "content": "\n\n".join(parts)}
+    ]
+
+
+def split_packed_response(response):
+    """Splits a packed answer into {document id: answer}, each answer in the single document format parse_response reads."""
+    try:
+        entries = json.loads(response)["documents"]
+    except Exception:
+        return {}
+    answers = {}
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        try:
+            doc_pk = int(entry.pop("document_id"))
+        except (KeyError, TypeError, ValueError):
+            continue
+        answers[doc_pk] = json.dumps(entry)
+    return answers
+
+
+def generate_for_documents(ctx, documents):
+    """Generates answers for several short documents with one request.
+
+    Returns {document id: answer}. Cached documents are answered from the cache, and every new answer is cached
+    under the same key a single document request would use.
+    """
+    answers, keys, missing = {}, {}, []
+    for doc in documents:
+        key = cache_key(ctx.openai_model, build_messages(ctx.openai_model, doc["content"]))
+        answer, skip = lookup_cached_answer(key)
+        if answer:
+            answers[doc["id"]] = answer
+        elif not skip:
+            keys[doc["id"]] = key
+            missing.append(doc)
+    if not missing:
+        return answers
+
+    response = query_openai(ctx.openai_client, model=ctx.openai_model, messages=build_packed_messages(missing))
+    try:
+        packed = split_packed_response(response.choices[0].message.content)
+    except Exception:
+        packed = {}
+    for doc_pk, answer in packed.items():
+        if doc_pk in keys and parse_response(answer)[0]:
+            store_answer(keys[doc_pk], answer)
+            answers[doc_pk] = answer
+    return answers
+
+
+def process_documents(ctx, documents):
+    """Processes a pack of documents with one request, falling back to single requests for documents left unanswered.
+
+    Near duplicates and documents classified from similar ones get their reused answer first, only the others
+    are sent. Returns {document id: whether it was processed}.
+    """
+    results, left = {}, []
+    for doc in documents:
+        with METRICS.stage("generate"):
+            reused = reuse_answer(ctx, doc)
+        if reused:
+            results[doc["id"]] = apply_response(ctx, doc, reused)
+        else:
+            left.append(doc)
+    if len(left) == 1:
+        results[left[0]["id"]] = process_single_document(ctx, left[0], reuse=False)
+    if len(left) <= 1:
+        return results
+    logging.info(f"processing documents {[doc['id'] for doc in left]} with one request")
+    with METRICS.stage("generate_packed"):
+        answers = generate_for_documents(ctx, left)
+    for doc in left:
+        if doc["id"] in answers:
+            results[doc["id"]] = apply_response(ctx, doc, answers[doc["id"]])
+        else:
+            logging.info(f"no answer for document {doc['id']} in the packed response, processing it on its own")
+            results[doc["id"]] = process_single_document(ctx, doc, reuse=False)
+    return results
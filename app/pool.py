@@ -0,0 +1,112 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# threads of the pool shared by all run_concurrently() calls
+CONCURRENT_WORKERS = 32
+
+
+def run_bounded(items, fn, workers, max_pending=None):
+    """Calls fn(item) for every item on a pool of worker threads.
+
+    At most max_pending items (default: twice the number of workers) are submitted but not yet finished,
+    so items are pulled lazily from the iterable and a long input never sits in memory as a whole.
+    Exceptions raised by fn are logged and do not stop the remaining items.
+    """
+    if workers <= 1:
+        for item in items:
+            _call(fn, item)
+        return
+
+    pending = threading.BoundedSemaphore(max_pending or workers * 2)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            pending.acquire()
+            future = executor.submit(_call, fn, item)
+            future.add_done_callback(lambda _: pending.release())
+
+
+def run_concurrently(fns, sess=None):
+    """Calls every function in fns concurrently and returns their results in order.
+
+    Meant for a handful of independent Paperless calls that would otherwise wait for each other. The first
+    function runs on the calling thread, the others on a long-lived pool shared by all calls; one still queued
+    when the calling thread is done runs there too, so nested calls cannot wait for each other forever. With
+    sess, every function is called with a session: the first with sess, the others with a session of their
+    pool thread carrying the same headers.
+    """
+    if not fns:
+        return []
+    rest = [_executor().submit(_call_with_session, fn, sess, True) for fn in fns[1:]]
+    results = [_call_with_session(fns[0], sess)]
+    for fn, future in zip(fns[1:], rest):
+        results.append(_call_with_session(fn, sess) if future.cancel() else future.result())
+    return results
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_local = threading.local()
+
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=CONCURRENT_WORKERS, thread_name_prefix="concurrent")
+        return _pool
+
+
+def _call_with_session(fn, sess, pooled=False):
+    if sess is None:
+        return fn()
+    return fn(thread_session(sess) if pooled else sess)
+
+
+def thread_session(sess):
+    """The calling thread's own session with the headers of sess, requests.Session not being thread safe."""
+    sessions = _local.__dict__.setdefault("sessions", {})
+    key = tuple(sorted(sess.headers.items()))
+    thread_sess = sessions.get(key)
+    if thread_sess is None:
+        thread_sess = sessions[key] = requests.Session()
+        thread_sess.headers.update(sess.headers)
+    return thread_sess
+
+
+def _call(fn, item):
+    try:
+        fn(item)
+    except Exception:
+        logging.exception(f"unhandled error while processing {item!r:.80}")
+
+
+class ThreadContexts:
+    """Gives every worker thread its own copy of a ProcessingContext with a separate Paperless session.
+
+    requests.Session is not guaranteed to be thread safe, while the OpenAI client is and stays shared.
+    new_session is called once per thread and must return an authenticated session.
+    """
+
+    def __init__(self, ctx, new_session):
+        self.ctx = ctx
+        self._new_session = new_session
+        self._local = threading.local()
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        if not hasattr(self._local, "ctx"):
+            sess = self._new_session()
+            with self._lock:
+                self._sessions.append(sess)
+            self._local.ctx = self.ctx.for_session(sess)
+        return self._local.ctx
+
+    def close(self):
+        with self._lock:
+            for sess in self._sessions:
+                sess.close()
+            self._sessions.clear()
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+
+
+class RateLimiter:
+    """Caps concurrent calls to an endpoint and paces them by requests per second and tokens per minute.
+
+    Any limit left as None (or 0) is not enforced.
+    """
+
+    def __init__(self, name, max_concurrency=None, requests_per_second=None, tokens_per_minute=None):
+        self.name = name
+        self._lock = threading.Lock()
+        self.configure(max_concurrency, requests_per_second, tokens_per_minute)
+
+    def configure(self, max_concurrency=None, requests_per_second=None, tokens_per_minute=None):
+        """Replaces the limits. Must not be called while calls are in flight."""
+        with self._lock:
+            self.max_concurrency = max_concurrency or None
+            self.requests_per_second = requests_per_second or None
+            self.tokens_per_minute = tokens_per_minute or None
+            self._slots = threading.BoundedSemaphore(self.max_concurrency) if self.max_concurrency else None
+            self._async_slots = weakref.WeakKeyDictionary()
+            now = time.monotonic()
+            self._request_allowance = float(self.requests_per_second or 0)
+            self._token_allowance = float(self.tokens_per_minute or 0)
+            self._last_refill = now
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        if self.requests_per_second:
+            self._request_allowance = min(float(self.requests_per_second),
+                                          self._request_allowance + elapsed * self.requests_per_second)
+        if self.tokens_per_minute:
+            self._token_allowance = min(float(self.tokens_per_minute),
+                                        self._token_allowance + elapsed * self.tokens_per_minute / 60.0)
+
+    def _reserve(self, tokens):
+        """Takes budget for one call if available. Returns 0, or the seconds to wait before trying again."""
+        if not self.requests_per_second and not self.tokens_per_minute:
+            return 0.0
+        if self.tokens_per_minute:
+            # a single request larger than the whole minute budget would otherwise wait forever
+            tokens = min(tokens, self.tokens_per_minute)
+        with self._lock:
+            self._refill(time.monotonic())
+            wait = 0.0
+            if self.requests_per_second and self._request_allowance < 1:
+                wait = max(wait, (1 - self._request_allowance) / self.requests_per_second)
+            if self.tokens_per_minute and self._token_allowance < tokens:
+                wait = max(wait, (tokens - self._token_allowance) * 60.0 / self.tokens_per_minute)
+            if wait <= 0:
+                if self.requests_per_second:
+                    self._request_allowance -= 1
+                if self.tokens_per_minute:
+                    self._token_allowance -= tokens
+            return wait
+
+    @contextmanager
+    def limit(self, tokens=0):
+        """Blocks until a call with the given token cost may start, and holds a concurrency slot while it runs."""
+        slots = self._slots
+        if slots:
+            slots.acquire()
+        try:
+            while (wait := self._reserve(tokens)) > 0:
+                logging.debug(f"{self.name} rate limit reached, waiting {wait:.2f}s")
+                time.sleep(wait)
+            yield
+        finally:
+            if slots:
+                slots.release()
+
+    @asynccontextmanager
+    async def limit_async(self, tokens=0):
+        """Same as limit() for coroutines, waiting without blocking the event loop.
+
+        Concurrency is capped separately from threaded callers, per event loop.
+        """
+        slots = None
+        if self.max_concurrency:
+            loop = asyncio.get_running_loop()
+            slots = self._async_slots.get(loop)
+            if slots is None:
+                slots = self._async_slots[loop] = asyncio.Semaphore(self.max_concurrency)
+        if slots:
+            await slots.acquire()
+        try:
+            while (wait := self._reserve(tokens)) > 0:
+                logging.debug(f"{self.name} rate limit reached, waiting {wait:.2f}s")
+                await asyncio.sleep(wait)
+            yield
+        finally:
+            if slots:
+                slots.release()
+
+
+PAPERLESS_LIMITER = RateLimiter("paperless")
+OPENAI_LIMITER = RateLimiter("openai")
+
+
+def configure_limits(paperless_concurrency=None, paperless_rps=None,
+                     openai_concurrency=None, openai_rps=None, openai_tpm=None):
+    """Configures the shared Paperless and OpenAI limiters."""
+    PAPERLESS_LIMITER.configure(paperless_concurrency, paperless_rps)
+    OPENAI_LIMITER.configure(openai_concurrency, openai_rps, openai_tpm)
+
+
+def estimate_tokens(messages):
+    """Rough token estimate for a list of chat messages (about four characters per token)."""
+    return sum(len(message.get("content") or "") for message in messages) // 4
@@ -0,0 +1,224 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from email.utils import parsedate_to_datetime
+
+from cfg import (RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY, BREAKER_FAILURE_THRESHOLD,
+                 BREAKER_COOLDOWN)
+
+# methods that can be repeated without changing the result; POST creates are re-checked instead
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "PATCH", "DELETE")
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+# how Paperless words the 400 it answers a create with when the name is taken
+CONFLICT_MARKERS = ("already exists", "unique constraint")
+
+
+class RejectedRequest(Exception):
+    """Raised for a request Paperless rejected as invalid, which would be rejected the same way again."""
+
+
+def is_rejected(status, text):
+    """True for a 4xx response that is neither retried nor a conflict with an existing object of the same name."""
+    if not 400 <= status < 500 or status in RETRY_STATUSES or status == 409:
+        return False
+    return not any(marker in (text or "").lower() for marker in CONFLICT_MARKERS)
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, preferring the server's Retry-After when it sends one."""
+
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait after the given failed attempt (starting at 1)."""
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+def parse_retry_after(headers):
+    """Returns the Retry-After header in seconds, or None if it is missing or invalid."""
+    value = headers.get("Retry-After") if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """Pauses all callers of an endpoint after repeated consecutive failures.
+
+    Once failure_threshold calls in a row failed, callers wait in before_call() until cooldown seconds have
+    passed, so a worker pool stops hammering an endpoint that is down. The first call afterwards is a trial:
+    a success closes the circuit, another failure opens it again.
+    """
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0.0
+
+    def _remaining(self):
+        with self._lock:
+            return self._open_until - time.monotonic()
+
+    def before_call(self):
+        while (remaining := self._remaining()) > 0:
+            time.sleep(remaining)
+
+    async def before_call_async(self):
+        while (remaining := self._remaining()) > 0:
+            await asyncio.sleep(remaining)
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.failure_threshold and self._failures >= self.failure_threshold:
+                self._open_until = time.monotonic() + self.cooldown
+                self._failures = self.failure_threshold - 1
+                logging.warning(f"{self.name} keeps failing, pausing calls for {self.cooldown}s")
+                RETRY_COUNTS.add(f"{self.name}_circuit_open")
+
+
+class RetryCounter:
+    """Thread safe count of retries per endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+
+    def add(self, key, count=1):
+        with self._lock:
+            self._counts[key] += count
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+RETRY_COUNTS = RetryCounter()
+PAPERLESS_BREAKER = CircuitBreaker("paperless")
+OPENAI_BREAKER = CircuitBreaker("openai")
+DEFAULT_POLICY = RetryPolicy()
+
+
+def create_after_recheck(create, lookup):
+    """Runs a non-idempotent create once more only if a lookup shows the object still does not exist.
+
+    A failed POST may still have created the object, or another worker may have created it meanwhile. A create
+    raising RejectedRequest, such as one for an invalid name, returns None right away instead.
+    """
+    try:
+        obj_id = create()
+        if obj_id:
+            return obj_id
+        obj_id = lookup()
+        if obj_id:
+            return obj_id
+        RETRY_COUNTS.add("paperless_create")
+        return create()
+    except RejectedRequest:
+        return None
+
+
+async def create_after_recheck_async(create, lookup):
+    """Async version of create_after_recheck taking coroutine functions."""
+    try:
+        obj_id = await create()
+        if obj_id:
+            return obj_id
+        obj_id = await lookup()
+        if obj_id:
+            return obj_id
+        RETRY_COUNTS.add("paperless_create")
+        return await create()
+    except RejectedRequest:
+        return None
+
+
+def log_retry_summary():
+    counts = RETRY_COUNTS.snapshot()
+    if counts:
+        logging.info(f"retries: {counts}")
+
+
+def classify_openai_error(error):
+    """Returns (retryable, retry_after seconds) for an exception raised by the OpenAI client."""
+    import openai
+
+    if isinstance(error, openai.APIConnectionError):
+        # also covers APITimeoutError
+        return True, None
+    if isinstance(error, openai.APIStatusError) and error.status_code in RETRY_STATUSES:
+        # an exhausted quota is reported as 429 too but will not recover by waiting
+        if getattr(error, "code", None) == "insufficient_quota":
+            return False, None
+        return True, parse_retry_after(error.response.headers)
+    return False, None
+
+
+def call_with_retries(fn, name, breaker, classify, policy=DEFAULT_POLICY):
+    """Calls fn(), retrying errors that classify() marks retryable with backoff. Other errors are raised."""
+    attempt = 0
+    while True:
+        attempt += 1
+        breaker.before_call()
+        try:
+            result = fn()
+        except Exception as e:
+            retryable, retry_after = classify(e)
+            if not retryable:
+                raise
+            breaker.record_failure()
+            if attempt >= policy.max_attempts:
+                raise
+            delay = policy.delay(attempt, retry_after)
+            logging.warning(f"attempt {attempt} calling {name} failed ({e}), retrying in {delay:.1f}s")
+            RETRY_COUNTS.add(name)
+            time.sleep(delay)
+            continue
+        breaker.record_success()
+        return result
+
+
+async def call_with_retries_async(fn, name, breaker, classify, policy=DEFAULT_POLICY):
+    """Async version of call_with_retries, fn being a coroutine function."""
+    attempt = 0
+    while True:
+        attempt += 1
+        await breaker.before_call_async()
+        try:
+            result = await fn()
+        except Exception as e:
+            retryable, retry_after = classify(e)
+            if not retryable:
+                raise
+            breaker.record_failure()
+            if attempt >= policy.max_attempts:
+                raise
+            delay = policy.delay(attempt, retry_after)
+            logging.warning(f"attempt {attempt} calling {name} failed ({e}), retrying in {delay:.1f}s")
+            RETRY_COUNTS.add(name)
+            await asyncio.sleep(delay)
+            continue
+        breaker.record_success()
+        return result
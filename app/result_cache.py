@@ -0,0 +1,114 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from cfg import RESULT_CACHE_MAX_MB, RESULT_CACHE_PATH
+
+# fraction of the size limit the cache is trimmed down to once it is exceeded
+EVICT_TO = 0.9
+
+
+class ResultCache:
+    """SQLite backed store of LLM answers keyed on a hash of model, prompt and the content that was sent.
+
+    When the stored answers exceed max_bytes the least recently used ones are evicted.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, answer TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT answer FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            with self._conn:
+                self._conn.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, answer):
+        size = len(answer.encode("utf-8"))
+        with self._lock:
+            with self._conn:
+                old = self._conn.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+                self._conn.execute("INSERT OR REPLACE INTO results (key, answer, size, accessed) VALUES (?, ?, ?, ?)",
+                                   (key, answer, size, time.time()))
+            self._size += size - (old[0] if old else 0)
+            if self.max_bytes and self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        target = self.max_bytes * EVICT_TO
+        rows = self._conn.execute("SELECT key, size FROM results ORDER BY accessed").fetchall()
+        evicted = []
+        for key, size in rows:
+            if self._size <= target:
+                break
+            evicted.append((key,))
+            self._size -= size
+        with self._conn:
+            self._conn.executemany("DELETE FROM results WHERE key = ?", evicted)
+        logging.info(f"evicted {len(evicted)} cached results from {self.path}")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_cache = None
+_cache_only = False
+_refresh = False
+
+
+def configure_result_cache(path=RESULT_CACHE_PATH, max_mb=RESULT_CACHE_MAX_MB, cache_only=False, refresh=False):
+    """Opens the result cache at path (disabled when path is empty).
+
+    cache_only answers only from the cache and never calls the LLM; refresh ignores cached answers but still
+    stores the new ones.
+    """
+    global _cache, _cache_only, _refresh
+    if _cache is not None:
+        _cache.close()
+    _cache = ResultCache(path, max_mb * 1024 * 1024) if path else None
+    _cache_only = cache_only
+    _refresh = refresh
+    if cache_only and _cache is None:
+        logging.warning("cache only mode requested without a result cache, no documents will be processed")
+
+
+def cache_key(model, messages):
+    digest = hashlib.sha256(model.encode("utf-8"))
+    for message in messages:
+        digest.update(b"\0" + message["role"].encode("utf-8") + b"\0" + message["content"].encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get_cached_answer(key):
+    if _cache is None or _refresh:
+        return None
+    return _cache.get(key)
+
+
+def store_answer(key, answer):
+    if _cache is not None:
+        _cache.put(key, answer)
+
+
+def is_cache_only():
+    return _cache_only
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""Offline throughput benchmark of the post-consume script and the back-fill cli against a local stub server.
+
+Runs scripted scenarios (run_for_document per document, cli all with threads, async, packing, bulk_edit,
+injected errors and resuming a finished run) against scripts/stub_server.py and reports documents per second,
+p50/p99 latencies estimated from the metrics histograms, the requests the stub received and the bytes it sent.
+No Paperless instance or OpenAI account is needed and nothing leaves the machine.
+
+    python3 app/scripts/bench.py [--documents N] [--scenario NAME ...] [--json PATH]
+    python3 app/scripts/bench.py --baseline bench.json --tolerance 0.2
+
+With --baseline the exit status is 1 if any scenario processes fewer documents per second than the baseline
+(written earlier with --json) allows, so the benchmark can guard against performance regressions.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from stub_server import StubServer  # noqa: E402
+
+# name: (description, cli arguments for "all", or None to call run_for_document once per document)
+SCENARIOS = {
+    "single": ("post-consume run_for_document, one document at a time", None),
+    "all": ("cli all, one worker", ["all"]),
+    "all-threads": ("cli all, 8 workers", ["all", "--workers", "8"]),
+    "all-async": ("cli all --async, 32 documents in flight", ["all", "--async", "--workers", "32"]),
+    "all-pack": ("cli all --pack, 4 workers", ["all", "--pack", "--workers", "4"]),
+    "all-bulkedit": ("cli all --bulkedit, 8 workers", ["all", "--bulkedit", "--workers", "8"]),
+    "all-errors": ("cli all, 8 workers, 5% injected 503 errors", ["all", "--workers", "8"]),
+    "all-resume": ("cli all --resume after a finished run, 8 workers", ["all", "--resume", "--workers", "8"]),
+}
+ERROR_RATES = {"all-errors": 0.05}
+# run untimed before the scenario, sharing its run state
+PREPARE = {"all-resume": ["all", "--workers", "8"]}
+
+
+def configure_environment(base_url):
+    """Points the configuration at the stub. Must run before the app modules are imported, cfg reads it once."""
+    os.environ.update({
+        "PAPERLESS_URL": base_url,
+        "PAPERLESS_API_KEY": "bench",
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASEURL": base_url + "/v1",
+        "OPENAPI_MODEL": "gpt-4o-mini",
+        # keep retries of injected errors from dominating the run time
+        "RETRY_BASE_DELAY": "0.01",
+        "RETRY_MAX_DELAY": "0.1",
+    })
+    for name in ("RESULT_CACHE_PATH", "WORKER_QUEUE_PATH", "OWNER_NAME"):
+        os.environ.pop(name, None)
+
+
+def latency_ms(summary, name, **labels):
+    """Returns (p50, p99) in milliseconds of the histogram with these labels, or None if nothing was recorded."""
+    for entry in summary["latency_seconds"].get(name, []):
+        if all(entry.get(key) == value for key, value in labels.items()):
+            return entry["p50"] * 1000, entry["p99"] * 1000
+    return None
+
+
+def counter(summary, name, **labels):
+    return sum(entry["value"] for entry in summary["counters"].get(name, [])
+               if all(entry.get(key) == value for key, value in labels.items()))
+
+
+def run_scenario(name, stub, documents, state_dir):
+    # imported late, see configure_environment
+    from cli import parse_args
+    from main import run_for_document
+    from metadata_cache import invalidate_all
+    from metrics import METRICS
+    from resilience import RETRY_COUNTS
+
+    _, cli_args = SCENARIOS[name]
+    state_args = ["--runstatepath", os.path.join(state_dir, f"{name}.sqlite")]
+    stub.reset(documents)
+    stub.error_rate = ERROR_RATES.get(name, 0.0)
+    invalidate_all()
+    if name in PREPARE:
+        parse_args(["--loglevel", "WARNING"] + PREPARE[name] + state_args)
+        stub.clear_counts()
+    METRICS.reset()
+    retries_before = sum(RETRY_COUNTS.snapshot().values())
+
+    start = time.perf_counter()
+    if cli_args is None:
+        for doc_pk in range(1, documents + 1):
+            run_for_document(doc_pk)
+    else:
+        parse_args(["--loglevel", "WARNING"] + cli_args + state_args)
+    seconds = time.perf_counter() - start
+
+    summary = METRICS.summary()
+    processed = counter(summary, "documents_total", result="processed")
+    return {
+        "scenario": name,
+        "documents": documents,
+        "processed": processed,
+        "seconds": round(seconds, 3),
+        "docs_per_sec": round(processed / seconds, 2) if seconds else 0.0,
+        "bytes_sent": stub.bytes_sent,
+        "document_ms": latency_ms(summary, "stage_seconds", stage="document"),
+        "openai_ms": latency_ms(summary, "request_seconds", service="openai"),
+        "paperless_requests": sum(count for key, count in stub.requests.items() if "/chat/completions" not in key),
+        "openai_requests": sum(count for key, count in stub.requests.items() if "/chat/completions" in key),
+        "injected_errors": stub.errors,
+        "retries": sum(RETRY_COUNTS.snapshot().values()) - retries_before,
+        "requests": dict(sorted(stub.requests.items())),
+    }
+
+
+def format_ms(value):
+    return f"{value[0]:7.1f} {value[1]:7.1f}" if value else f"{'-':>7} {'-':>7}"
+
+
+def print_report(results):
+    print(f"{'scenario':<13} {'docs':>5} {'docs/s':>8} {'doc p50':>7} {'p99':>7} {'llm p50':>7} {'p99':>7} "
+          f"{'paperless':>9} {'openai':>6} {'errors':>6} {'retries':>7} {'kB sent':>8}")
+    for r in results:
+        print(f"{r['scenario']:<13} {r['processed']:>5} {r['docs_per_sec']:>8.2f} {format_ms(r['document_ms'])} "
+              f"{format_ms(r['openai_ms'])} {r['paperless_requests']:>9} {r['openai_requests']:>6} "
+              f"{r['injected_errors']:>6} {r['retries']:>7} {r['bytes_sent'] / 1000:>8.0f}")
+
+
+def check_baseline(results, path, tolerance):
+    """Returns the scenarios that are more than tolerance slower than in the baseline file."""
+    with open(path) as f:
+        baseline = {r["scenario"]: r for r in json.load(f)}
+    regressions = []
+    for r in results:
+        before = baseline.get(r["scenario"])
+        if before and r["docs_per_sec"] < before["docs_per_sec"] * (1 - tolerance):
+            regressions.append(f"{r['scenario']}: {r['docs_per_sec']:.2f} docs/s, baseline {before['docs_per_sec']:.2f}")
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--documents", type=int, default=200, help="Number of documents served by the stub")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS),
+                        help="Scenario to run, may be repeated (default: all)")
+    parser.add_argument("--paperless-latency", type=float, default=0.005, help="Seconds added to Paperless responses")
+    parser.add_argument("--openai-latency", type=float, default=0.1, help="Seconds added to chat completions")
+    parser.add_argument("--json", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run to compare docs/sec against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed relative drop in docs/sec against the baseline")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    stub = StubServer(args.documents, args.paperless_latency, args.openai_latency)
+    base_url = stub.start()
+    configure_environment(base_url)
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as state_dir:
+            for name in args.scenario or SCENARIOS:
+                if name == "all-async":
+                    try:
+                        import httpx  # noqa: F401
+                    except ImportError:
+                        print(f"skipping {name}, httpx is not installed")
+                        continue
+                results.append(run_scenario(name, stub, args.documents, state_dir))
+    finally:
+        stub.stop()
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        regressions = check_baseline(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
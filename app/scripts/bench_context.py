@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of per-document setup cost: a reused ProcessingContext against the old per-document path.
+
+The old path fetched every document twice and built a new OpenAI client (and HTTP connection pool) for every
+completion. Both paths are timed against the local stub server serving one document and an OpenAI-compatible
+chat completions endpoint, so only the client side overhead is measured. See bench.py for end-to-end throughput.
+
+    python3 app/scripts/bench_context.py [iterations]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import requests  # noqa: E402
+from openai import OpenAI  # noqa: E402
+
+from main import ProcessingContext, get_single_document, query_openai, set_auth_tokens  # noqa: E402
+from stub_server import StubServer, document_content  # noqa: E402
+
+MESSAGES = [{"role": "user", "content": document_content(1)}]
+
+
+def legacy_document(sess, base_url):
+    get_single_document(sess, 1, base_url)
+    get_single_document(sess, 1, base_url)
+    client = OpenAI(api_key="bench", base_url=base_url + "/v1")
+    query_openai(client, "bench", MESSAGES)
+
+
+def context_document(ctx):
+    get_single_document(ctx.sess, 1, ctx.paperless_url)
+    query_openai(ctx.openai_client, "bench", MESSAGES)
+
+
+def timed(fn, iterations):
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+def main(iterations):
+    stub = StubServer(documents=1)
+    base_url = stub.start()
+    try:
+        with requests.Session() as sess:
+            set_auth_tokens(sess, "bench")
+            legacy_ms = timed(lambda: legacy_document(sess, base_url), iterations)
+            ctx = ProcessingContext(sess, base_url, "bench", "bench", base_url + "/v1")
+            context_ms = timed(lambda: context_document(ctx), iterations)
+    finally:
+        stub.stop()
+    print(f"per-document client path over {iterations} iterations")
+    print(f"  legacy (double GET, new OpenAI client): {legacy_ms:.2f} ms")
+    print(f"  ProcessingContext:                      {context_ms:.2f} ms")
+    print(f"  saved per document:                     {legacy_ms - context_ms:.2f} ms")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
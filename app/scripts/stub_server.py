@@ -0,0 +1,301 @@
+"""Local stand-in for the Paperless API and an OpenAI compatible chat completions endpoint, used by the benchmarks.
+
+Serves documents, tags, correspondents, document types, custom fields and users with Paperless style pagination,
+fields= projection and id__in and modified__gt filtering, accepts creates, document PATCHes and bulk_edit, and
+answers chat completions (single and packed documents, optionally streamed) with a deterministic JSON answer.
+Every response can be delayed and a share of them replaced by 503 errors, so client side concurrency, retries and
+caching can be measured without a real Paperless or OpenAI account.
+
+    stub = StubServer(documents=500, paperless_latency=0.005, openai_latency=0.2)
+    base_url = stub.start()
+    ...
+    stub.stop()
+"""
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+COLLECTIONS = ("tags", "correspondents", "document_types", "custom_fields")
+TAGS = ["rechnung", "vertrag", "steuer", "versicherung", "bank", "auto", "haus", "gesundheit", "arbeit", "strom"]
+CORRESPONDENTS = ["Finanzamt", "Stadtwerke", "Sparkasse", "Allianz", "Telekom", "Krankenkasse", "Vermieter"]
+DOCUMENT_TYPES = ["Rechnung", "Vertrag", "Bescheid", "Brief", "Kontoauszug"]
+DOCUMENT_ID = re.compile(r"Dokument (\d+)\b")
+PACKED_ID = re.compile(r"^=== Document (\d+) ===$", re.MULTILINE)
+ID_PATH = re.compile(r"^/api/(\w+)/(\d+)/$")
+# characters of the answer per chunk of a streamed completion
+STREAM_CHUNK_CHARS = 16
+
+
+def document_content(doc_pk, words=120):
+    rng = random.Random(doc_pk)
+    body = " ".join(rng.choice(TAGS + CORRESPONDENTS + DOCUMENT_TYPES) for _ in range(words))
+    return f"Dokument {doc_pk}\nDatum: 2024-{doc_pk % 12 + 1:02d}-{doc_pk % 28 + 1:02d}\n{body}"
+
+
+def answer_for(doc_pk):
+    """The answer the stub model gives for a document, always the same for the same id."""
+    return {
+        "title": f"Dokument {doc_pk}",
+        "created_date": f"2024-{doc_pk % 12 + 1:02d}-{doc_pk % 28 + 1:02d}",
+        "tags": [TAGS[doc_pk % len(TAGS)], TAGS[(doc_pk * 7 + 3) % len(TAGS)]],
+        "correspondent": CORRESPONDENTS[doc_pk % len(CORRESPONDENTS)],
+        "document_type": DOCUMENT_TYPES[doc_pk % len(DOCUMENT_TYPES)],
+        "summary": f"Zusammenfassung von Dokument {doc_pk}",
+        "explanation": "stub answer",
+    }
+
+
+class StubServer:
+    """Threaded HTTP server holding an in-memory Paperless instance.
+
+    paperless_latency and openai_latency are the seconds every response is delayed by, error_rate the share of
+    requests answered with 503 instead. Request counts per method and endpoint are kept in requests, the size of
+    all response bodies in bytes_sent.
+    """
+
+    def __init__(self, documents=100, paperless_latency=0.0, openai_latency=0.0, error_rate=0.0, seed=0):
+        self.paperless_latency = paperless_latency
+        self.openai_latency = openai_latency
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self.reset(documents)
+
+    def reset(self, documents=None):
+        """Recreates the documents, drops all created objects and clears the request counts."""
+        with self._lock:
+            count = documents if documents is not None else len(self.documents)
+            self.documents = {pk: {"id": pk, "title": f"scan {pk}", "content": document_content(pk),
+                                   "created_date": "2024-01-01", "modified": "2024-01-01T00:00:00Z",
+                                   "tags": [], "correspondent": None, "document_type": None,
+                                   "custom_fields": []}
+                              for pk in range(1, count + 1)}
+            self.collections = {name: {} for name in COLLECTIONS}
+        self.clear_counts()
+
+    def clear_counts(self):
+        with self._lock:
+            self.requests = Counter()
+            self.errors = 0
+            self.completions = 0
+            self.bytes_sent = 0
+
+    def _sent(self, size):
+        with self._lock:
+            self.bytes_sent += size
+
+    def start(self, host="127.0.0.1", port=0):
+        """Starts serving in a background thread and returns the base URL."""
+        self._server = ThreadingHTTPServer((host, port), _StubHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        threading.Thread(target=self._server.serve_forever, name="stub-server", daemon=True).start()
+        return f"http://{host}:{self._server.server_address[1]}"
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _should_fail(self):
+        with self._lock:
+            fail = self.error_rate and self._rng.random() < self.error_rate
+            if fail:
+                self.errors += 1
+            return fail
+
+    def _count(self, method, path):
+        with self._lock:
+            self.requests[f"{method} {ID_PATH.sub(lambda m: f'/api/{m.group(1)}/{{id}}/', path)}"] += 1
+
+    def handle(self, method, path, query, body, base_url):
+        """Returns (status, payload) for one request."""
+        self._count(method, path)
+        is_openai = path.endswith("/chat/completions")
+        time.sleep(self.openai_latency if is_openai else self.paperless_latency)
+        if self._should_fail():
+            return 503, {"detail": "injected error"}
+        if is_openai and method == "POST":
+            return 200, self._completion(body)
+        if path == "/api/documents/bulk_edit/" and method == "POST":
+            return self._bulk_edit(body)
+
+        match = ID_PATH.match(path)
+        if match:
+            return self._object(method, match.group(1), int(match.group(2)), body)
+        collection = path.strip("/").split("/")[-1] if path.startswith("/api/") else None
+        if method == "GET" and collection in COLLECTIONS + ("documents", "users"):
+            return 200, self._list(collection, query, path, base_url)
+        if method == "POST" and collection in COLLECTIONS:
+            return self._create(collection, body)
+        return 404, {"detail": "not found"}
+
+    def _items(self, collection):
+        if collection == "documents":
+            return self.documents
+        if collection == "users":
+            return {1: {"id": 1, "username": "paperless"}}
+        return self.collections[collection]
+
+    def _list(self, collection, query, path, base_url):
+        with self._lock:
+            items = list(self._items(collection).values())
+        for key, values in query.items():
+            if key.endswith("__iexact"):
+                field = key[:-len("__iexact")]
+                items = [item for item in items if str(item.get(field, "")).lower() == values[0].lower()]
+            elif key == "id__in":
+                ids = {int(i) for i in values[0].split(",") if i}
+                items = [item for item in items if item["id"] in ids]
+            elif key == "modified__gt":
+                since = _parse_time(values[0])
+                items = [item for item in items if _parse_time(item["modified"]) > since]
+        page_size = int(query.get("page_size", ["25"])[0])
+        page = int(query.get("page", ["1"])[0])
+        results = items[(page - 1) * page_size:page * page_size]
+        if "fields" in query:
+            fields = query["fields"][0].split(",")
+            results = [{field: item[field] for field in fields if field in item} for item in results]
+        next_url = None
+        if page * page_size < len(items):
+            next_query = {key: values[0] for key, values in query.items()}
+            next_query["page"] = page + 1
+            next_url = f"{base_url}{path}?{urlencode(next_query)}"
+        return {"count": len(items), "next": next_url, "previous": None, "results": results}
+
+    def _create(self, collection, body):
+        name = (body or {}).get("name", "")
+        if not name.strip():
+            return 400, {"name": ["This field may not be blank."]}
+        with self._lock:
+            items = self.collections[collection]
+            # names are unique per collection in Paperless as well
+            if any(item["name"].lower() == name.lower() for item in items.values()):
+                return 400, {"name": ["An object with this name already exists."]}
+            obj = dict(body, id=len(items) + 1)
+            items[obj["id"]] = obj
+        return 201, obj
+
+    def _object(self, method, collection, pk, body):
+        with self._lock:
+            obj = self._items(collection).get(pk) if collection in COLLECTIONS + ("documents",) else None
+            if obj is None:
+                return 404, {"detail": "not found"}
+            if method == "PATCH":
+                obj.update(body or {})
+                if collection == "documents":
+                    obj["modified"] = _now()
+            elif method != "GET":
+                return 405, {"detail": "method not allowed"}
+            return 200, dict(obj)
+
+    def _bulk_edit(self, body):
+        method, params = body.get("method"), body.get("parameters", {})
+        with self._lock:
+            for pk in body.get("documents", []):
+                doc = self.documents.get(pk)
+                if not doc:
+                    continue
+                doc["modified"] = _now()
+                if method == "modify_tags":
+                    doc["tags"] = sorted((set(doc["tags"]) | set(params.get("add_tags", [])))
+                                         - set(params.get("remove_tags", [])))
+                elif method in ("set_correspondent", "set_document_type"):
+                    field = method[len("set_"):]
+                    doc[field] = params.get(field)
+        return 200, {"result": "OK"}
+
+    def _completion(self, body):
+        content = "\n".join(str(message.get("content", "")) for message in body.get("messages", [])
+                            if message.get("role") == "user")
+        packed = [int(pk) for pk in PACKED_ID.findall(content)]
+        if packed:
+            answer = {"documents": [dict(answer_for(pk), document_id=pk) for pk in packed]}
+        else:
+            match = DOCUMENT_ID.search(content)
+            answer = answer_for(int(match.group(1)) if match else 0)
+        with self._lock:
+            self.completions += 1
+        prompt_tokens = sum(len(str(message.get("content", ""))) for message in body.get("messages", [])) // 4
+        if body.get("stream"):
+            return self._chunks(body, json.dumps(answer), prompt_tokens)
+        return {
+            "id": f"stub-{self.completions}", "object": "chat.completion", "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": json.dumps(answer)}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 80,
+                      "total_tokens": prompt_tokens + 80},
+        }
+
+
+    def _chunks(self, body, content, prompt_tokens):
+        """The chunks of a streamed completion, sent as server-sent events."""
+        base = {"id": f"stub-{self.completions}", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": body.get("model", "stub")}
+        pieces = [content[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(content), STREAM_CHUNK_CHARS)]
+        chunks = [dict(base, choices=[{"index": 0, "delta": {"role": "assistant", "content": piece},
+                                       "finish_reason": None}]) for piece in pieces]
+        chunks.append(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            chunks.append(dict(base, choices=[], usage={"prompt_tokens": prompt_tokens, "completion_tokens": 80,
+                                                        "total_tokens": prompt_tokens + 80}))
+        return StreamedResponse(chunks)
+
+
+class StreamedResponse(list):
+    """Chunks the handler sends as server-sent events instead of one JSON body."""
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _parse_time(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _handle(self, method):
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            body = json.loads(raw) if raw else None
+        except ValueError:
+            body = None
+        base_url = f"http://{self.headers.get('Host')}"
+        status, payload = self.server.stub.handle(method, url.path, parse_qs(url.query), body, base_url)
+        if isinstance(payload, StreamedResponse):
+            events = [f"data: {json.dumps(chunk)}\n\n" for chunk in payload] + ["data: [DONE]\n\n"]
+            data, content_type = "".join(events).encode("utf-8"), "text/event-stream"
+        else:
+            data, content_type = json.dumps(payload).encode("utf-8"), "application/json"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.stub._sent(len(data))
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+    def log_message(self, *args):
+        pass
@@ -1,5 +1,9 @@
+import asyncio
 import logging
 from helpers import make_request
+from metadata_cache import TAG_CACHE, unique_names
+from pool import run_concurrently
+from resilience import create_after_recheck, create_after_recheck_async
 
 def generate_random_hex_color():
     """Generates a random hex color string."""
@@ -17,15 +21,23 @@ def create_new_tag(sess, tag_name, paperless_url, owner_id):
         "owner": owner_id_or_empty  # Owner is optional
     }
         
-    response = make_request(sess, url, "POST", body=body)
+    response = make_request(sess, url, "POST", body=body, raise_rejected=True)
     if not response:
         logging.error(f"could not create tag {tag_name}")
+        TAG_CACHE.invalidate()
         return None
     logging.info(f"created new tag: {tag_name} with color {body['color']}")
+    TAG_CACHE.add(tag_name, response['id'])
     return response['id']
 
 def get_existing_tag(sess, tag_name, paperless_url):
     """Checks if a tag with the exact name already exists."""
+    if TAG_CACHE.load(sess, paperless_url):
+        tag_id = TAG_CACHE.match(tag_name)
+        if tag_id:
+            logging.info(f"tag {tag_name} already exists with id {tag_id}")
+        return tag_id
+
     url = paperless_url + f"/api/tags/?name__iexact={tag_name}"
     response = make_request(sess, url, "GET")
     if not response:
@@ -38,16 +50,74 @@ def get_existing_tag(sess, tag_name, paperless_url):
     return None
 
 def get_or_create_tags(sess, tags, paperless_url, owner_id=None):
-    """Checks if tags exist; if not, creates them with random colors. Returns list of tag IDs."""
-    tag_ids = []
-    
-    for tag in tags:
-        tag_id = get_existing_tag(sess, tag, paperless_url)
+    """Checks if tags exist; if not, creates them with random colors. Returns list of tag IDs.
+
+    All names are looked up in the cached tag listing at once, and only the missing tags are created, concurrently.
+    """
+    TAG_CACHE.load(sess, paperless_url)
+    tag_ids = {tag: TAG_CACHE.match(tag) for tag in unique_names(tags)}
+    missing = [tag for tag, tag_id in tag_ids.items() if not tag_id]
+    if missing:
+        created = run_concurrently([lambda tag_sess, tag=tag: get_or_create_tag(tag_sess, tag, paperless_url, owner_id)
+                                    for tag in missing], sess)
+        tag_ids.update(zip(missing, created))
+    # spelling variants may have been mapped onto the same tag
+    return list(dict.fromkeys(tag_id for tag_id in tag_ids.values() if tag_id))
+
+def get_or_create_tag(sess, tag, paperless_url, owner_id=None):
+    """Returns the ID of the tag, creating it if needed. Concurrent calls for the same name share a single lookup and create."""
+    def resolve():
+        return get_existing_tag(sess, tag, paperless_url) or create_after_recheck(
+            lambda: create_new_tag(sess, tag, paperless_url, owner_id),
+            lambda: get_existing_tag(sess, tag, paperless_url))
+
+    return TAG_CACHE.single_flight(tag, resolve)
+
+async def create_new_tag_async(client, tag_name, paperless_url, owner_id):
+    """Async version of create_new_tag using an AsyncPaperlessClient."""
+    url = paperless_url + "/api/tags/"
+    body = {
+        "name": tag_name,
+        "color": generate_random_hex_color(),
+        "owner": owner_id or ''
+    }
+    response = await client.request(url, "POST", body=body, raise_rejected=True)
+    if not response:
+        logging.error(f"could not create tag {tag_name}")
+        TAG_CACHE.invalidate()
+        return None
+    logging.info(f"created new tag: {tag_name} with color {body['color']}")
+    TAG_CACHE.add(tag_name, response['id'])
+    return response['id']
+
+async def get_existing_tag_async(client, tag_name, paperless_url):
+    """Async version of get_existing_tag using an AsyncPaperlessClient."""
+    if await TAG_CACHE.load_async(client, paperless_url):
+        tag_id = TAG_CACHE.match(tag_name)
         if tag_id:
-            tag_ids.append(tag_id)
-        else:
-            new_tag_id = create_new_tag(sess, tag, paperless_url, owner_id)
-            if new_tag_id:
-                tag_ids.append(new_tag_id)
-    
-    return tag_ids
\ No newline at end of file
+            logging.info(f"tag {tag_name} already exists with id {tag_id}")
+        return tag_id
+
+    response = await client.request(paperless_url + "/api/tags/", "GET", params={"name__iexact": tag_name})
+    if not response:
+        logging.error(f"could not retrieve tag {tag_name}")
+        return None
+    if len(response['results']) > 0:
+        tag = response['results'][0]
+        logging.info(f"tag {tag_name} already exists with id {tag['id']}")
+        return tag['id']
+    return None
+
+async def get_or_create_tags_async(client, tags, paperless_url, owner_id=None):
+    """Async version of get_or_create_tags, resolving all tags concurrently."""
+    async def resolve(tag):
+        tag_id = await get_existing_tag_async(client, tag, paperless_url)
+        return tag_id or await create_after_recheck_async(
+            lambda: create_new_tag_async(client, tag, paperless_url, owner_id),
+            lambda: get_existing_tag_async(client, tag, paperless_url))
+
+    async def get_or_create(tag):
+        return await TAG_CACHE.single_flight_async(tag, lambda: resolve(tag))
+
+    tag_ids = await asyncio.gather(*(get_or_create(tag) for tag in unique_names(tags)))
+    return list(dict.fromkeys(tag_id for tag_id in tag_ids if tag_id))
@@ -0,0 +1,120 @@
+import re
+
+from cfg import CONTENT_TOKEN_BUDGET
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# rough characters per token for OCR text when tiktoken is not installed, German text tokenizes denser than English
+CHARS_PER_TOKEN = 3.5
+# tokens kept free for the answer
+OUTPUT_RESERVE = 1024
+
+# model prefix -> (context window in tokens, USD per 1M input tokens, USD per 1M output tokens)
+# the longest matching prefix wins
+MODELS = {
+    "gpt-4o-mini": (128000, 0.15, 0.60),
+    "gpt-4o": (128000, 2.50, 10.00),
+    "gpt-4-turbo": (128000, 10.00, 30.00),
+    "gpt-4-32k": (32768, 60.00, 120.00),
+    "gpt-4": (8192, 30.00, 60.00),
+    "gpt-3.5-turbo": (16385, 0.50, 1.50),
+}
+# unknown models, e.g. local ones behind an OpenAI compatible endpoint
+DEFAULT_MODEL = (8192, 0.0, 0.0)
+
+# part of the budget spent on the start of the document, date-bearing lines from the middle, and the end
+HEAD_SHARE = 0.5
+DATES_SHARE = 0.2
+GAP = " [...] "
+
+WHITESPACE = re.compile(r"\s+")
+MONTHS = r"(?:jan|feb|m[äa]r|apr|ma[iy]|jun|jul|aug|sep|o[ck]t|nov|de[cz])[a-zä]*"
+DATE = re.compile(
+    r"\b(?:\d{1,2}[./-]\d{1,2}[./-]\d{2,4}|\d{4}-\d{2}-\d{2}|\d{1,2}\.?\s+" + MONTHS + r"\s+\d{4})\b",
+    re.IGNORECASE)
+
+
+def model_info(model):
+    """Returns (context tokens, input price, output price) for a model."""
+    matches = [prefix for prefix in MODELS if model.startswith(prefix)]
+    if not matches:
+        return DEFAULT_MODEL
+    return MODELS[max(matches, key=len)]
+
+
+def _encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text, model):
+    """Counts tokens with tiktoken if installed, otherwise estimates them from the length."""
+    if tiktoken is not None:
+        return len(_encoding(model).encode(text, disallowed_special=()))
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    """Estimated USD cost of a request, with cached prompt tokens billed at half price."""
+    _, input_price, output_price = model_info(model)
+    uncached = prompt_tokens - cached_tokens
+    return (uncached * input_price + cached_tokens * input_price / 2 + completion_tokens * output_price) / 1_000_000
+
+
+def normalize_whitespace(text):
+    """Collapses all runs of whitespace to single spaces in one pass."""
+    return WHITESPACE.sub(" ", text).strip()
+
+
+def content_budget(model, prompt_tokens):
+    """Tokens available for document content: the configured budget, capped by the model's context window."""
+    context = model_info(model)[0]
+    return max(0, min(CONTENT_TOKEN_BUDGET, context - prompt_tokens - OUTPUT_RESERVE))
+
+
+def _date_lines(text, max_chars):
+    picked, used, seen = [], 0, set()
+    for match in DATE.finditer(text):
+        start = text.rfind("\n", 0, match.start()) + 1
+        end = text.find("\n", match.end())
+        line = normalize_whitespace(text[start:end if end != -1 else len(text)])
+        if line in seen:
+            continue
+        if used + len(line) > max_chars:
+            break
+        seen.add(line)
+        picked.append(line)
+        used += len(line) + len(GAP)
+    return picked
+
+
+def select_content(content, model, budget):
+    """Returns the content to send, fitted to budget tokens.
+
+    Content that fits is sent whole. Otherwise the start of the document (letterhead, subject, first page),
+    lines from the middle that contain dates, and the end (last page, signature) are kept.
+    """
+    text = normalize_whitespace(content)
+    if budget <= 0:
+        return ""
+    # cheap upper bound first, tokens are never shorter than one character
+    if len(text) <= budget or count_tokens(text, model) <= budget:
+        return text
+
+    max_chars = int(budget * CHARS_PER_TOKEN)
+    while True:
+        head_chars = int(max_chars * HEAD_SHARE)
+        dates_chars = int(max_chars * DATES_SHARE)
+        tail_chars = max_chars - head_chars - dates_chars
+        # dates are looked up in the raw content, where line breaks still separate them from their context
+        middle = content[head_chars:max(head_chars, len(content) - tail_chars)]
+        parts = [text[:head_chars]] + _date_lines(middle, dates_chars) + [text[-tail_chars:]]
+        selected = GAP.join(part for part in parts if part)
+        if count_tokens(selected, model) <= budget or max_chars < 100:
+            return selected
+        max_chars = int(max_chars * 0.9)
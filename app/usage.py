@@ -0,0 +1,55 @@
+import logging
+import threading
+
+from metrics import METRICS
+from token_budget import estimate_cost
+
+
+class UsageTracker:
+    """Aggregates the token usage reported with each OpenAI response, per model."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models = {}
+
+    def record(self, model, usage):
+        """Adds the usage of one response. usage may be the SDK object or the plain dict from a batch result."""
+        if usage is None:
+            return
+        if not isinstance(usage, dict):
+            usage = usage.model_dump() if hasattr(usage, "model_dump") else vars(usage)
+        prompt_tokens = usage.get("prompt_tokens") or 0
+        completion_tokens = usage.get("completion_tokens") or 0
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        logging.debug(f"usage: {prompt_tokens} prompt tokens ({cached_tokens} cached), {completion_tokens} completion tokens")
+        with self._lock:
+            totals = self._models.setdefault(model, {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0,
+                                                     "completion_tokens": 0})
+            totals["requests"] += 1
+            totals["prompt_tokens"] += prompt_tokens
+            totals["cached_tokens"] += cached_tokens
+            totals["completion_tokens"] += completion_tokens
+        METRICS.inc("openai_tokens_total", prompt_tokens - cached_tokens, model=model, type="prompt")
+        METRICS.inc("openai_tokens_total", cached_tokens, model=model, type="cached")
+        METRICS.inc("openai_tokens_total", completion_tokens, model=model, type="completion")
+
+    def summary(self):
+        """Returns the totals per model with the prompt cache hit rate and the estimated cost in USD."""
+        with self._lock:
+            models = {model: dict(totals) for model, totals in self._models.items()}
+        for model, totals in models.items():
+            prompt_tokens = totals["prompt_tokens"]
+            totals["cache_hit_rate"] = round(totals["cached_tokens"] / prompt_tokens, 3) if prompt_tokens else 0.0
+            totals["estimated_cost_usd"] = round(estimate_cost(model, prompt_tokens, totals["completion_tokens"],
+                                                               totals["cached_tokens"]), 4)
+        return models
+
+    def log_summary(self):
+        for model, totals in self.summary().items():
+            logging.info(f"OpenAI usage for {model}: {totals['requests']} requests, "
+                         f"{totals['prompt_tokens']} prompt tokens of which {totals['cached_tokens']} cached "
+                         f"({totals['cache_hit_rate']:.1%}), {totals['completion_tokens']} completion tokens, "
+                         f"about ${totals['estimated_cost_usd']:.4f}")
+
+
+USAGE = UsageTracker()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Resident worker processing documents queued by the post-consume script.
+
+Keeps the Paperless sessions, the OpenAI client and the metadata caches warm between documents and
+processes up to WORKER_CONCURRENCY documents at once.
+"""
+import logging
+import os
+import signal
+import threading
+import time
+
+import requests
+
+from cfg import (PAPERLESS_API_KEY, PAPERLESS_URL, OPENAI_API_KEY, OPENAPI_MODEL, OPENAI_BASEURL, OWNER_NAME,
+                 WORKER_QUEUE_PATH, WORKER_CONCURRENCY, WORKER_POLL_INTERVAL, WORKER_MAX_ATTEMPTS, METRICS_PORT)
+from helpers import strtobool
+from job_queue import JobQueue
+from metrics import start_metrics_server
+from main import ProcessingContext, get_single_document, process_single_document, set_auth_tokens
+from pool import run_bounded, ThreadContexts
+from result_cache import configure_result_cache
+from cascade import configure_cascade
+from duplicates import configure_duplicates
+from usage import USAGE
+from resilience import log_retry_summary
+
+# finished jobs are kept for a day so recent activity can be inspected in the queue file
+KEEP_DONE_SECONDS = 24 * 60 * 60
+
+
+def iter_jobs(queue, stop, poll_interval):
+    """Yields claimed (job_id, doc_pk) jobs until stop is set, polling while the queue is empty."""
+    while not stop.is_set():
+        jobs = queue.claim()
+        if not jobs:
+            queue.purge_done(KEEP_DONE_SECONDS)
+            stop.wait(poll_interval)
+            continue
+        yield from jobs
+
+
+def run_worker(queue_path=WORKER_QUEUE_PATH, concurrency=WORKER_CONCURRENCY, poll_interval=WORKER_POLL_INTERVAL,
+               dry_run=False, metrics_port=METRICS_PORT):
+    queue = JobQueue(queue_path, WORKER_MAX_ATTEMPTS)
+    queue.requeue_running()
+    stop = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stop.set())
+
+    def new_session():
+        sess = requests.Session()
+        set_auth_tokens(sess, PAPERLESS_API_KEY)
+        return sess
+
+    def run_job(job):
+        job_id, doc_pk = job
+        started = time.monotonic()
+        worker_ctx = contexts.get()
+        doc_info = get_single_document(worker_ctx.sess, doc_pk, PAPERLESS_URL)
+        if not isinstance(doc_info, dict):
+            queue.fail(job_id, "could not retrieve document")
+            return
+        try:
+            processed = process_single_document(worker_ctx, doc_info)
+        except Exception as e:
+            queue.fail(job_id, repr(e))
+            raise
+        if processed:
+            queue.complete(job_id)
+            logging.info(f"processed document {doc_pk} in {time.monotonic() - started:.2f}s")
+        else:
+            queue.fail(job_id, "processing failed")
+
+    logging.info(f"worker started on {queue_path} with concurrency {concurrency}")
+    metrics_server = start_metrics_server(metrics_port) if metrics_port else None
+    with requests.Session() as sess:
+        set_auth_tokens(sess, PAPERLESS_API_KEY)
+        ctx = ProcessingContext(sess, PAPERLESS_URL, OPENAPI_MODEL, OPENAI_API_KEY, OPENAI_BASEURL,
+                                username=OWNER_NAME, dry_run=dry_run)
+        contexts = ThreadContexts(ctx, new_session)
+        try:
+            run_bounded(iter_jobs(queue, stop, poll_interval), run_job, concurrency)
+        finally:
+            contexts.close()
+            ctx.close()
+            queue.close()
+            if metrics_server:
+                metrics_server.shutdown()
+            USAGE.log_summary()
+            log_retry_summary()
+    logging.info("worker stopped")
+
+
+if __name__ == '__main__':
+    LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO').upper()
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                        datefmt='%m/%d/%Y %I:%M:%S %p',
+                        level=LOGLEVEL)
+    if not WORKER_QUEUE_PATH:
+        logging.error("Missing WORKER_QUEUE_PATH")
+        raise SystemExit(1)
+    DRY_RUN = strtobool(os.getenv("DRY_RUN", "false"))
+    if DRY_RUN:
+        logging.info("DRY_RUN ENABLED")
+    configure_result_cache()
+    configure_cascade()
+    configure_duplicates()
+    run_worker(dry_run=DRY_RUN)
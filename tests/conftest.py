@@ -0,0 +1,46 @@
+import os
+import sys
+
+import pytest
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+# the modules in app/ import each other by their bare names, as when the post-consume script runs them
+sys.path[:0] = [APP, os.path.join(APP, "scripts")]
+
+# cfg reads the environment once on import: fail fast against the stub and keep every store out of the tree
+os.environ.update({
+    "RETRY_MAX_ATTEMPTS": "2",
+    "RETRY_BASE_DELAY": "0.01",
+    "RETRY_MAX_DELAY": "0.05",
+    "BREAKER_FAILURE_THRESHOLD": "0",
+})
+for name in ("RESULT_CACHE_PATH", "CASCADE_INDEX_PATH", "DUPLICATE_INDEX_PATH", "WORKER_QUEUE_PATH", "OWNER_NAME",
+             "FUZZY_MATCH_THRESHOLD"):
+    os.environ.pop(name, None)
+
+
+@pytest.fixture
+def stub():
+    """A running stub Paperless and OpenAI server with 30 documents, and its base URL."""
+    from metadata_cache import invalidate_all
+    from stub_server import StubServer
+
+    server = StubServer(documents=30)
+    base_url = server.start()
+    try:
+        yield server, base_url
+    finally:
+        server.stop()
+        invalidate_all()
+
+
+@pytest.fixture
+def cli_args(stub, tmp_path):
+    """Returns a function building cli arguments pointing at the stub, with the run state in tmp_path."""
+    _, base_url = stub
+
+    def build(*args):
+        return ["--loglevel", "WARNING", "--paperlessurl", base_url, "--paperlesskey", "test",
+                "--openaikey", "test", "--openaibaseurl", base_url + "/v1", "--openaimodel", "gpt-4o-mini",
+                *args]
+    return build
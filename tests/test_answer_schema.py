@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+from answer_schema import AnswerStream, MalformedAnswer, parse_answer
+
+
+def answer(**fields):
+    data = {
+        "title": "Stromrechnung",
+        "created_date": "2024-03-01",
+        "tags": ["Strom", "Rechnung"],
+        "correspondent": "Stadtwerke",
+        "document_type": "Rechnung",
+        "summary": "Jahresabrechnung Strom",
+        "explanation": "Eine Rechnung der Stadtwerke.",
+    }
+    data.update(fields)
+    return json.dumps(data, ensure_ascii=False)
+
+
+def stream(text, chunk_size=16, on_field=None):
+    parser = AnswerStream(on_field)
+    for start in range(0, len(text), chunk_size):
+        parser.feed(text[start:start + chunk_size])
+    return parser
+
+
+def test_fields_are_reported_as_they_complete():
+    seen = []
+    parser = stream(answer(), on_field=lambda name, value: seen.append((name, value)))
+    assert [name for name, _ in seen] == ["title", "created_date", "tags", "correspondent", "document_type",
+                                          "summary", "explanation"]
+    assert dict(seen)["tags"] == ["Strom", "Rechnung"]
+    assert json.loads(parser.finish())["correspondent"] == "Stadtwerke"
+
+
+def test_long_explanation_is_accepted():
+    text = answer(explanation="Sehr ausführlich. " * 50)
+    assert len(json.loads(text)["explanation"]) > 850
+    assert json.loads(stream(text).finish())["explanation"].startswith("Sehr ausführlich.")
+
+
+def test_runaway_field_is_rejected():
+    with pytest.raises(MalformedAnswer, match="title"):
+        stream(answer(title="Rechnung " * 40))
+
+
+def test_text_before_the_object_is_rejected():
+    with pytest.raises(MalformedAnswer):
+        stream("Here is the answer: " + answer())
+
+
+def test_invalid_field_is_rejected_before_the_answer_ends():
+    text = answer(tags=[1, 2])
+    parser = AnswerStream()
+    with pytest.raises(MalformedAnswer, match="tags"):
+        parser.feed(text)
+    assert "summary" not in parser.fields
+
+
+def test_cut_off_explanation_keeps_the_answer():
+    text = answer(explanation="abgeschnitten " * 10)
+    parser = stream(text[:-30])
+    assert json.loads(parser.finish())["explanation"] == ""
+
+
+def test_missing_required_field_fails_on_finish():
+    with pytest.raises(MalformedAnswer, match="summary"):
+        stream(answer()[:120]).finish()
+
+
+def test_parse_answer_ignores_code_fences_and_splits_tag_strings():
+    parsed = parse_answer("```json\n" + answer(tags="Strom, Rechnung, ") + "\n```")
+    assert parsed.tags == ["Strom", "Rechnung"]
+    assert parse_answer("no answer") is None
@@ -0,0 +1,71 @@
+import json
+
+import pytest
+import requests
+
+from batch import BatchState, apply_batch_result
+from main import ProcessingContext, set_auth_tokens
+from stub_server import answer_for
+
+
+@pytest.fixture
+def state(tmp_path):
+    state = BatchState(str(tmp_path / "batch_state.sqlite"))
+    yield state
+    state.close()
+
+
+@pytest.fixture
+def ctx(stub):
+    _, base_url = stub
+    with requests.Session() as sess:
+        set_auth_tokens(sess, "test")
+        ctx = ProcessingContext(sess, base_url, "gpt-4o-mini", "test", base_url + "/v1", openai_client=object())
+        yield ctx
+        ctx.close()
+
+
+def test_failed_requests_can_be_submitted_again(state):
+    state.add_batch("batch_1", "validating", [("doc-1", 1, "key-1"), ("doc-2", 2, "key-2")])
+    assert state.is_requested(1) and state.is_requested(2)
+    state.set_request_status("doc-2", "failed")
+    assert not state.is_requested(2)
+    assert state.request("doc-1") == (1, "key-1", "submitted")
+    assert state.counts() == {"submitted": 1, "failed": 1}
+    state.update_batch("batch_1", "completed", output_file_id="file_1")
+    assert state.batches(("completed",)) == [("batch_1", "completed", "file_1", None)]
+    assert state.batches(("in_progress",)) == []
+
+
+def test_result_is_applied_once(stub, ctx, state):
+    server, _ = stub
+    state.add_batch("batch_1", "completed", [("doc-1", 1, "key-1")])
+    apply_batch_result(ctx, state, "doc-1", json.dumps(answer_for(1)))
+    assert server.documents[1]["title"] == "Dokument 1"
+    assert state.request("doc-1")[2] == "applied"
+    patches = server.requests["PATCH /api/documents/1/"]
+    apply_batch_result(ctx, state, "doc-1", json.dumps(answer_for(1)))
+    assert server.requests["PATCH /api/documents/1/"] == patches
+
+
+def test_unusable_result_marks_the_request_failed(stub, ctx, state):
+    server, _ = stub
+    state.add_batch("batch_1", "completed", [("doc-1", 1, "key-1"), ("doc-2", 2, "key-2")])
+    apply_batch_result(ctx, state, "doc-1", None)
+    apply_batch_result(ctx, state, "doc-2", "not json")
+    apply_batch_result(ctx, state, "unknown", json.dumps(answer_for(3)))
+    assert state.counts() == {"failed": 2}
+    assert server.documents[1]["title"] == "scan 1"
+
+
+def test_dry_apply_leaves_the_result_for_a_real_apply(stub, ctx, state):
+    server, _ = stub
+    state.add_batch("batch_1", "completed", [("doc-1", 1, "key-1")])
+    ctx.dry_run = True
+    apply_batch_result(ctx, state, "doc-1", json.dumps(answer_for(1)))
+    assert server.documents[1]["title"] == "scan 1"
+    assert state.request("doc-1")[2] == "submitted"
+    ctx.dry_run = False
+    apply_batch_result(ctx, state, "doc-1", json.dumps(answer_for(1)))
+    assert server.documents[1]["title"] == "Dokument 1"
+    assert state.request("doc-1")[2] == "applied"
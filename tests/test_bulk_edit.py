@@ -0,0 +1,73 @@
+import requests
+
+from bulk_edit import BulkCommitter
+from cli import parse_args
+from run_state import RunState
+
+
+def metadata(tags, correspondent=1, document_type=1):
+    return {"tags": tags, "correspondent": correspondent, "document_type": document_type}
+
+
+def test_tags_are_added_to_the_current_ones(stub):
+    server, base_url = stub
+    server.documents[1]["tags"] = [1, 2]
+    server.documents[2]["tags"] = [2, 3]
+    server.documents[3]["tags"] = []
+    committer = BulkCommitter(base_url, batch_size=10)
+    with requests.Session() as sess:
+        committer.add(sess, dict(server.documents[1]), metadata([2, 4]))
+        committer.add(sess, dict(server.documents[2]), metadata([4, 2]))
+        committer.add(sess, dict(server.documents[3]), metadata([5], correspondent=2))
+        committer.flush(sess)
+    assert server.documents[1]["tags"] == [1, 2, 4]
+    assert server.documents[2]["tags"] == [2, 3, 4]
+    assert server.documents[3]["tags"] == [5]
+    assert server.documents[3]["correspondent"] == 2
+    # two sets of added tags, two correspondents and one document type
+    assert server.requests["POST /api/documents/bulk_edit/"] == 5
+
+
+def test_documents_are_written_once_all_their_groups_are(stub):
+    server, base_url = stub
+    committer = BulkCommitter(base_url, batch_size=2)
+    written = {}
+    with requests.Session() as sess:
+        committer.add(sess, dict(server.documents[1]), metadata([1]))
+        committer.when_written(1, lambda ok: written.setdefault(1, ok))
+        # fills the correspondent and document type groups, the tag sets differ
+        committer.add(sess, dict(server.documents[2]), metadata([2]))
+        committer.when_written(2, lambda ok: written.setdefault(2, ok))
+        assert written == {}
+        committer.flush(sess)
+    assert written == {1: True, 2: True}
+    # nothing queued, answered right away
+    committer.when_written(3, lambda ok: written.setdefault(3, ok))
+    assert written[3] is True
+
+
+def test_failed_bulk_edit_is_reported(stub):
+    server, base_url = stub
+    committer = BulkCommitter(base_url)
+    written = {}
+    with requests.Session() as sess:
+        committer.add(sess, dict(server.documents[1]), metadata([1]))
+        committer.when_written(1, lambda ok: written.setdefault(1, ok))
+        server.error_rate = 1.0
+        committer.flush(sess)
+    assert written == {1: False}
+
+
+def test_bulkedit_run_records_documents_after_their_bulk_edit(stub, cli_args, tmp_path):
+    server, _ = stub
+    state_path = str(tmp_path / "run_state.sqlite")
+    original = server._bulk_edit
+    # the stub answers bulk_edit for tag sets with an error
+    server._bulk_edit = lambda body: (500, {"detail": "error"}) if body["method"] == "modify_tags" else original(body)
+    parse_args(cli_args("all", "--bulkedit", "--workers", "4", "--runstatepath", state_path))
+    state = RunState(state_path)
+    try:
+        assert sorted(state.failed_ids()) == sorted(server.documents)
+    finally:
+        state.close()
+    assert all(doc["correspondent"] for doc in server.documents.values())
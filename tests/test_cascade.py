@@ -0,0 +1,59 @@
+import json
+
+import pytest
+import requests
+
+import cascade
+from cascade import classify_from_neighbours, configure_cascade, record_processed
+from main import ProcessingContext, process_single_document, set_auth_tokens
+
+STATEMENT = ("Kontoauszug der Sparkasse für das Girokonto mit allen Buchungen des Monats, Überweisungen, "
+             "Lastschriften und Daueraufträge sowie dem Saldo am Ende des Abrechnungszeitraums. Bitte prüfen "
+             "Sie die Buchungen und melden Sie Unstimmigkeiten innerhalb von sechs Wochen bei Ihrer Filiale. "
+             "Mit freundlichen Grüßen Ihre Sparkasse am Ort, Kundenservice und Beratung für Privatkunden. ")
+
+
+def statement(month):
+    return f"Kontoauszug {month}/2024\n" + STATEMENT * 2
+
+
+def answer(month):
+    return json.dumps({"title": f"Kontoauszug {month}", "created_date": f"2024-{month:02d}-01",
+                       "tags": ["bank"], "correspondent": "Sparkasse", "document_type": "Kontoauszug",
+                       "summary": f"Kontoauszug für Monat {month}", "explanation": "test"})
+
+
+@pytest.fixture
+def neighbours(tmp_path):
+    configure_cascade(str(tmp_path / "similar.sqlite"), model="")
+    for month in (1, 2):
+        record_processed({"id": 100 + month, "content": statement(month)}, answer(month))
+    yield
+    configure_cascade(None)
+
+
+def test_without_a_model_only_metadata_is_reused(neighbours):
+    reused = json.loads(classify_from_neighbours(None, {"id": 1, "content": statement(3)}))
+    assert reused["metadata_only"] is True
+    assert (reused["tags"], reused["correspondent"], reused["document_type"]) == (["bank"], "Sparkasse", "Kontoauszug")
+    assert not {"title", "created_date", "summary"} & reused.keys()
+
+
+def test_unrelated_documents_are_escalated(neighbours):
+    assert classify_from_neighbours(None, {"id": 1, "content": "Mietvertrag " * 10 + STATEMENT[::-1]}) is None
+
+
+def test_reused_metadata_keeps_title_and_summary(neighbours, stub):
+    server, base_url = stub
+    doc = server.documents[1]
+    doc["content"] = statement(3)
+    with requests.Session() as sess:
+        set_auth_tokens(sess, "test")
+        ctx = ProcessingContext(sess, base_url, "gpt-4o-mini", "test", base_url + "/v1", openai_client=object())
+        assert process_single_document(ctx, dict(doc))
+    assert server.completions == 0
+    assert doc["title"] == "scan 1"
+    assert doc["custom_fields"] == []
+    assert doc["correspondent"] and doc["document_type"] and doc["tags"]
+    # an answer without title is not recorded as a neighbour for later documents
+    assert len(cascade._index) == 2
@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+import requests
+
+from cli import LIST_FIELDS, iter_documents, iter_with_content, parse_args
+from helpers import ListingError
+from run_state import RunState
+
+
+def test_iter_documents_pages_through_the_listing(stub):
+    _, base_url = stub
+    with requests.Session() as sess:
+        docs = list(iter_documents(sess, base_url, page_size=7, prefetch=True))
+    assert [doc["id"] for doc in docs] == list(range(1, 31))
+
+
+def test_iter_documents_raises_on_a_failed_page(stub):
+    server, base_url = stub
+    with requests.Session() as sess:
+        docs = iter_documents(sess, base_url, page_size=10)
+        assert next(docs)["id"] == 1
+        server.error_rate = 1.0
+        with pytest.raises(ListingError):
+            list(docs)
+
+
+def test_content_is_fetched_on_sessions_of_their_own(stub):
+    _, base_url = stub
+    callers = set()
+    with requests.Session() as sess:
+        request = sess.request
+
+        def recording_request(*args, **kwargs):
+            callers.add(threading.get_ident())
+            return request(*args, **kwargs)
+        sess.request = recording_request
+        listed = iter_documents(sess, base_url, page_size=5, prefetch=True, fields=LIST_FIELDS)
+        docs = list(iter_with_content(sess, base_url, listed, batch_size=4, concurrency=3))
+    assert [doc["id"] for doc in docs] == list(range(1, 31))
+    assert all(doc["content"] for doc in docs)
+    assert callers == {threading.get_ident()}
+
+
+@pytest.mark.parametrize("mode", [[], ["--async"]])
+def test_failed_listing_does_not_finish_the_run(stub, cli_args, tmp_path, mode):
+    server, _ = stub
+    server.error_rate = 1.0
+    state_path = str(tmp_path / "run_state.sqlite")
+    parse_args(cli_args("all", *mode, "--runstatepath", state_path))
+    state = RunState(state_path)
+    try:
+        assert state.last_finished_run_start() is None
+    finally:
+        state.close()
+
+
+@pytest.mark.parametrize("mode", [[], ["--async"]])
+def test_failed_content_fetch_does_not_finish_the_run(stub, cli_args, tmp_path, mode):
+    server, _ = stub
+    state_path = str(tmp_path / "run_state.sqlite")
+    # listing without content first, then every fetch of the content fails
+    original = server.handle
+    server.handle = lambda method, path, query, *rest: (
+        (503, {"detail": "injected error"}) if "id__in" in query else original(method, path, query, *rest))
+    parse_args(cli_args("all", *mode, "--resume", "--runstatepath", state_path))
+    state = RunState(state_path)
+    try:
+        assert state.last_finished_run_start() is None
+    finally:
+        state.close()
+    assert server.completions == 0
@@ -0,0 +1,80 @@
+import json
+
+import pytest
+import requests
+
+import cascade
+import duplicates
+from cascade import configure_cascade
+from duplicates import configure_duplicates, record_document
+from batch import BatchState, submit_batches
+from main import ProcessingContext, process_single_document, set_auth_tokens
+from packing import process_documents
+
+LETTER = ("Sehr geehrte Damen und Herren, hiermit kündige ich meinen Vertrag fristgerecht zum nächstmöglichen "
+          "Zeitpunkt. Bitte bestätigen Sie mir den Eingang dieser Kündigung sowie das Datum, zu dem der Vertrag "
+          "endet, schriftlich. Eine Einzugsermächtigung widerrufe ich zum selben Datum. Mit freundlichen Grüßen ")
+ANSWER = json.dumps({"title": "Kündigung Vertrag", "created_date": "2024-03-01", "tags": ["vertrag"],
+                     "correspondent": "Stadtwerke", "document_type": "Kündigung",
+                     "summary": "Kündigung des Vertrags", "explanation": "test"})
+
+
+@pytest.fixture
+def ctx(stub):
+    _, base_url = stub
+    with requests.Session() as sess:
+        set_auth_tokens(sess, "test")
+        ctx = ProcessingContext(sess, base_url, "gpt-4o-mini", "test", base_url + "/v1")
+        yield ctx
+        ctx.close()
+
+
+@pytest.fixture
+def indexes(tmp_path):
+    configure_duplicates(str(tmp_path / "duplicates.sqlite"), tag="duplikat")
+    configure_cascade(str(tmp_path / "similar.sqlite"), model="")
+    record_document({"id": 101, "content": LETTER * 2}, ANSWER)
+    cascade.record_processed({"id": 101, "content": LETTER * 2}, ANSWER)
+    yield
+    configure_duplicates(None)
+    configure_cascade(None)
+
+
+def test_reused_duplicate_is_recorded_with_the_original_answer(indexes, stub):
+    server, base_url = stub
+    doc = server.documents[1]
+    doc["content"] = LETTER * 2
+    with requests.Session() as sess:
+        set_auth_tokens(sess, "test")
+        ctx = ProcessingContext(sess, base_url, "gpt-4o-mini", "test", base_url + "/v1", openai_client=object())
+        assert process_single_document(ctx, dict(doc))
+    assert server.completions == 0
+    assert doc["title"] == "Kündigung Vertrag"
+    assert len(doc["tags"]) == 2
+    # the duplicate tag stays on the duplicate and is not handed on to documents resembling it
+    assert duplicates._index.answer(1) == ANSWER
+    assert cascade._index._answer(1) == ANSWER
+
+
+def test_only_documents_without_a_duplicate_are_packed(indexes, stub, ctx):
+    server, _ = stub
+    for doc_pk in (1, 2):
+        server.documents[doc_pk]["content"] = LETTER * 2
+    docs = [dict(server.documents[doc_pk]) for doc_pk in (1, 2, 3, 4)]
+    assert process_documents(ctx, docs) == {1: True, 2: True, 3: True, 4: True}
+    assert server.completions == 1
+    assert server.documents[1]["title"] == "Kündigung Vertrag"
+    assert server.documents[3]["title"] == "Dokument 3"
+
+
+def test_duplicates_are_not_submitted_as_batch_requests(indexes, stub, ctx, tmp_path):
+    server, _ = stub
+    server.documents[1]["content"] = LETTER * 2
+    state = BatchState(str(tmp_path / "batch_state.sqlite"))
+    try:
+        # no request is left to upload, the stub has no files endpoint
+        submit_batches(ctx, state, [dict(server.documents[1])], requests.Session())
+        assert state.batches() == []
+    finally:
+        state.close()
+    assert server.documents[1]["title"] == "Kündigung Vertrag"
@@ -0,0 +1,46 @@
+import pytest
+
+import fuzzy_index
+from fuzzy_index import TrigramIndex, normalize
+from metadata_cache import TAG_CACHE
+
+NAMES = ["Rechnung", "Finanzamt", "Deutsche Bahn", "Stadtwerke Köln", "Versicherung"]
+
+
+@pytest.fixture(params=["numpy", "python"])
+def index(request, monkeypatch):
+    if request.param == "python":
+        monkeypatch.setattr(fuzzy_index, "np", None)
+    elif fuzzy_index.np is None:
+        pytest.skip("NumPy is not installed")
+    index = TrigramIndex(0.8)
+    for value, name in enumerate(NAMES, 1):
+        index.add(name, value)
+    return index
+
+
+def test_normalize_folds_case_umlauts_and_punctuation():
+    assert normalize("  Straße & Söhne GmbH.") == "strasse sohne gmbh"
+
+
+@pytest.mark.parametrize("name, value", [("Rechnungen", 1), ("Finanzamt München", 2), ("versicherungen", 5)])
+def test_spelling_variants_match(index, name, value):
+    assert index.best(name)[0] == value
+
+
+@pytest.mark.parametrize("name", ["Deutsche Bank", "Stadtwerke München", "Vertrag", "", "--"])
+def test_distinct_names_do_not_match(index, name):
+    assert index.best(name) is None
+
+
+def test_names_added_later_are_found(index):
+    assert index.best("Kontoauszüge") is None
+    index.add("Kontoauszug", 6)
+    assert index.best("Kontoauszüge")[:2] == (6, "Kontoauszug")
+
+
+def test_cache_matches_exact_names_only_by_default(stub):
+    _, base_url = stub
+    TAG_CACHE._store({"rechnung": 1}, base_url)
+    assert TAG_CACHE.match(" Rechnung ") == 1
+    assert TAG_CACHE.match("Rechnungen") is None
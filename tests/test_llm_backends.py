@@ -0,0 +1,53 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import main
+from cli import parse_args
+from llm_backends import DynamicBatcher, FakeBackend
+
+
+def conversation(i):
+    return [{"role": "user", "content": f"Dokument {i}"}]
+
+
+def batcher_threads():
+    return [thread for thread in threading.enumerate() if thread.name.endswith("-batcher")]
+
+
+def test_concurrent_requests_are_batched():
+    backend = FakeBackend(latency=0.05, per_document=0)
+    batcher = DynamicBatcher(backend, max_batch_size=4, max_wait_ms=50)
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            answers = list(executor.map(lambda i: batcher.generate(conversation(i)), range(8)))
+    finally:
+        batcher.close()
+    assert answers == [FakeBackend._answer(conversation(i)) for i in range(8)]
+    assert sum(backend.batches) == 8
+    assert max(backend.batches) <= 4
+    assert len(backend.batches) < 8
+
+
+def test_single_request_waits_at_most_max_wait():
+    backend = FakeBackend(latency=0, per_document=0)
+    batcher = DynamicBatcher(backend, max_batch_size=8, max_wait_ms=10)
+    try:
+        assert batcher.generate(conversation(1))
+    finally:
+        batcher.close()
+    assert backend.batches == [1]
+
+
+def test_run_shares_one_backend_and_stops_it(stub, cli_args, tmp_path, monkeypatch):
+    backends = []
+
+    def create_backend(*args):
+        backends.append(FakeBackend(latency=0.01, per_document=0))
+        return DynamicBatcher(backends[-1], max_batch_size=8, max_wait_ms=20)
+
+    monkeypatch.setattr(main, "create_backend", create_backend)
+    before = len(batcher_threads())
+    parse_args(cli_args("all", "--workers", "8", "--runstatepath", str(tmp_path / "run_state.sqlite")))
+    assert len(backends) == 1
+    assert sum(backends[0].batches) == 30
+    assert len(batcher_threads()) == before
@@ -0,0 +1,63 @@
+import os
+import subprocess
+import sys
+
+import requests
+
+from conftest import APP
+from job_queue import JobQueue
+from main import ProcessingContext, build_document_update, process_single_document, set_auth_tokens
+
+
+def test_post_consume_script_only_queues_with_a_worker(tmp_path):
+    queue_path = str(tmp_path / "queue.sqlite")
+    env = dict(os.environ, WORKER_QUEUE_PATH=queue_path, DOCUMENT_ID="7")
+    result = subprocess.run([sys.executable, "-X", "importtime", os.path.join(APP, "main.py")], env=env,
+                            capture_output=True, text=True, timeout=30)
+    assert result.returncode == 0
+    imported = {line.split("|")[-1].strip() for line in result.stderr.splitlines() if line.startswith("import time:")}
+    assert not imported & {"requests", "openai", "metrics", "cascade", "token_budget"}
+    queue = JobQueue(queue_path)
+    try:
+        assert [doc_pk for _, doc_pk in queue.claim()] == [7]
+    finally:
+        queue.close()
+
+
+DOC = {"id": 1, "title": "Rechnung März", "tags": [3, 1], "correspondent": 2, "document_type": 4,
+       "created_date": "2024-03-01", "custom_fields": [{"field": 9, "value": "x"}]}
+METADATA = {"tags": [1, 3], "correspondent": 2, "document_type": 4}
+
+
+def test_unchanged_fields_are_left_out():
+    assert build_document_update(DOC, "Rechnung März", METADATA, "2024-03-01") == {}
+    update = build_document_update(DOC, "Rechnung April", dict(METADATA, correspondent=5), "2024-03-01")
+    assert update == {"title": "Rechnung April", "correspondent": 5}
+
+
+def test_tags_are_added_to_the_current_ones():
+    update = build_document_update(DOC, metadata_ids=dict(METADATA, tags=[7, 1]))
+    assert update == {"tags": [3, 1, 7]}
+
+
+def test_other_custom_fields_are_kept():
+    update = build_document_update(DOC, custom_field_id=8, custom_field_value="Zusammenfassung")
+    assert update == {"custom_fields": [{"field": 9, "value": "x"}, {"field": 8, "value": "Zusammenfassung"}]}
+    assert build_document_update(DOC, custom_field_id=9, custom_field_value="x") == {}
+
+
+def test_processed_document_is_written_once(stub):
+    server, base_url = stub
+    server.documents[1]["tags"] = [1]
+    with requests.Session() as sess:
+        set_auth_tokens(sess, "test")
+        ctx = ProcessingContext(sess, base_url, "gpt-4o-mini", "test", base_url + "/v1")
+        try:
+            assert process_single_document(ctx, dict(server.documents[1]))
+            assert server.requests["PATCH /api/documents/{id}/"] == 1
+            assert server.documents[1]["tags"][0] == 1
+            # the same answer again, from the stub model, changes nothing
+            assert process_single_document(ctx, dict(server.documents[1]))
+        finally:
+            ctx.close()
+    assert server.requests["PATCH /api/documents/{id}/"] == 1
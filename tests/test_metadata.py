@@ -0,0 +1,72 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from main import set_auth_tokens
+from metadata_cache import TAG_CACHE, MetadataCache
+from tags import get_or_create_tag
+
+
+def test_rejected_create_is_not_retried(stub):
+    server, base_url = stub
+    with requests.Session() as sess:
+        set_auth_tokens(sess, "test")
+        assert get_or_create_tag(sess, " ", base_url) is None
+    assert server.requests["POST /api/tags/"] == 1
+    # the cached listing is still trusted
+    assert server.requests["GET /api/tags/"] == 1
+
+
+def test_conflicting_create_relists_the_collection(stub):
+    server, base_url = stub
+    with requests.Session() as sess:
+        set_auth_tokens(sess, "test")
+        TAG_CACHE.load(sess, base_url)
+        tags = server.collections["tags"]
+        tags[len(tags) + 1] = {"id": len(tags) + 1, "name": "Kontoauszug"}
+        assert get_or_create_tag(sess, "kontoauszug", base_url) == len(tags)
+    assert server.requests["POST /api/tags/"] == 1
+    assert server.requests["GET /api/tags/"] == 2
+
+
+def test_concurrent_lookups_of_a_name_share_one_call():
+    cache = MetadataCache("tags")
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def resolve():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 42
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        leader = executor.submit(cache.single_flight, "Rechnung", resolve)
+        started.wait(5)
+        followers = [executor.submit(cache.single_flight, name, resolve) for name in (" rechnung", "RECHNUNG ")]
+        time.sleep(0.05)
+        release.set()
+        results = [future.result() for future in [leader] + followers]
+    assert results == [42, 42, 42]
+    assert len(calls) == 1
+    # a later call after the flight landed resolves again
+    assert cache.single_flight("Rechnung", lambda: 43) == 43
+
+
+def test_concurrent_async_lookups_of_a_name_share_one_call():
+    cache = MetadataCache("tags")
+    calls = []
+
+    async def resolve():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 42
+
+    async def lookup_all():
+        return await asyncio.gather(*(cache.single_flight_async(name, resolve) for name in ("Rechnung", "rechnung ")))
+
+    assert asyncio.run(lookup_all()) == [42, 42]
+    assert len(calls) == 1
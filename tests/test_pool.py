@@ -0,0 +1,35 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import pool
+from pool import run_concurrently
+
+
+def test_results_keep_their_order():
+    assert run_concurrently([lambda i=i: i * i for i in range(10)]) == [i * i for i in range(10)]
+
+
+def test_every_thread_gets_its_own_session():
+    sess = requests.Session()
+    sess.headers["Authorization"] = "Token test"
+    barrier = threading.Barrier(3, timeout=5)
+
+    def call(thread_sess):
+        barrier.wait()
+        return thread_sess
+
+    sessions = run_concurrently([call] * 3, sess)
+    assert sessions[0] is sess
+    assert len({id(s) for s in sessions}) == 3
+    assert all(s.headers["Authorization"] == "Token test" for s in sessions)
+
+
+def test_nested_calls_do_not_wait_on_a_busy_pool(monkeypatch):
+    monkeypatch.setattr(pool, "_pool", ThreadPoolExecutor(max_workers=1))
+
+    def inner():
+        return sum(run_concurrently([lambda: 1] * 3))
+
+    assert run_concurrently([inner] * 3) == [3, 3, 3]
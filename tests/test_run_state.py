@@ -0,0 +1,63 @@
+from cli import parse_args
+from run_state import RunState
+
+
+def open_state(tmp_path):
+    return RunState(str(tmp_path / "run_state.sqlite"))
+
+
+def run_all(cli_args, tmp_path, *args):
+    parse_args(cli_args("all", "--workers", "4", "--runstatepath", str(tmp_path / "run_state.sqlite"), *args))
+
+
+def test_finished_run_is_recorded(stub, cli_args, tmp_path):
+    server, _ = stub
+    run_all(cli_args, tmp_path)
+    assert server.completions == 30
+    state = open_state(tmp_path)
+    try:
+        assert state.last_finished_run_start() is not None
+        assert state.failed_ids() == []
+    finally:
+        state.close()
+
+
+def test_dry_run_is_not_recorded(stub, cli_args, tmp_path):
+    parse_args(["--dry"] + cli_args("all", "--runstatepath", str(tmp_path / "run_state.sqlite")))
+    state = open_state(tmp_path)
+    try:
+        assert state.last_finished_run_start() is None
+    finally:
+        state.close()
+
+
+def test_resume_skips_processed_documents(stub, cli_args, tmp_path):
+    server, _ = stub
+    run_all(cli_args, tmp_path)
+    server.clear_counts()
+    run_all(cli_args, tmp_path, "--resume")
+    assert server.completions == 0
+    # listed without content, and none fetched with it
+    assert server.requests["GET /api/documents/"] == 1
+
+
+def test_since_last_run_retries_failed_documents(stub, cli_args, tmp_path):
+    server, _ = stub
+    run_all(cli_args, tmp_path)
+    state = open_state(tmp_path)
+    try:
+        state.record(5, "", False)
+    finally:
+        state.close()
+    # nothing was modified since the last run
+    for doc in server.documents.values():
+        doc["modified"] = "2024-01-01T00:00:00Z"
+    server.clear_counts()
+
+    run_all(cli_args, tmp_path, "--since-last-run")
+    assert server.completions == 1
+    state = open_state(tmp_path)
+    try:
+        assert state.failed_ids() == []
+    finally:
+        state.close()
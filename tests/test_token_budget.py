@@ -0,0 +1,32 @@
+from cfg import CONTENT_TOKEN_BUDGET
+from token_budget import GAP, content_budget, count_tokens, select_content
+
+MODEL = "gpt-4o-mini"
+
+
+def letter(middle_lines):
+    head = "Stadtwerke Musterstadt\nRechnung Nr. 4711\n" + "Sehr geehrte Kundin, sehr geehrter Kunde,\n" * 20
+    middle = "\n".join(f"Position {i}: Verbrauch und Grundpreis laut Tarif" for i in range(middle_lines))
+    dated = "\nZahlbar bis zum 15.04.2024 ohne Abzug.\n"
+    tail = "Mit freundlichen Grüßen\n" * 20 + "Ihre Stadtwerke"
+    return head + middle + dated + middle + "\n" + tail
+
+
+def test_short_content_is_sent_whole():
+    assert select_content("Rechnung\n\n  Nr. 4711 ", MODEL, 100) == "Rechnung Nr. 4711"
+    assert select_content("Rechnung", MODEL, 0) == ""
+
+
+def test_long_content_keeps_start_dates_and_end():
+    content = letter(500)
+    selected = select_content(content, MODEL, 300)
+    assert count_tokens(selected, MODEL) <= 300
+    assert selected.startswith("Stadtwerke Musterstadt Rechnung Nr. 4711")
+    assert selected.endswith("Ihre Stadtwerke")
+    assert f"{GAP}Zahlbar bis zum 15.04.2024 ohne Abzug.{GAP}" in selected
+
+
+def test_budget_is_capped_by_the_context_window():
+    assert content_budget(MODEL, 1000) == CONTENT_TOKEN_BUDGET
+    assert content_budget("local-model", 7000) == 168
+    assert content_budget("local-model", 9000) == 0